@@ -3,14 +3,18 @@ import json
 import time
 import datetime
 import calendar
+import functools
 
 from collections import OrderedDict
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf.urls.defaults import url
 from django.utils.timezone import make_aware, utc
 from django.utils.timezone import now as django_now
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.http import StreamingHttpResponse
 
 from tastypie.resources import ModelResource, Resource, ALL, ALL_WITH_RELATIONS
 from tastypie.api import Api
@@ -20,7 +24,7 @@ from tastypie.serializers import Serializer
 from tastypie.bundle import Bundle
 from tastypie import fields
 from tastypie.exceptions import NotFound, BadRequest, Unauthorized
-from tastypie.http import HttpCreated
+from tastypie.http import HttpCreated, HttpNotFound, HttpMultipleChoices
 from tastypie.throttle import CacheDBThrottle
 
 from esmond.api import SNMP_NAMESPACE, ANON_LIMIT, OIDSET_INTERFACE_ENDPOINTS
@@ -57,7 +61,9 @@ REST namespace documentation:
 /v1/device/$DEVICE/interface/$INTERFACE/in
 /v1/device/$DEVICE/interface/$INTERFACE/out
 
-Params for GET: begin, end, agg (and cf where appropriate).
+Params for GET: begin, end, agg (and cf where appropriate).  Add stream=true
+to have the data written out as it is read rather than built up in memory
+first, which is worth doing for long time ranges.
 
 If none are supplied, sane defaults will be set by the interface and the 
 last hour of base rates will be returned.  The begin/end params are 
@@ -96,6 +102,28 @@ def get_throttle_args(config):
 
 THROTTLE_ARGS = get_throttle_args(get_config(get_config_path()))
 
+BULK_CONCURRENCY = get_config(get_config_path()).api_bulk_concurrency
+
+def run_bulk_queries(queries, concurrency=None):
+    """Run a list of no-argument callables that query the cassandra backend
+    and return their results in the same order.
+
+    Up to ``concurrency`` queries (api_bulk_concurrency by default) run at
+    once, each in its own thread using a connection from the pycassa
+    ConnectionPool.  An exception raised by any query is re-raised here."""
+    if concurrency is None:
+        concurrency = BULK_CONCURRENCY
+
+    if concurrency <= 1 or len(queries) <= 1:
+        return [q() for q in queries]
+
+    pool = ThreadPool(min(concurrency, len(queries)))
+    try:
+        return pool.map(lambda q: q(), queries)
+    finally:
+        pool.close()
+        pool.join()
+
 def check_connection():
     """Called by testing suite to produce consistent errors.  If no 
     cassandra instance is available, test_api might silently hide that 
@@ -475,7 +503,68 @@ class InterfaceDataObject(DataObject):
     """Encapsulation object to assign values to during processing."""
     pass
 
-class InterfaceDataResource(Resource):
+# Rows written per chunk of a streamed response.
+STREAM_CHUNK_ROWS = 1000
+
+def iter_json(d, key, rows):
+    """Generate the JSON for dict d in chunks, with the list d[key] taken
+    from the iterable rows as it is written.  The output matches what
+    DeviceSerializer produces for the whole dict."""
+    enc = DjangoJSONEncoder(sort_keys=True)
+
+    yield '{'
+    for i, k in enumerate(sorted(d.keys())):
+        if i:
+            yield ', '
+        yield enc.encode(k) + ': '
+        if k != key:
+            yield enc.encode(d[k])
+            continue
+
+        yield '['
+        rows = iter(rows)
+        first = True
+        while True:
+            chunk = [enc.encode(r) for r in islice(rows, STREAM_CHUNK_ROWS)]
+            if not chunk:
+                break
+            if not first:
+                yield ', '
+            first = False
+            yield ', '.join(chunk)
+        yield ']'
+    yield '}'
+
+class StreamingDetailMixin(object):
+    """Mixin for the data resources to return a StreamingHttpResponse when
+    the client passes stream=true.  obj_get must leave obj.data as an
+    iterator when obj.stream is set, so the series is formatted and written
+    as it is read from cassandra rather than built up in memory."""
+
+    def get_detail(self, request, **kwargs):
+        if not QueryUtil.stream_requested(request.GET):
+            return super(StreamingDetailMixin, self).get_detail(request, **kwargs)
+
+        # obj_get rather than cached_obj_get, obj.data is an iterator.
+        bundle = self.build_bundle(request=request)
+        try:
+            obj = self.obj_get(bundle, **self.remove_api_resource_names(kwargs))
+        except ObjectDoesNotExist:
+            return HttpNotFound()
+        except MultipleObjectsReturned:
+            return HttpMultipleChoices("More than one resource is found at this URI.")
+
+        # Dehydrate everything but the data so the rest of the payload
+        # is the same as the non-streamed response.
+        rows = obj.data
+        obj.data = []
+        bundle = self.full_dehydrate(self.build_bundle(obj=obj, request=request))
+        d = self._meta.serializer.to_simple(bundle, None)
+
+        return StreamingHttpResponse(iter_json(d, 'data', rows),
+                content_type='application/json')
+
+class InterfaceDataResource(StreamingDetailMixin, Resource):
     """Data for interface on a device.
 
     Note: this resource is always nested under a DeviceResource and is not bound
@@ -583,6 +672,8 @@ class InterfaceDataResource(Resource):
         else:
             obj.agg = None
 
+        obj.stream = QueryUtil.stream_requested(filters)
+
         return self._execute_query(oidset, obj)
 
     def _execute_query(self, oidset, obj):
@@ -612,16 +703,21 @@ class InterfaceDataResource(Resource):
 
         if obj.agg == oidset.frequency:
             # Fetch the base rate data.
-            data = db.query_baserate_timerange(path=obj.datapath, freq=obj.agg*1000,
+            data = db.iter_baserate_timerange(path=obj.datapath, freq=obj.agg*1000,
                     ts_min=obj.begin_time*1000, ts_max=obj.end_time*1000)
         else:
             # Get the aggregation.
             if obj.cf not in AGG_TYPES:
                 raise BadRequest('%s is not a valid consolidation function' %
                         (obj.cf))
-            data = db.query_aggregation_timerange(path=obj.datapath, freq=obj.agg*1000,
+            data = db.iter_aggregation_timerange(path=obj.datapath, freq=obj.agg*1000,
                     ts_min=obj.begin_time*1000, ts_max=obj.end_time*1000, cf=obj.cf)
 
+        if obj.stream:
+            obj.data = Fill.iter_fill(obj.begin_time, obj.end_time, obj.agg,
+                    QueryUtil.iter_format_data_payload(data))
+            return obj
+
         obj.data = QueryUtil.format_data_payload(data)
         obj.data = Fill.verify_fill(obj.begin_time, obj.end_time,
                 obj.agg, obj.data)
@@ -763,6 +859,9 @@ class InterfaceBulkRequestResource(Resource):
         else:
             ret_obj.agg = None
 
+        queries = []
+        paths = []
+
         for i in bundle.data['interfaces']:
             device_name = i['device'].rstrip('/').split('/')[-1]
             iface_name = i['iface']
@@ -801,14 +900,19 @@ class InterfaceBulkRequestResource(Resource):
                 obj.cf = ret_obj.cf
                 obj.agg = ret_obj.agg
 
-                data = InterfaceDataResource()._execute_query(oidset, obj)
+                queries.append(functools.partial(
+                    InterfaceDataResource()._execute_query, oidset, obj))
+                paths.append({'dev': device_name,'iface': iface_name,'endpoint': end_point})
 
-                row = {
-                    'data': data.data,
-                    'path': {'dev': device_name,'iface': iface_name,'endpoint': end_point},
-                }
+        # The lookups above all hit the SQL db so they are done up front
+        # and only the cassandra queries are run concurrently.
+        for data, path in zip(run_bulk_queries(queries), paths):
+            row = {
+                'data': data.data,
+                'path': path,
+            }
 
-                ret_obj.data.append(row)
+            ret_obj.data.append(row)
 
         bundle.obj = ret_obj
         return bundle
@@ -842,7 +946,8 @@ schema-like syntax.
 $TYPE: is RawData, BaseRate or Aggs
 $NS: is just a prefix/key construct
 
-Params for get: begin, end, and cf where appropriate.
+Params for get: begin, end, and cf where appropriate.  stream=true returns
+a streamed response as in the /v1/device/ namespace.
 Params for put: JSON list of dicts with keys 'val' and 'ts' sent as POST 
 data payload.
 
@@ -869,7 +974,7 @@ class TimeseriesDataObject(DataObject):
     """Data encapsulation."""
     pass
 
-class TimeseriesResource(Resource):
+class TimeseriesResource(StreamingDetailMixin, Resource):
     """
     This is a non-ORM resource.  The fields defined right below 
     are just the return values from ths resource, not connected to 
@@ -992,6 +1097,8 @@ class TimeseriesResource(Resource):
             else:
                 obj.cf = 'average'
 
+        obj.stream = QueryUtil.stream_requested(filters)
+
         obj = self._execute_query(obj)
 
         return obj
@@ -1094,23 +1201,31 @@ class TimeseriesResource(Resource):
         data = []
 
         if obj.r_type == 'BaseRate':
-            data = db.query_baserate_timerange(path=obj.datapath, freq=obj.agg,
+            data = db.iter_baserate_timerange(path=obj.datapath, freq=obj.agg,
                     ts_min=obj.begin_time, ts_max=obj.end_time)
         elif obj.r_type == 'Aggs':
             if obj.cf not in AGG_TYPES:
                 raise BadRequest('%s is not a valid consolidation function' %
                         (obj.cf))
-            data = db.query_aggregation_timerange(path=obj.datapath, freq=obj.agg,
+            data = db.iter_aggregation_timerange(path=obj.datapath, freq=obj.agg,
                     ts_min=obj.begin_time, ts_max=obj.end_time, cf=obj.cf)
         elif obj.r_type == 'RawData':
-            data = db.query_raw_data(path=obj.datapath, freq=obj.agg,
+            data = db.iter_raw_data(path=obj.datapath, freq=obj.agg,
                     ts_min=obj.begin_time, ts_max=obj.end_time)
         else:
             # Input has been checked already
             pass
 
-        obj.data = QueryUtil.format_data_payload(data, in_ms=True)
-        if not len(obj.data):
+        if obj.stream:
+            data = QueryUtil.iter_format_data_payload(data, in_ms=True)
+            # Only the first item is needed to tell if there is any data.
+            first = list(islice(data, 1))
+            obj.data = chain(first, data)
+        else:
+            obj.data = QueryUtil.format_data_payload(data, in_ms=True)
+            first = obj.data
+
+        if not len(first):
             # If no data is returned, sanity check that there is a 
             # corresponding key in the database.
             v = db.check_for_valid_keys(path=obj.datapath, freq=obj.agg, 
@@ -1119,8 +1234,12 @@ class TimeseriesResource(Resource):
                 raise BadRequest('The request path {0} has no corresponding keys.'.format([obj.r_type] + obj.datapath + [obj.agg]))
 
         if obj.r_type != 'RawData':
-            obj.data = Fill.verify_fill(obj.begin_time, obj.end_time,
-                    obj.agg, obj.data)
+            if obj.stream:
+                obj.data = Fill.iter_fill(obj.begin_time, obj.end_time,
+                        obj.agg, obj.data)
+            else:
+                obj.data = Fill.verify_fill(obj.begin_time, obj.end_time,
+                        obj.agg, obj.data)
 
         return obj
 
@@ -1130,11 +1249,14 @@ class TimeseriesResource(Resource):
         appropriate inserts, and then explicitly flush the db so the 
         inserts don't sit in the batch wating for more data to auto-flush.
         """
+        rate_bins = []
+
         for obj in objs:
             if obj.r_type == 'BaseRate':
                 rate_bin = BaseRateBin(path=obj.datapath, ts=obj.ts, 
                     val=obj.val, freq=obj.agg)
                 db.update_rate_bin(rate_bin)
+                rate_bins.append(rate_bin)
             elif obj.r_type == 'Aggs':
                 pass
             elif obj.r_type == 'RawData':
@@ -1147,6 +1269,11 @@ class TimeseriesResource(Resource):
         
         db.flush()
 
+        # The bins may be in blocks the query cache already holds.
+        for rate_bin in rate_bins:
+            db.expire_query_cache(db.rates, rate_bin.get_key(),
+                rate_bin.freq, rate_bin.ts_to_jstime())
+
         return True
 
 # ---
@@ -1242,6 +1369,8 @@ class TimeseriesBulkRequestResource(Resource):
         else:
             ret_obj.end_time = int(time.time()) * 1000
 
+        queries = []
+
         for p in bundle.data['paths']:
             obj = TimeseriesBulkRequestDataObject()
             obj.r_type = bundle.data['type']
@@ -1251,8 +1380,10 @@ class TimeseriesBulkRequestResource(Resource):
             obj.datapath = p
             obj.agg = int(obj.datapath.pop())
 
-            obj = TimeseriesResource()._execute_query(obj)
+            queries.append(functools.partial(
+                TimeseriesResource()._execute_query, obj))
 
+        for obj in run_bulk_queries(queries):
             row = {
                 'data': obj.data,
                 'path': obj.datapath + [obj.agg]
@@ -1493,8 +1624,8 @@ class OutletDataResource(Resource):
         return self._execute_query(oidset, obj)
 
     def _execute_query(self, oidset, obj):
-        data = db.query_raw_data(obj.datapath, oidset.frequency*1000,
-                                 obj.begin_time*1000, obj.end_time*1000)
+        data = db.iter_raw_data(obj.datapath, oidset.frequency*1000,
+                                obj.begin_time*1000, obj.end_time*1000)
 
         obj.data = QueryUtil.format_data_payload(data, coerce_to_bins=oidset.frequency*1000)
         obj.data = Fill.verify_fill(obj.begin_time, obj.end_time, oidset.frequency,
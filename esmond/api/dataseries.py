@@ -5,6 +5,12 @@ and gaps in a series of data.
 import datetime
 
 from collections import OrderedDict
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from esmond.util import atdecode, atencode
 from tastypie.exceptions import BadRequest
@@ -71,9 +77,14 @@ class QueryUtil(object):
         the bins spaced coerce_to_bins ms apart. This is useful for 
         fitting raw data to bin boundaries."""
 
-        divs = { False: 1000, True: 1 }
+        return list(QueryUtil.iter_format_data_payload(data, in_ms=in_ms,
+            coerce_to_bins=coerce_to_bins))
+
+    @staticmethod
+    def iter_format_data_payload(data, in_ms=False, coerce_to_bins=None):
+        """Generator version of format_data_payload."""
 
-        results = []
+        divs = { False: 1000, True: 1 }
 
         for row in data:
             ts = row['ts']
@@ -94,9 +105,39 @@ class QueryUtil(object):
             else: # Raw Data
                 pass
             
-            results.append(d)
+            yield d
+
+    @staticmethod
+    def format_data_arrays(data, in_ms=False, coerce_to_bins=None):
+        """Array version of format_data_payload for numeric series.
+
+        Returns a tuple of numpy arrays (timestamps, values).  The values
+        are a float64 masked array with invalid base rates and None values
+        masked.  Requires numpy."""
+        divs = { False: 1000, True: 1 }
+
+        ts = []
+        vals = []
+        mask = []
+        for row in data:
+            ts.append(row['ts'])
+            val = row['val']
+            invalid = val is None or row.get('is_valid', 1) == 0
+            vals.append(0 if invalid else val)
+            mask.append(invalid)
 
-        return results
+        ts = numpy.array(ts, dtype=numpy.int64)
+        if coerce_to_bins:
+            ts -= ts % coerce_to_bins
+        ts //= divs[in_ms]
+
+        return ts, numpy.ma.array(vals, mask=mask, dtype=numpy.float64)
+
+    @staticmethod
+    def stream_requested(filters):
+        """True if the client asked for a streamed response with the
+        stream=true query arg."""
+        return filters.get('stream', '').lower() in ('1', 'true', 'yes')
 
 class Fill(object):
     """Set of methods to verify that a series of binned data contains
@@ -160,7 +201,38 @@ class Fill(object):
     @staticmethod
     def generate_filled_series(start_bin, end_bin, freq, data):
         """Genrate a new 'filled' series if the returned series has unexpected
-        gaps.  Initialize a new range based in the requested time range as
+        gaps.  Uses numpy if it is installed.
+        """
+        if numpy is not None:
+            return iter(Fill.filled_series_numpy(start_bin, end_bin, freq, data))
+        return Fill.filled_series_dict(start_bin, end_bin, freq, data)
+
+    @staticmethod
+    def filled_series_numpy(start_bin, end_bin, freq, data):
+        """Build the filled series with numpy: the observed timestamps are
+        placed in an int64 array of the expected bins with searchsorted and
+        their values copied into an array that starts out as all None.
+        Returns a list."""
+        bins = numpy.arange(start_bin, end_bin + 1, freq, dtype=numpy.int64)
+        vals = numpy.empty(len(bins), dtype=object)
+
+        if len(data):
+            ts = numpy.fromiter((dp['ts'] for dp in data), dtype=numpy.int64,
+                    count=len(data))
+            idx = numpy.searchsorted(bins, ts)
+            # As with the dict version, a timestamp that isn't one of the
+            # expected bins is an error.
+            bad = idx >= len(bins)
+            bad[~bad] = bins[idx[~bad]] != ts[~bad]
+            if bad.any():
+                raise KeyError(int(ts[bad][0]))
+            vals[idx] = [dp['val'] for dp in data]
+
+        return [{'ts': t, 'val': v} for t, v in izip(bins.tolist(), vals.tolist())]
+
+    @staticmethod
+    def filled_series_dict(start_bin, end_bin, freq, data):
+        """Initialize a new range based in the requested time range as
         an OrderedDict, then iterate through original series to retain original
         values.
         """
@@ -198,6 +270,47 @@ class Fill(object):
             #print 'verify: filling'
             return list(Fill.generate_filled_series(start_bin,end_bin,freq,data))
 
+    @staticmethod
+    def fill_arrays(begin, end, freq, ts, vals):
+        """Array version of verify_fill for the output of
+        QueryUtil.format_data_arrays.  Returns (bins, values) covering every
+        expected bin, with the values of missing bins masked.  Timestamps
+        that aren't on a bin are dropped.  Requires numpy."""
+        begin, end, freq = int(begin), int(end), int(freq)
+        start_bin,end_bin,expected_bins = Fill.get_bin_alignment(begin, end, freq)
+
+        bins = numpy.arange(start_bin, end_bin + 1, freq, dtype=numpy.int64)
+        filled = numpy.ma.masked_all(len(bins), dtype=vals.dtype)
+
+        idx = numpy.searchsorted(bins, ts)
+        keep = idx < len(bins)
+        keep[keep] = bins[idx[keep]] == ts[keep]
+        filled[idx[keep]] = vals[keep]
+
+        return bins, filled
+
+    @staticmethod
+    def iter_fill(begin, end, freq, data):
+        """Generator version of verify_fill for data sorted by timestamp.
+        The data is passed through as it is read and an invalid value is
+        generated for each missing bin, so the whole series is never held
+        in memory."""
+        begin, end, freq = int(begin), int(end), int(freq)
+        start_bin,end_bin,expected_bins = Fill.get_bin_alignment(begin, end, freq)
+
+        s = start_bin
+        for dp in data:
+            while s < dp['ts'] and s <= end_bin:
+                yield dict(ts=s, val=None)
+                s += freq
+            if s == dp['ts']:
+                s += freq
+            yield dp
+
+        while s <= end_bin:
+            yield dict(ts=s, val=None)
+            s += freq
+
 
 def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
     """Fit successive counter measurements into evenly spaced bins.
@@ -330,3 +443,91 @@ def fit_to_bins(freq, ts_prev, val_prev, ts_curr, val_curr):
 
     return updates
 
+
+def _round_half_away(x):
+    """Round a float64 array the way Python 2's round() does - halves go
+    away from zero - and return it as int64.  numpy.round() rounds halves
+    to even so it can't be used."""
+    a = numpy.abs(x)
+    r = numpy.floor(a)
+    r += (a - r) >= 0.5
+    return numpy.copysign(r, x).astype(numpy.int64)
+
+def fit_to_bins_batch(freq, ts_prev, val_prev, ts_curr, val_curr):
+    """Batch version of fit_to_bins for many counters at once.
+
+    The arguments after freq are sequences (or numpy arrays) with one entry
+    per counter.  The return value is three int64 arrays (index, bins, vals)
+    with one entry per bin update: the position of the counter in the
+    input, the bin and the amount to increment the bin by.  The updates for
+    each counter are exactly what fit_to_bins returns for it, including how
+    the remainder is spread over the bins.  Requires numpy.
+
+    >>> index, bins, vals = fit_to_bins_batch(30, [0, 31, 89], [0, 100, 100],
+    ...     [30, 62, 181], [100, 213, 200])
+    >>> zip(index.tolist(), bins.tolist(), vals.tolist())
+    [(0, 0, 100), (0, 30, 0), (1, 30, 106), (1, 60, 7), (2, 60, 0), (2, 180, 1), (2, 90, 33), (2, 120, 33), (2, 150, 33)]
+    """
+    ts_prev = numpy.asarray(ts_prev, dtype=numpy.int64)
+    ts_curr = numpy.asarray(ts_curr, dtype=numpy.int64)
+    # Counters can be unsigned 64 bit values so only the deltas are
+    # expected to fit in an int64.
+    delta_v = (numpy.asarray(val_curr, dtype=object) -
+        numpy.asarray(val_prev, dtype=object)).astype(numpy.int64)
+
+    assert (ts_curr > ts_prev).all()
+
+    bin_prev = ts_prev - (ts_prev % freq)
+    bin_mid = (ts_prev + freq) - (ts_prev % freq)
+    bin_curr = ts_curr - (ts_curr % freq)
+
+    delta_t = (ts_curr - ts_prev).astype(numpy.float64)
+    dv = delta_v.astype(numpy.float64)
+
+    # Samples in the same bin put all of the data in that bin.
+    same = bin_curr == bin_prev
+    n_mid = numpy.where(same, 0, (bin_curr - bin_mid) // freq)
+    n_bins = numpy.where(same, 1, n_mid + 2)
+
+    frac_prev = (bin_mid - ts_prev) / delta_t
+    frac_curr = (ts_curr - bin_curr) / delta_t
+    p = _round_half_away(frac_prev * dv)
+    c = _round_half_away(frac_curr * dv)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        frac_mid = (bin_curr - bin_mid) / delta_t
+        m = frac_mid * dv
+        m_per_midbin = numpy.where(n_mid > 0, _round_half_away(m / n_mid), 0)
+        frac_per_midbin = frac_mid / n_mid
+
+    remainder = numpy.where(same, 0, delta_v - (p + c + m_per_midbin * n_mid))
+
+    # Flatten out to one entry per bin update.  For each counter the bins
+    # are in the same order fit_to_bins builds its list of fractions:
+    # bin_prev, bin_curr and then the middle bins.
+    index = numpy.repeat(numpy.arange(len(n_bins)), n_bins)
+    starts = numpy.cumsum(n_bins) - n_bins
+    pos = numpy.arange(len(index)) - starts[index]
+
+    first = pos == 0
+    second = pos == 1
+    bins = numpy.where(first, bin_prev[index],
+        numpy.where(second, bin_curr[index], bin_mid[index] + (pos - 2) * freq))
+    vals = numpy.where(first, numpy.where(same, delta_v, p)[index],
+        numpy.where(second, c[index], m_per_midbin[index]))
+    fracs = numpy.where(first, frac_prev[index],
+        numpy.where(second, frac_curr[index], frac_per_midbin[index]))
+
+    # Spread the remainder one unit at a time over the bins of each
+    # counter, largest fraction first if it is positive and smallest first
+    # if it is negative.  Ties keep their original order, as the stable
+    # sort in fit_to_bins does.
+    r = remainder[index]
+    order = numpy.lexsort((pos, numpy.where(r > 0, -fracs, fracs), index))
+    rank = numpy.empty_like(pos)
+    rank[order] = numpy.arange(len(order)) - starts[index[order]]
+
+    a = numpy.abs(r)
+    vals += numpy.sign(r) * (a // n_bins[index] + (rank < a % n_bins[index]))
+
+    return index, bins, vals
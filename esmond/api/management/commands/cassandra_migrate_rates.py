@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from esmond.cassandra import CASSANDRA_DB
+from esmond.config import get_config, get_config_path
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Copy the base rate and rate aggregation counters to the ' \
+        'absolute column families (cassandra_rate_storage = absolute).'
+
+    def handle(self, *args, **options):
+        config = get_config(get_config_path())
+        if config.cassandra_rate_storage != 'absolute':
+            raise CommandError('set cassandra_rate_storage = absolute in %s '
+                'before migrating' % config.file)
+
+        db = CASSANDRA_DB(config)
+        try:
+            copied = db.migrate_rate_counters()
+        finally:
+            db.close()
+
+        for cf in (db.rate_cf, db.agg_cf):
+            rows, cols = copied[cf]
+            print 'Copied %d rows/%d bins from %s' % (rows, cols, cf)
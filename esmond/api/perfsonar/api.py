@@ -944,7 +944,14 @@ class PSTimeSeriesResource(Resource):
         bundle.obj = self._obj_create(bundle.data, **kwargs)
         #save to db
         db.flush()
+        self._expire_query_cache(bundle.obj.written_bins)
         return bundle
+    
+    def _expire_query_cache(self, written_bins):
+        #drop cached query blocks holding bins that were just written
+        for cf, b in written_bins:
+            if b.freq:
+                db.expire_query_cache(cf, b.get_key(), b.freq, b.ts_to_jstime())
         
     def _obj_create(self, request_data, **kwargs):
         if request_data is None:
@@ -985,6 +992,7 @@ class PSTimeSeriesResource(Resource):
         
         #Insert into cassandra
         local_cache = {}
+        obj.written_bins = []
         #NOTE: Ordering in model allows statistics to go last. If this ever changes may need to update code here.
         #check that this event_type is defined
         rawsql_cursor = connection.cursor()
@@ -997,7 +1005,9 @@ class PSTimeSeriesResource(Resource):
                                             summary_type=et[0],
                                             summary_window=et[1]
                                             )
-            self.database_write(ts_obj, local_cache)
+            written = self.database_write(ts_obj, local_cache)
+            if written is not None:
+                obj.written_bins.append(written)
         #make sqlite happy (mainly for unit tests not configured to use postgres)
         if connection.vendor.startswith('sqlite'):
             rawsql_cursor.execute("UPDATE ps_event_types SET time_updated='now' WHERE event_type=%s AND metadata_id=(SELECT id FROM ps_metadata WHERE metadata_key=%s)", [obj.event_type, obj.metadata_key])
@@ -1009,6 +1019,8 @@ class PSTimeSeriesResource(Resource):
         return obj
     
     def database_write(self, ts_obj, local_cache):
+        """Write ts_obj and return (cf, bin) if it went to a base rate or
+        rate aggregation bin, otherwise None."""
         data_type = EVENT_TYPE_CONFIG[ts_obj.event_type]["type"]
         validator = TYPE_VALIDATOR_MAP[data_type]
         
@@ -1036,18 +1048,23 @@ class PSTimeSeriesResource(Resource):
         #insert the data in the target column-family
         log.debug("action=create_timeseries.start md_key=%s event_type=%s summ_type=%s summ_win=%s ts=%s val=%s cf=%s datapath=%s freq=%s base_freq=%s" %
                   (ts_obj.metadata_key, ts_obj.event_type, ts_obj.summary_type, ts_obj.summary_window, str(ts_obj.get_datetime()), str(ts_obj.value), col_family, ts_obj.datapath, ts_obj.freq, ts_obj.base_freq ))
+        written = None
         if col_family == db.rate_cf:
             ratebin = BaseRateBin(path=ts_obj.datapath, ts=ts_obj.get_datetime(), val=ts_obj.value, freq=ts_obj.freq)
             db.update_rate_bin(ratebin)
+            written = (db.rates, ratebin)
         elif col_family == db.agg_cf:
             agg = AggregationBin(path=ts_obj.datapath,
                     ts=ts_obj.get_datetime(), val=ts_obj.value["numerator"],
                     freq=ts_obj.freq, base_freq=ts_obj.base_freq, count=ts_obj.value["denominator"])
             db.aggs.insert(agg.get_key(), {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): agg.count}})
+            written = (db.aggs, agg)
         elif col_family == db.raw_cf:
             rawdata = RawRateData(path=ts_obj.datapath, ts=ts_obj.get_datetime(), val=ts_obj.value, freq=ts_obj.freq)
             db.set_raw_data(rawdata)
         log.debug("action=create_timeseries.end status=0")
+        
+        return written
                   
 class PSBulkTimeSeriesResource(PSTimeSeriesResource):
     class Meta(CustomModelResource.Meta):
@@ -1067,6 +1084,7 @@ class PSBulkTimeSeriesResource(PSTimeSeriesResource):
         #authorize
         self.authorized_create_detail(bundle.data["data"], bundle)
         
+        written_bins = []
         i = 0
         for ts_item in bundle.data["data"]:
             i += 1
@@ -1087,9 +1105,11 @@ class PSBulkTimeSeriesResource(PSTimeSeriesResource):
                 tmp_obj = { DATA_KEY_TIME: ts, DATA_KEY_VALUE: val_item[DATA_KEY_VALUE] }
                 #assign last item to bundle.obj to avoid null error
                 bundle.obj = self._obj_create(tmp_obj, metadata_key=kwargs['metadata_key'], event_type=val_item['event-type'], summary_type='base')
+                written_bins.extend(bundle.obj.written_bins)
                 
         #everything succeeded so save to database
         db.flush()
+        self._expire_query_cache(written_bins)
         
         return bundle    
         
@@ -337,6 +337,15 @@ class MockCASSANDRA_DB(object):
         else:
             pass
 
+    def iter_baserate_timerange(self, path=None, freq=None, ts_min=None, ts_max=None):
+        return iter(self.query_baserate_timerange(path, freq, ts_min, ts_max))
+
+    def iter_raw_data(self, path=None, freq=None, ts_min=None, ts_max=None):
+        return iter(self.query_raw_data(path, freq, ts_min, ts_max))
+
+    def iter_aggregation_timerange(self, path=None, freq=None, ts_min=None, ts_max=None, cf=None):
+        return iter(self.query_aggregation_timerange(path, freq, ts_min, ts_max, cf))
+
     def _test_incoming_args(self, path, freq, ts_min, ts_max, cf=None):
         assert isinstance(path, list)
         assert isinstance(freq, int)
@@ -488,6 +497,45 @@ class DeviceAPIDataTests(DeviceAPITestsBase):
         data = json.loads(response.content)
         self.assertTrue(len(data['data']) > 0)
 
+    def test_streamed_data_detail(self):
+        end = int(time.time())
+        begin = end - 3600
+
+        for url, params in (
+                ('/v1/device/rtr_a/interface/xe-0@2F0@2F0/in',
+                    dict(begin=begin, end=end)),
+                ('/v1/device/rtr_a/interface/xe-0@2F0@2F0/in',
+                    dict(begin=begin - 3600*3, end=end, agg='3600', cf='max')),
+                ('/v1/timeseries/BaseRate/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/30000',
+                    dict(begin=begin*1000, end=end*1000)),
+                ('/v1/timeseries/RawData/snmp/rtr_a/FastPollHC/ifHCInOctets/fxp0.0/30000',
+                    dict(begin=begin*1000, end=end*1000))):
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 200)
+            data = json.loads(response.content)
+
+            params['stream'] = 'true'
+            response = self.client.get(url, params)
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            streamed = json.loads(''.join(response.streaming_content))
+
+            # filled bins are the same, the streamed version keeps m_ts
+            # on the real data points
+            for d in data, streamed:
+                for row in d['data']:
+                    row.pop('m_ts', None)
+            self.assertEquals(streamed, data)
+
+        # errors are the same as well
+        for url in ('/v1/device/rtr_a/interface/xe-1@2F0@2F0/in',
+                '/v1/device/rtr_z/interface/xe-0@2F0@2F0/in',
+                '/v1/device/rtr_a/interface/xe-0@2F0@2F0/nope'):
+            response = self.client.get(url)
+            streamed = self.client.get(url, {'stream': 'true'})
+            self.assertEquals(streamed.status_code, response.status_code)
+            self.assertNotEquals(response.status_code, 200)
+
     def test_bad_aggregations(self):
         url = '/v1/device/rtr_a/interface/xe-0@2F0@2F0/in'
 
@@ -1041,3 +1089,56 @@ class QueryUtilTests(TestCase):
         data_out_nocoerce = [{ 'ts': 1391216201, 'val': 1100}, { 'ts': 1391216262, 'val': 1100}, { 'ts': 1391216323, 'val': 1100}]
         data_check = QueryUtil.format_data_payload(data_in)
         self.assertEquals(data_check, data_out_nocoerce)
+
+class BulkQueryTests(TestCase):
+    def test_run_bulk_queries(self):
+        from esmond.api.api import run_bulk_queries
+        from tastypie.exceptions import BadRequest
+
+        # later queries finish first but results come back in order
+        queries = [lambda i=i: time.sleep((10 - i) * 0.01) or i for i in range(10)]
+        self.assertEquals(run_bulk_queries(queries, concurrency=4), range(10))
+        self.assertEquals(run_bulk_queries(queries, concurrency=1), range(10))
+        self.assertEquals(run_bulk_queries([]), [])
+
+        def bad():
+            raise BadRequest('bad query')
+
+        self.assertRaises(BadRequest, run_bulk_queries, queries + [bad],
+            concurrency=4)
+
+class FillTests(TestCase):
+    def _series(self):
+        # 30 second bins with a few gaps and a None value
+        data = [{'ts': ts, 'val': ts / 30} for ts in range(0, 3600, 30)
+            if ts % 210 != 0]
+        data[3]['val'] = None
+        return data
+
+    def test_fill(self):
+        from esmond.api.dataseries import Fill
+
+        data = self._series()
+        expected = list(Fill.filled_series_dict(0, 3570, 30, data))
+        self.assertEquals(len(expected), 120)
+        self.assertEquals(Fill.verify_fill(0, 3570, 30, data), expected)
+        self.assertEquals(list(Fill.iter_fill(0, 3570, 30, iter(data))), expected)
+
+    def test_fill_numpy(self):
+        from esmond.api import dataseries
+        from esmond.api.dataseries import Fill, QueryUtil
+        if dataseries.numpy is None:
+            return
+
+        data = self._series()
+        expected = list(Fill.filled_series_dict(0, 3570, 30, data))
+        self.assertEquals(Fill.filled_series_numpy(0, 3570, 30, data), expected)
+        self.assertRaises(KeyError, Fill.filled_series_numpy, 0, 3570, 30,
+            data + [{'ts': 3601, 'val': 1}])
+
+        rows = [{'ts': d['ts'] * 1000, 'val': d['val'], 'is_valid': 1}
+            for d in data]
+        ts, vals = QueryUtil.format_data_arrays(rows)
+        bins, filled = Fill.fill_arrays(0, 3570, 30, ts, vals)
+        self.assertEquals(bins.tolist(), [d['ts'] for d in expected])
+        self.assertEquals(filled.tolist(None), [d['val'] for d in expected])
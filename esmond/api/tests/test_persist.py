@@ -11,8 +11,12 @@ import json
 import datetime
 import calendar
 import shutil
+import random
+import tempfile
 import time
 
+import cPickle as pickle
+
 # This MUST be here in any testing modules that use cassandra!
 os.environ['ESMOND_UNIT_TESTS'] = 'True'
 
@@ -23,13 +27,23 @@ from django.conf import settings
 
 from tastypie.test import ResourceTestCase
 
-from esmond.api.models import Device, IfRef, ALUSAPRef, OIDSet, DeviceOIDSetMap
+from esmond.api.models import Device, IfRef, ALUSAPRef, LSPOpStatus, OIDSet, \
+     DeviceOIDSetMap
 
-from esmond.persist import IfRefPollPersister, ALUSAPRefPersister, \
-     PersistQueueEmpty, CassandraPollPersister
-from esmond.api.dataseries import fit_to_bins
+from esmond.persist import IfRefPollPersister, ALUSAPRefPersister, LSPOpStatusPersister, \
+     PersistQueue, PersistQueueEmpty, PollPersister, CassandraPollPersister, \
+     PollResult, SegmentPersistQueue
+from esmond.api import dataseries
+from esmond.api.dataseries import fit_to_bins, fit_to_bins_batch
 from esmond.config import get_config, get_config_path
-from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD
+from esmond.cassandra import CASSANDRA_DB, SEEK_BACK_THRESHOLD, MutationBatch, \
+     LRUCache, RawRateData, BaseRateBin, AggregationBin, Metadata, get_rowkey, \
+     build_rowkey, RowKeyCache
+from esmond.oidsets import OIDSetCache
+from esmond.querycache import BlockCache
+from esmond.segmentlog import SegmentLog, RECORD_HEADER
+from esmond.serialization import BinaryResultSerializer, JSONResultSerializer, \
+     MAGIC, loads
 from esmond.util import max_datetime
 
 from pycassa.columnfamily import ColumnFamily
@@ -129,9 +143,17 @@ class TestPersistQueue(object):
         except IndexError:
             raise PersistQueueEmpty()
 
+    def get_many(self, n, timeout=0):
+        if not self.data:
+            raise PersistQueueEmpty()
+        items = [TestPollResult(x) for x in self.data[:n]]
+        del self.data[:n]
+        return items
+
 class MockConfig(object):
     def __init__(self):
         self.profile_persister = False
+        self.debug = False
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -177,6 +199,28 @@ class TestIfRefPersister(TestCase):
 
         self.assertTrue(ifrefs[1].end_time < max_datetime)
 
+    def test_persister_unchanged(self):
+        data = json.loads(ifref_test_data)
+        q = TestPersistQueue(data[:1])
+        p = IfRefPollPersister(MockConfig(), "test", persistq=q)
+        p.run()
+
+        # a poll where nothing changed doesn't touch the database
+        self.assertNumQueries(0, p.store, TestPollResult(data[0]))
+
+        # until the fingerprints are too old to trust
+        p.fingerprints["rtr_d"] = (0, p.fingerprints["rtr_d"][1])
+        p.store(TestPollResult(data[0]))
+        self.assertNotEqual(p.fingerprints["rtr_d"][0], 0)
+
+        ifrefs = IfRef.objects.filter(device__name="rtr_d", ifName="Vlan1")
+        self.assertEqual(len(ifrefs), 1)
+        self.assertEqual(ifrefs[0].end_time, max_datetime)
+
+        p.store(TestPollResult(data[1]))
+        ifrefs = IfRef.objects.filter(device__name="rtr_d", ifName="Vlan1")
+        self.assertEqual(len(ifrefs), 2)
+
 
 alu_sap_test_data = """
 [
@@ -265,6 +309,65 @@ class TestALUSAPRefPersister(TestCase):
 
         self.assertTrue(ifrefs[1].end_time < max_datetime)
 
+lsp_test_data = """
+[
+    {
+        "oidset_name": "LSPOpStatus",
+        "device_name": "rtr_d",
+        "timestamp": 1345125600,
+        "oid_name": "",
+        "data": {
+            "mplsLspInfoState": [
+                [ "mplsLspInfoState.'lsp-one'", 2 ]
+            ],
+            "mplsLspInfoFrom": [
+                [ "mplsLspInfoFrom.'lsp-one'", "10.0.0.1" ]
+            ],
+            "mplsLspInfoTo": [
+                [ "mplsLspInfoTo.'lsp-one'", "10.0.0.2" ]
+            ]
+        },
+        "metadata": {}
+    },
+    {
+        "oidset_name": "LSPOpStatus",
+        "device_name": "rtr_d",
+        "timestamp": 1345125660,
+        "oid_name": "",
+        "data": {
+            "mplsLspInfoState": [
+                [ "mplsLspInfoState.'lsp-one'", 3 ]
+            ],
+            "mplsLspInfoFrom": [
+                [ "mplsLspInfoFrom.'lsp-one'", "10.0.0.1" ]
+            ],
+            "mplsLspInfoTo": [
+                [ "mplsLspInfoTo.'lsp-one'", "10.0.0.2" ]
+            ]
+        },
+        "metadata": {}
+    }
+]
+"""
+class TestLSPOpStatusPersister(TestCase):
+    def setUp(self):
+        self.td = build_rtr_d_metadata()
+
+    def test_persister(self):
+        q = TestPersistQueue(json.loads(lsp_test_data))
+        p = LSPOpStatusPersister(MockConfig(), "test", persistq=q)
+        p.run()
+
+        lsps = LSPOpStatus.objects.filter(device__name="rtr_d", name="lsp-one")
+        lsps = lsps.order_by("end_time").all()
+        self.assertEqual(len(lsps), 2)
+
+        self.assertTrue(lsps[0].end_time < max_datetime)
+        self.assertTrue(lsps[1].end_time == max_datetime)
+        self.assertEqual([l.state for l in lsps], [2, 3])
+        self.assertEqual(lsps[1].srcAddr, "10.0.0.1")
+        self.assertEqual(lsps[1].dstAddr, "10.0.0.2")
+
 timeseries_test_data = """
 [
     {
@@ -556,6 +659,282 @@ class TestCassandraPollPersister(TestCase):
 
             #print k,v
 
+    def test_persister_batch_writes(self):
+        """Make sure batched and var by var writes store the same data."""
+        config = get_config(get_config_path())
+
+        key = '%s:%s:%s:%s:%s:%s:%s'  % (
+                SNMP_NAMESPACE,
+                'rtr_d',
+                'FastPollHC',
+                'ifHCOutOctets',
+                'GigabitEthernet0/1',
+                30*1000,
+                2013
+        )
+
+        results = []
+
+        for batch_writes in (False, True):
+            config.db_clear_on_testing = True
+            q = TestPersistQueue(json.loads(backwards_counters_test_data))
+            p = CassandraPollPersister(config, "test", persistq=q)
+            p.batch_writes = batch_writes
+            p.run()
+            p.db.flush()
+            p.db.close()
+            config.db_clear_on_testing = False
+
+            db = CASSANDRA_DB(config)
+            results.append((
+                ColumnFamily(db.pool, db.raw_cf).get(key),
+                ColumnFamily(db.pool, db.rate_cf).get(key),
+            ))
+            db.close()
+
+        self.assertEqual(results[0], results[1])
+
+    def test_persister_counter_accumulator(self):
+        """Make sure the write-behind counter accumulator stores the same
+        base rates and rate aggregations as sending them right away."""
+        config = get_config(get_config_path())
+
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCOutOctets',
+                'GigabitEthernet0/1']
+        rate_key = get_rowkey(path, 30*1000, 2013)
+        agg_key = get_rowkey(path, 3600*1000, 2013)
+
+        results = []
+
+        for interval in (0, 3600):
+            config.db_clear_on_testing = True
+            config.counter_flush_interval = interval
+            q = TestPersistQueue(json.loads(backwards_counters_test_data))
+            p = CassandraPollPersister(config, "test", persistq=q)
+            p.run()
+            if interval:
+                # nothing has been sent until the flush
+                self.assertNotEqual(len(p.db._counters), 0)
+            p.db.flush()
+            self.assertEqual(len(p.db._counters), 0)
+            p.db.close()
+            config.db_clear_on_testing = False
+            config.counter_flush_interval = 0
+
+            db = CASSANDRA_DB(config)
+            results.append((
+                ColumnFamily(db.pool, db.rate_cf).get(rate_key),
+                ColumnFamily(db.pool, db.agg_cf).get(agg_key),
+            ))
+            db.close()
+
+        self.assertEqual(results[0], results[1])
+
+    def test_persister_absolute_rates(self):
+        """Make sure absolute rate storage stores the same base rates and
+        rate aggregations as the counters, and that migrating the
+        counters copies them."""
+        config = get_config(get_config_path())
+
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCOutOctets',
+                'GigabitEthernet0/1']
+        rate_key = get_rowkey(path, 30*1000, 2013)
+        agg_key = get_rowkey(path, 3600*1000, 2013)
+
+        results = []
+
+        for storage, interval in (('counter', 0), ('absolute', 0),
+                ('absolute', 3600)):
+            config.db_clear_on_testing = True
+            config.cassandra_rate_storage = storage
+            config.counter_flush_interval = interval
+            q = TestPersistQueue(json.loads(backwards_counters_test_data))
+            p = CassandraPollPersister(config, "test", persistq=q)
+            p.run()
+            p.db.flush()
+            p.db.close()
+            config.db_clear_on_testing = False
+            config.counter_flush_interval = 0
+
+            db = CASSANDRA_DB(config)
+            results.append((
+                ColumnFamily(db.pool, db.rates._column_family.column_family).get(rate_key),
+                ColumnFamily(db.pool, db.aggs._column_family.column_family).get(agg_key),
+            ))
+            if storage == 'counter':
+                config.cassandra_rate_storage = 'absolute'
+                db.close()
+                db = CASSANDRA_DB(config)
+                copied = db.migrate_rate_counters()
+                self.assertTrue(copied[db.rate_cf][0] > 0)
+                results.append((
+                    ColumnFamily(db.pool, db.rate_absolute_cf).get(rate_key),
+                    ColumnFamily(db.pool, db.agg_absolute_cf).get(agg_key),
+                ))
+            db.close()
+
+        config.cassandra_rate_storage = 'counter'
+
+        for r in results[1:]:
+            self.assertEqual(results[0], r)
+
+    def test_persister_absolute_rates_multi_bin(self):
+        """Make sure absolute rate storage keeps the totals of polls that
+        span three or more bins while the writes are held back."""
+        config = get_config(get_config_path())
+
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCOutOctets',
+                'GigabitEthernet0/1']
+        rate_key = get_rowkey(path, 30*1000, 2013)
+
+        # 61 to 89 seconds apart, so each poll spans three or four bins
+        data = []
+        ts, val = 1384371885, 3983656138
+        for i in range(40):
+            data.append({
+                "oidset_name": "FastPollHC",
+                "device_name": "rtr_d",
+                "timestamp": ts,
+                "oid_name": "ifHCOutOctets",
+                "data": [[["ifHCOutOctets", "GigabitEthernet0/1"], val]]
+            })
+            ts += 61 + (i * 7) % 29
+            val += 1000000 + i * 1000
+
+        results = []
+
+        for storage, interval in (('counter', 0), ('absolute', 3600)):
+            config.db_clear_on_testing = True
+            config.cassandra_rate_storage = storage
+            config.counter_flush_interval = interval
+            q = TestPersistQueue(list(data))
+            p = CassandraPollPersister(config, "test", persistq=q)
+            p.run()
+            p.db.flush()
+            p.db.close()
+            config.db_clear_on_testing = False
+            config.counter_flush_interval = 0
+
+            db = CASSANDRA_DB(config)
+            results.append(ColumnFamily(db.pool,
+                db.rates._column_family.column_family).get(rate_key,
+                column_count=1000))
+            db.close()
+
+        config.cassandra_rate_storage = 'counter'
+
+        self.assertEqual(results[0], results[1])
+
+    def test_persister_spill(self):
+        """Make sure writes that fail are spilled and replayed to store
+        the same data as writing them right away."""
+        config = get_config(get_config_path())
+
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCOutOctets',
+                'GigabitEthernet0/1']
+        raw_key = get_rowkey(path, 30*1000, 2013)
+        agg_key = get_rowkey(path, 3600*1000, 2013)
+
+        results = []
+        d = tempfile.mkdtemp()
+
+        try:
+            for spill_dir, batch_writes in ((None, True), (d, True),
+                    (d, False)):
+                config.db_clear_on_testing = True
+                config.spill_dir = spill_dir
+                q = TestPersistQueue(json.loads(backwards_counters_test_data))
+                p = CassandraPollPersister(config, "test", persistq=q)
+                p.batch_writes = batch_writes
+                if spill_dir:
+                    # cassandra is down
+                    p.db._send_rows = lambda *args, **kw: False
+                p.run()
+                p.db.flush()
+
+                if spill_dir:
+                    self.assertGreater(p.db.spill_pending(), 0)
+                    self.assertEqual(p.db.replay_spill(), 0)
+                    config.spill_max_pending = 0
+                    self.assertFalse(p.backpressure())
+                    config.spill_max_pending = 1
+                    self.assertTrue(p.backpressure())
+
+                    # a corrupt record is skipped and doesn't leave the
+                    # journal looking like it still has work pending
+                    p.db.spill.append(['garbage'])
+                    seg = sorted([f for f in os.listdir(p.db.spill.path)
+                        if f.endswith('.seg')])[-1]
+                    f = open(os.path.join(p.db.spill.path, seg), 'r+b')
+                    f.seek(-1, os.SEEK_END)
+                    f.write(chr(ord(f.read(1)) ^ 0xff))
+                    f.close()
+
+                    # and back up again
+                    del p.db._send_rows
+                    p.db._spill_retry_at = 0
+                    p.db.spill_replay_rate = 1000000
+                    for i in range(100):
+                        if not p.db.spill_pending():
+                            break
+                        p.db._last_replay -= 1
+                        p.idle()
+                    self.assertEqual(p.db.spill_pending(), 0)
+                    self.assertEqual(p.db.replayed_rows, p.db.spilled_rows)
+                    self.assertFalse(p.backpressure())
+                    config.spill_max_pending = 1000
+
+                p.db.close()
+                config.db_clear_on_testing = False
+                config.spill_dir = None
+
+                db = CASSANDRA_DB(config)
+                results.append((
+                    ColumnFamily(db.pool, db.raw_cf).get(raw_key),
+                    ColumnFamily(db.pool, db.rate_cf).get(raw_key),
+                    ColumnFamily(db.pool, db.agg_cf).get(agg_key),
+                    ColumnFamily(db.pool, db.stat_cf).get(agg_key),
+                ))
+                db.close()
+        finally:
+            shutil.rmtree(d)
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_persister_stat_checkpoint(self):
+        """Make sure checkpointing the stat aggregations stores the same
+        min/max as writing every change."""
+        config = get_config(get_config_path())
+
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCOutOctets',
+                'GigabitEthernet0/1']
+        agg_key = get_rowkey(path, 3600*1000, 2013)
+
+        results = []
+
+        for interval in (0, 3600):
+            config.db_clear_on_testing = True
+            config.stat_checkpoint_interval = interval
+            q = TestPersistQueue(json.loads(backwards_counters_test_data))
+            p = CassandraPollPersister(config, "test", persistq=q)
+            p.run()
+            p.db.flush()
+            if interval:
+                self.assertGreater(p.db.stats.deferred_stats, 0)
+                self.assertGreaterEqual(p.db.stats.stat_mutations_avoided, 0)
+            else:
+                self.assertEqual(p.db.stats.deferred_stats, 0)
+            p.db.close()
+            config.db_clear_on_testing = False
+            config.stat_checkpoint_interval = 0
+
+            db = CASSANDRA_DB(config)
+            results.append(ColumnFamily(db.pool, db.stat_cf).get(agg_key))
+            db.close()
+
+        self.assertEqual(results[0], results[1])
+
 
     def test_persister_long(self):
         """Make sure the tsdb and cassandra data match"""
@@ -746,6 +1125,7 @@ class TestCassandraPollPersister(TestCase):
         self.assertEqual(ret[0]['val'], self.ctr.raw_val_first)
         self.assertEqual(ret[len(ret)-1]['ts'], self.ctr.raw_ts_last*1000)
         self.assertEqual(ret[len(ret)-1]['val'], self.ctr.raw_val_last)
+        ret_raw = ret
 
         ret = db.query_aggregation_timerange(
             path=[SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','fxp0.0'],
@@ -797,6 +1177,18 @@ class TestCassandraPollPersister(TestCase):
         self.assertEqual(ret[0]['val'], self.ctr.agg_max)
         self.assertEqual(ret[0]['ts'], self.ctr.agg_ts*1000)
 
+        # results are the same when fetched over many small pages
+        path = [SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets','fxp0.0']
+        full = db.query_baserate_timerange(path=path, freq=30*1000,
+            ts_min=start_time, ts_max=end_time)
+        db._query_page_size = 7
+        paged = db.iter_baserate_timerange(path=path, freq=30*1000,
+            ts_min=start_time, ts_max=end_time)
+        self.assertEqual(list(paged), full)
+        self.assertEqual(db.query_raw_data(path=path, freq=30*1000,
+            ts_min=start_time, ts_max=end_time, column_count=5),
+            ret_raw[:5])
+
         db.close()
 
     def test_cassandra_agg_cache(self):
@@ -872,6 +1264,177 @@ class TestCassandraPollPersister(TestCase):
         p.db.flush()
         p.db.close()
 
+    def test_metadata_prefetch(self):
+        """Make sure prefetched metadata matches a get_metadata lookup."""
+        config = get_config(get_config_path())
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        config.db_clear_on_testing = True
+
+        q = TestPersistQueue(test_data)
+        p = CassandraPollPersister(config, "test", persistq=q)
+        p.run()
+        p.db.flush()
+        p.db.close()
+        config.db_clear_on_testing = False
+
+        ts = (self.ctr.raw_ts_last + 1) * 1000
+        raw_data_list = [
+            RawRateData(path=[SNMP_NAMESPACE,'rtr_d','FastPollHC','ifHCInOctets',
+                iface], ts=ts, val=self.ctr.raw_val_last + 1000, freq=30*1000)
+            for iface in ('fxp0.0', 'no_such_interface')
+        ]
+
+        db = CASSANDRA_DB(config)
+        db.prefetch_metadata(raw_data_list)
+        self.assertEqual(len(db.metadata_cache), 2)
+
+        db2 = CASSANDRA_DB(config)
+
+        for raw_data in raw_data_list:
+            self.assertEqual(db.get_metadata(raw_data).get_document(),
+                db2.get_metadata(raw_data).get_document())
+
+        meta = db.get_metadata(raw_data_list[0])
+        self.assertEqual(meta.ts_to_jstime('last_update'),
+            self.ctr.raw_ts_last * 1000)
+        self.assertEqual(meta.last_val, self.ctr.raw_val_last)
+
+        # Nothing stored for this one so it is seeded with the current value.
+        meta = db.get_metadata(raw_data_list[1])
+        self.assertEqual(meta.last_val, raw_data_list[1].val)
+
+        db.close()
+        db2.close()
+
+    def test_metadata_snapshot(self):
+        """Make sure the metadata snapshot is only written when the
+        persister is stopped and is only loaded once."""
+        config = get_config(get_config_path())
+        test_data = load_test_data("rtr_d_ifhcin_long.json")
+        d = tempfile.mkdtemp()
+        path = os.path.join(d, 'test.metadata_cache')
+
+        try:
+            config.db_clear_on_testing = True
+            config.metadata_snapshot_dir = d
+            q = TestPersistQueue(test_data)
+            p = CassandraPollPersister(config, "test", persistq=q)
+            p.run()
+            # nothing is written while running
+            self.assertFalse(os.path.exists(path))
+            p.stop(None, None)
+            p.db.close()
+            self.assertTrue(os.path.exists(path))
+            config.db_clear_on_testing = False
+
+            db = CASSANDRA_DB(config, qname="test")
+            self.assertEqual(len(db.metadata_cache), len(p.db.metadata_cache))
+            self.assertFalse(os.path.exists(path))
+            db.close()
+
+            # a crash leaves nothing to load
+            db = CASSANDRA_DB(config, qname="test")
+            self.assertEqual(len(db.metadata_cache), 0)
+            db.close()
+        finally:
+            config.metadata_snapshot_dir = None
+            shutil.rmtree(d)
+
+    def test_update_metadata(self):
+        """Make sure update_metadata() leaves the cache up to date whether
+        it is handed the cached Metadata, a different one or one that has
+        been evicted."""
+        config = get_config(get_config_path())
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCInOctets',
+                'fxp0.0']
+        ts = datetime.datetime(2013, 12, 7, 0, 0)
+        raw = RawRateData(path=path, ts=ts, val=100, freq=30000)
+        k = raw.get_meta_key()
+
+        try:
+            config.db_clear_on_testing = True
+            db = CASSANDRA_DB(config)
+            db.metadata_cache = LRUCache(1)
+
+            m = db.get_metadata(raw)
+            self.assertTrue(db.get_metadata(raw) is m)
+
+            # the object get_metadata() returned is the cached one
+            m.refresh_from_raw(RawRateData(path=path,
+                ts=ts + datetime.timedelta(seconds=30), val=200, freq=30000))
+            db.update_metadata(k, m)
+            self.assertTrue(db.metadata_cache[k] is m)
+            self.assertEqual(db.metadata_cache[k].last_val, 200)
+
+            # a different object is copied into the cached one
+            other = Metadata(path=path, last_val=300, freq=30000,
+                last_update=ts + datetime.timedelta(seconds=60), min_ts=ts)
+            db.update_metadata(k, other)
+            self.assertTrue(db.metadata_cache[k] is m)
+            self.assertEqual(m.last_val, 300)
+            self.assertEqual(m.last_update, other.last_update)
+
+            # evicted in the meantime, it is added back
+            db.metadata_cache['other'] = Metadata(path=path, last_update=ts,
+                last_val=0, min_ts=ts, freq=30000)
+            self.assertFalse(k in db.metadata_cache)
+            db.update_metadata(k, other)
+            self.assertTrue(db.metadata_cache[k] is other)
+            db.close()
+        finally:
+            config.db_clear_on_testing = False
+
+    def test_query_cache_expire(self):
+        """Make sure only base rate and aggregation blocks are cached and
+        that a block written to, by the API or the persister, is read
+        again."""
+        config = get_config(get_config_path())
+        d = tempfile.mkdtemp()
+
+        path = [SNMP_NAMESPACE, 'rtr_d', 'FastPollHC', 'ifHCInOctets',
+                'fxp0.0']
+        ts = 1386369600000
+
+        try:
+            config.db_clear_on_testing = True
+            config.query_cache_dir = d
+            db = CASSANDRA_DB(config)
+            db.query_cache_min_age = 0
+
+            rate_bin = BaseRateBin(path=path, ts=ts, val=300, freq=30000)
+            db.update_rate_bin(rate_bin)
+            db.set_raw_data(RawRateData(path=path, ts=ts, val=1, freq=30000))
+            db.flush()
+
+            for i in range(2):
+                self.assertEqual(db.query_baserate_timerange(path=path,
+                    freq=30000, ts_min=ts, ts_max=ts)[0]['val'], 10)
+                self.assertEqual(len(db.query_raw_data(path=path,
+                    freq=30000, ts_min=ts, ts_max=ts)), 1)
+            self.assertEqual(db.query_cache.hits, 1)
+
+            db.update_rate_bin(rate_bin)
+            db.flush()
+            db.expire_query_cache(db.rates, rate_bin.get_key(), 30000, ts)
+            self.assertEqual(db.query_baserate_timerange(path=path,
+                freq=30000, ts_min=ts, ts_max=ts)[0]['val'], 20)
+
+            # old bins written by the persister (a spill replay or a queue
+            # backlog) expire the blocks they are in when they are sent
+            self.assertEqual(db.query_baserate_timerange(path=path,
+                freq=30000, ts_min=ts, ts_max=ts)[0]['val'], 20)
+            hits = db.query_cache.hits
+            db.update_rate_bin(rate_bin)
+            db.flush()
+            self.assertEqual(db.query_baserate_timerange(path=path,
+                freq=30000, ts_min=ts, ts_max=ts)[0]['val'], 30)
+            self.assertEqual(db.query_cache.hits, hits)
+            db.close()
+        finally:
+            config.db_clear_on_testing = False
+            config.query_cache_dir = None
+            shutil.rmtree(d)
+
 
 class TestCassandraApiQueries(ResourceTestCase):
     fixtures = ['oidsets.json']
@@ -1463,6 +2026,491 @@ class TestFitToBins(TestCase):
         self.assertEqual({1386369690000: 249747233}, r)
         self.assertLess(time.time()-t0, 0.5)
 
+    def _check_batch(self, freq, ts_prev, val_prev, ts_curr, val_curr):
+        index, bins, vals = fit_to_bins_batch(freq, ts_prev, val_prev,
+                ts_curr, val_curr)
+
+        got = [{} for i in range(len(ts_prev))]
+        for i, b, v in zip(index.tolist(), bins.tolist(), vals.tolist()):
+            got[i][b] = v
+
+        for i, r in enumerate(got):
+            self.assertEqual(fit_to_bins(freq, ts_prev[i], val_prev[i],
+                ts_curr[i], val_curr[i]), r)
+
+    def test_fit_to_bins_batch(self):
+        if dataseries.numpy is None:
+            return
+
+        # the docstring tests and the real world one as a single batch
+        self._check_batch(30, [0, 31, 90, 89], [0, 100, 100, 100],
+                [30, 62, 121, 181], [100, 213, 200, 200])
+        self._check_batch(30000, [1386369693000], [141368641534364],
+                [1386369719000], [141368891281597])
+
+        # random counters, including 64 bit ones and gaps of many bins
+        rand = random.Random(42)
+        for freq in (30, 60, 30000):
+            ts_prev, val_prev, ts_curr, val_curr = [], [], [], []
+            for i in range(500):
+                t = rand.randint(0, 10**6)
+                v = rand.choice([rand.randint(0, 1000),
+                    rand.randint(0, 2**64 - 2**40)])
+                ts_prev.append(t)
+                val_prev.append(v)
+                ts_curr.append(t + rand.choice([1, rand.randint(1, freq*2),
+                    rand.randint(1, freq*20)]))
+                val_curr.append(v + rand.choice([0, rand.randint(0, 10),
+                    rand.randint(0, 2**32)]))
+            self._check_batch(freq, ts_prev, val_prev, ts_curr, val_curr)
+
+class TestOIDSetCache(TestCase):
+    fixtures = ['oidsets.json']
+
+    def test_oidset_cache(self):
+        c = OIDSetCache()
+        self.assertEqual(c.load(), OIDSet.objects.count())
+        self.assertEqual(c.version, 1)
+
+        info = c.get('FastPollHC')
+        self.assertEqual(info.frequency_ms, 30*1000)
+        self.assertEqual(info.aggregates, (3600, 86400))
+        self.assertEqual(info.poller_args['correlator'], 'IfDescrCorrelator')
+        self.assertEqual([o.name for o in info.oids],
+            [o.name for o in OIDSet.objects.get(name='FastPollHC').oids.all()])
+        self.assertTrue(c.get_oid('ifHCInOctets').aggregate)
+        self.assertRaises(TypeError, info.poller_args.__setitem__, 'ttl', '1')
+
+        # nothing changed so the descriptors are kept
+        self.assertEqual(c.load(), 0)
+        self.assertEqual(c.version, 1)
+        self.assertTrue(c.get('FastPollHC') is info)
+
+        oidset = OIDSet.objects.get(name='FastPollHC')
+        oidset.poller_args += ' ttl=3600'
+        oidset.save()
+        other = c.get('FastPoll')
+
+        self.assertEqual(c.load(), 1)
+        self.assertEqual(c.version, 2)
+        self.assertEqual(c.get('FastPollHC').ttl, 3600)
+        self.assertTrue(c.get('FastPoll') is other)
+
+        self.assertRaises(KeyError, c.get, 'NoSuchOIDSet')
+
+        # an unknown name doesn't reload the cache again until
+        # reload_interval has passed
+        version = c.version
+        oidset.poller_args += ' chunk=10'
+        oidset.save()
+        self.assertRaises(KeyError, c.get, 'NoSuchOIDSet')
+        self.assertEqual(c.version, version)
+        c.missed[('oidsets', 'NoSuchOIDSet')] -= c.reload_interval
+        self.assertRaises(KeyError, c.get, 'NoSuchOIDSet')
+        self.assertEqual(c.version, version + 1)
+
+class TestMutationBatch(TestCase):
+    def test_mutation_batch(self):
+        b = MutationBatch()
+
+        b.add_raw('k1', 1000, '10', ttl=60)
+        b.add_raw('k1', 2000, '20', ttl=60)
+        b.add_raw('k2', 1000, '30')
+        self.assertEqual(b.raw, {60: {'k1': {1000: '10', 2000: '20'}},
+            None: {'k2': {1000: '30'}}})
+
+        # counter increments to the same column are summed
+        b.incr_rate('k1', 1000, 5, 1)
+        b.incr_rate('k1', 1000, 7, 1)
+        b.incr_rate('k1', 2000, 1, 0)
+        self.assertEqual(b.rates, {'k1': {1000: {'val': 12, 'is_valid': 2},
+            2000: {'val': 1, 'is_valid': 0}}})
+
+        b.incr_agg('k3', 0, 10, 30000)
+        b.incr_agg('k3', 0, 20, 30000)
+        self.assertEqual(b.aggs, {'k3': {0: {'val': 30, '30000': 2}}})
+
+        # stat writes to the same column are merged
+        b.set_stat('k4', {0: {'min': 1, 'max': 1}})
+        b.set_stat('k4', {0: {'max': 5}})
+        self.assertEqual(b.stats, {'k4': {0: {'min': 1, 'max': 5}}})
+
+        self.assertEqual(len(b), 5)
+
+        # merging the counters of another batch sums them too
+        b2 = MutationBatch()
+        b2.incr_rate('k1', 1000, 1, 1)
+        b2.incr_agg('k5', 0, 3, 30000)
+        b.merge_counters(b2)
+        self.assertEqual(b.rates['k1'][1000], {'val': 13, 'is_valid': 3})
+        self.assertEqual(b.aggs['k5'], {0: {'val': 3, '30000': 1}})
+        self.assertEqual(b.merged, 3)
+
+    def test_mutation_batch_totals(self):
+        b = MutationBatch()
+
+        # absolute values replace each other
+        b.set_rate('k1', 1000, {'val': 5, 'is_valid': 1})
+        b.set_rate('k1', 1000, {'val': 12, 'is_valid': 2})
+        b.set_agg('k3', 0, {'val': 10, '30000': 1})
+        self.assertEqual(b.rates, {'k1': {1000: {'val': 12, 'is_valid': 2}}})
+
+        b2 = MutationBatch()
+        b2.set_agg('k3', 0, {'val': 30, '30000': 2})
+        b.merge_totals(b2)
+        self.assertEqual(b.aggs, {'k3': {0: {'val': 30, '30000': 2}}})
+        self.assertEqual(b.merged, 2)
+
+class TestLRUCache(TestCase):
+    def test_lru_cache(self):
+        c = LRUCache(3)
+        c['a'] = 1
+        c['b'] = 2
+        c['c'] = 3
+        # touch 'a' so 'b' is the least recently used
+        self.assertEqual(c['a'], 1)
+        c['d'] = 4
+
+        self.assertEqual(len(c), 3)
+        self.assertFalse(c.has_key('b'))
+        self.assertEqual(c.get('b'), None)
+        self.assertTrue('a' in c)
+        self.assertEqual(c.evictions, 1)
+
+    def test_lru_cache_snapshot(self):
+        d = tempfile.mkdtemp()
+        path = os.path.join(d, 'test.metadata_cache')
+        try:
+            c = LRUCache(3)
+            for k in ('a', 'b', 'c'):
+                c[k] = {'last_val': k}
+            c.save(path)
+
+            c2 = LRUCache(2)
+            self.assertEqual(c2.load(path), 2)
+            # the least recently used entry is dropped
+            self.assertFalse(c2.has_key('a'))
+            self.assertEqual(c2['c'], {'last_val': 'c'})
+
+            # stale snapshots are ignored
+            c3 = LRUCache(3)
+            self.assertEqual(c3.load(path, max_age=-1), 0)
+
+            self.assertEqual(LRUCache().load(os.path.join(d, 'missing')), 0)
+
+            # snapshots of the version 1 dict cache are ignored
+            f = open(path, 'wb')
+            pickle.dump((1, time.time(), [('a', {'last_val': 'a'})]), f,
+                pickle.HIGHEST_PROTOCOL)
+            f.close()
+            self.assertEqual(LRUCache(3).load(path), 0)
+        finally:
+            shutil.rmtree(d)
+
+class TestDataContainers(TestCase):
+    def test_get_document(self):
+        path = ['snmp', 'rtr_d', 'FastPollHC', 'ifHCInOctets', 'fxp0.0']
+        ts = datetime.datetime(2013, 12, 7, 0, 0)
+
+        self.assertEqual(RawRateData(path=path, ts=ts, val=10,
+            freq=30000).get_document(),
+            dict(path=path, ts=ts, val=10, freq=30000))
+        self.assertEqual(BaseRateBin(path=path, ts=ts, val=10,
+            freq=30000).get_document(),
+            dict(path=path, ts=ts, val=10, freq=30000, is_valid=1))
+        self.assertEqual(AggregationBin(path=path, ts=ts, val=10, freq=3600000,
+            base_freq=30000, count=2, min=1, max=9, cf='average').get_document(),
+            dict(path=path, ts=ts, val=10, freq=3600000, is_valid=1,
+                base_freq=30000, count=2, min=1, max=9, cf='average'))
+
+        m = Metadata(path=path, last_update=ts, last_val=10, min_ts=ts,
+            freq=30000)
+        self.assertEqual(m.get_document(), dict(path=path, last_update=ts,
+            last_val=10, min_ts=ts, freq=30000))
+        # the containers have no __dict__ to add stray attributes to
+        self.assertRaises(AttributeError, setattr, m, 'last_value', 10)
+
+class TestRowKeyCache(TestCase):
+    def test_rowkey_cache(self):
+        c = RowKeyCache(max_entries=4)
+        path = ['snmp', 'rtr_a', 'FastPollHC', 'ifHCInOctets', 'xe-0/0/0:1']
+        for args in [(path,), (path, 30000), (path, 30000, 2013),
+                (path, None, 2013), ([],), ([], 30000, 2013), ([''], 30000),
+                ([u'rtr_\xe9', 'a:b'], 30000, 2013)]:
+            self.assertEqual(c.get(*args), build_rowkey(*args))
+            # and again from the cache
+            self.assertEqual(c.get(*args), build_rowkey(*args))
+
+        self.assertEqual(c.get(path, 30000, 2013),
+            'snmp:rtr_a:FastPollHC:ifHCInOctets:xe-0/0/0\\:1:30000:2013')
+        self.assertEqual(get_rowkey(tuple(path), 30000, 2013),
+            build_rowkey(path, 30000, 2013))
+
+        # the cache is bounded
+        self.assertTrue(len(c.keys) <= 4)
+        self.assertTrue(len(c.prefixes) <= 4)
+        self.assertTrue(c.resets > 0)
+
+class TestBlockCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_block_cache(self):
+        c = BlockCache(os.path.join(self.path, 'qc'), 2000)
+        cols = [(1386369600000 + i * 30000, i) for i in range(10)]
+
+        self.assertEqual(c.get('rates:a:0'), None)
+        c.put('rates:a:0', cols)
+        self.assertEqual(c.get('rates:a:0'), cols)
+        self.assertEqual((c.hits, c.misses), (1, 1))
+
+        # shared with another instance on the same directory
+        c2 = BlockCache(c.path, 2000)
+        self.assertEqual(c2.get('rates:a:0'), cols)
+        self.assertTrue(c2.size > 0)
+
+        # a corrupt file is a miss
+        open(c._filename('rates:b:0'), 'w').write('junk')
+        self.assertEqual(c.get('rates:b:0'), None)
+        self.assertFalse(os.path.exists(c._filename('rates:b:0')))
+
+        # the least recently used blocks are evicted
+        for i in range(1, 20):
+            c.put('rates:a:%d' % i, cols)
+            os.utime(c._filename('rates:a:%d' % i), (i, i))
+            c.get('rates:a:0')
+        self.assertTrue(c.evictions > 0)
+        self.assertTrue(c.size <= 2000)
+        self.assertEqual(c.get('rates:a:0'), cols)
+        self.assertEqual(c.get('rates:a:1'), None)
+
+        c.delete('rates:a:0')
+        self.assertEqual(c.get('rates:a:0'), None)
+        c.delete('rates:a:0')
+
+        c.clear()
+        self.assertEqual(c.get('rates:a:2'), None)
+
+class ListPersistQueue(PersistQueue):
+    def __init__(self, data):
+        PersistQueue.__init__(self, 'test')
+        self.data = data
+
+    def get(self, block=False):
+        if self.data:
+            return self.data.pop(0)
+        return None
+
+    def put(self, val):
+        self.data.append(val)
+
+class TestPersistQueueBatches(TestCase):
+    def test_get_many(self):
+        q = ListPersistQueue(range(5))
+        self.assertEqual(q.get_many(3), [0, 1, 2])
+        self.assertEqual(q.get_many(3), [3, 4])
+
+        # waits for up to timeout seconds when empty
+        t0 = time.time()
+        self.assertEqual(q.get_many(3, timeout=0.2), [])
+        self.assertGreaterEqual(time.time() - t0, 0.2)
+
+        q.put_many([5, 6])
+        self.assertEqual(q.get_many(3), [5, 6])
+
+    def test_store_batch(self):
+        stored = []
+
+        class BatchPersister(PollPersister):
+            def store(self, result):
+                stored.append(result)
+
+        q = TestPersistQueue([{'n': i, 'data': []} for i in range(250)])
+        p = BatchPersister(MockConfig(), "test", persistq=q)
+        p.run()
+        self.assertEqual([r.n for r in stored], range(250))
+
+    def test_idle(self):
+        calls = []
+
+        class IdleQueue(object):
+            def __init__(self, passes):
+                self.passes = passes
+
+            def get_many(self, n, timeout=0):
+                if not self.passes:
+                    raise PersistQueueEmpty()
+                self.passes -= 1
+                return []
+
+        class IdlePersister(PollPersister):
+            def flush(self):
+                calls.append('flush')
+
+            def idle(self):
+                calls.append('idle')
+
+        p = IdlePersister(MockConfig(), "test", persistq=IdleQueue(3))
+        p.run()
+        # flush() only on the first empty pass, idle() on all of them
+        self.assertEqual(calls, ['flush', 'idle', 'idle', 'idle'])
+
+class TestSegmentLog(TestCase):
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+    def _segments(self):
+        return sorted([f for f in os.listdir(self.d) if f.endswith('.seg')])
+
+    def test_segment_log(self):
+        w = SegmentLog(self.d, segment_size=100, fsync='always')
+        w.append(['rec%02d' % i for i in range(10)])
+        w.append(['x' * 60])
+        # the first segment is full so a second one was started
+        self.assertEqual(len(self._segments()), 2)
+
+        r = SegmentLog(self.d, consumer='test')
+        self.assertEqual(r.pending(), 11)
+        self.assertEqual(r.read(5), ['rec%02d' % i for i in range(5)])
+        r.commit()
+        self.assertEqual(r.read(100), ['rec%02d' % i for i in range(5, 10)] + ['x' * 60])
+        self.assertEqual(r.pending(), 0)
+        r.commit()
+        # the fully read segment is removed
+        self.assertEqual(len(self._segments()), 1)
+
+        # a new reader picks up from the committed position
+        w.append(['after'])
+        r2 = SegmentLog(self.d, consumer='test')
+        self.assertEqual(r2.read(10), ['after'])
+        self.assertEqual(r2.counts(), (12, 12))
+
+        # records read since the last commit are read again after a rollback
+        r2.rollback()
+        self.assertEqual(r2.read(10), ['after'])
+
+    def test_segment_log_recovery(self):
+        w = SegmentLog(self.d)
+        w.append(['one'])
+
+        # simulate a writer dying part way through an append
+        f = open(os.path.join(self.d, self._segments()[-1]), 'ab')
+        f.write('\x00\x00\x00\x09garb')
+        f.close()
+
+        r = SegmentLog(self.d, consumer='test')
+        self.assertEqual(r.read(10), ['one'])
+
+        w2 = SegmentLog(self.d)
+        w2.append(['two', 'bad', 'three'])
+
+        # corrupt a record - it is skipped
+        path = os.path.join(self.d, self._segments()[-1])
+        data = open(path, 'rb').read()
+        i = data.rindex('bad')
+        f = open(path, 'wb')
+        f.write(data[:i] + 'BAD' + data[i+3:])
+        f.close()
+
+        self.assertEqual(r.read(10), ['two', 'three'])
+        self.assertEqual(r.pending(), 0)
+
+        # a bad length skips the rest of the segment, the reader still
+        # catches up with the writer
+        w2.append(['four', 'five'])
+        f = open(path, 'r+b')
+        f.seek(len(data))
+        f.write(RECORD_HEADER.pack(1 << 30, 0))
+        f.close()
+        self.assertEqual(r.read(10), [])
+        self.assertEqual(r.pending(), 0)
+        r.commit()
+        w2.append(['six'])
+        self.assertEqual(r.pending(), 1)
+        self.assertEqual(r.read(10), ['six'])
+
+    def test_segment_persist_queue(self):
+        q = SegmentPersistQueue('test', self.d)
+        results = [PollResult('FastPollHC', 'rtr_d', 'ifHCInOctets', 1343956814 + i,
+            [[['ifHCInOctets', 'xe-0/0/0'], i]], {}) for i in range(3)]
+        q.put(results[0])
+        q.put_many(results[1:])
+
+        c = SegmentPersistQueue('test', self.d, consumer='persister')
+        self.assertEqual(len(c), 3)
+        r = c.get()
+        self.assertEqual(r.timestamp, results[0].timestamp)
+        self.assertEqual(r.data, [[['ifHCInOctets', 'xe-0/0/0'], 0]])
+        self.assertEqual([x.timestamp for x in c.get_many(10)],
+            [x.timestamp for x in results[1:]])
+        self.assertEqual(c.get(), None)
+        self.assertEqual(len(c), 0)
+
+class TestSerialization(TestCase):
+    def _result(self, data):
+        return dict(oidset_name='FastPollHC', device_name='rtr_d',
+            oid_name='ifHCInOctets', timestamp=1343956814.123456, data=data,
+            metadata={'tsdb_flags': 1, 'extra': None, 'ok': True})
+
+    def test_binary_round_trip(self):
+        b = BinaryResultSerializer()
+        for data in (
+                [[['ifHCInOctets', 'xe-0/0/%d' % i], i * 2**40] for i in range(300)],
+                [[['ifHCInOctets', 'xe-0/0/0'], 2**64 - 1]], # needs uint64
+                [[['ifHCInOctets', 'xe-0/0/0'], 2**70]], # too big to pack
+                [[['ifHCInOctets', 'xe-0/0/0'], None]], # missing value
+                [[['sysUpTime', u'r\xe9seau', '1'], -5]],
+                [[u'ifAlias', 'xe-0/0/0'], [u'ifSpeed', 1.5]],
+                []):
+            d = self._result(data)
+            s = b.dumps(d)
+            self.assertEqual(s[0], MAGIC)
+            self.assertEqual(b.loads(s), json.loads(json.dumps(d)))
+
+        d = self._result([[['ifHCInOctets', 'xe-0/0/%d' % i], i * 2**40]
+            for i in range(300)])
+        self.assertTrue(len(b.dumps(d)) < len(json.dumps(d)) / 2)
+
+    def test_fallback_and_detection(self):
+        b = BinaryResultSerializer()
+        # things the binary format can't encode are written as JSON
+        d = self._result([[['ifHCInOctets', 'xe-0/0/0'], 1]])
+        d['metadata'] = {'when': datetime.date(2012, 1, 1)}
+        self.assertRaises(TypeError, b.dumps, d)
+        d['metadata'] = {}
+        d['data'] = set()
+        self.assertRaises(TypeError, b.dumps, d)
+        d = self._result([[['ifHCInOctets', 'xe-0/0/0\x00'], 1]])
+        self.assertEqual(b.dumps(d), json.dumps(d))
+
+        d = self._result([[['ifHCInOctets', 'xe-0/0/0'], 1]])
+        j = JSONResultSerializer().dumps(d)
+        self.assertEqual(loads(j), loads(b.dumps(d)))
+        self.assertEqual(b.loads(j), json.loads(j))
+
+    def test_queue_serializers(self):
+        d = tempfile.mkdtemp()
+        try:
+            result = PollResult(**self._result(
+                [[['ifHCInOctets', 'xe-0/0/0'], 1]]))
+            SegmentPersistQueue('test', d).put(result)
+            SegmentPersistQueue('test', d,
+                serializer=BinaryResultSerializer()).put(result)
+
+            c = SegmentPersistQueue('test', d, consumer='persister')
+            r = c.get_many(10)
+            self.assertEqual(len(r), 2)
+            for x in r:
+                self.assertEqual(x.as_dict(), json.loads(result.json()))
+        finally:
+            shutil.rmtree(d)
+
 class TestCassandraApiQueriesALU(ResourceTestCase):
     fixtures = ['oidsets.json']
 
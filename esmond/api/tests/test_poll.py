@@ -0,0 +1,349 @@
+import collections
+import itertools
+import json
+import threading
+import time
+import Queue
+
+from collections import namedtuple
+
+from django.test import TestCase
+
+from esmond.api.models import OIDSet
+from esmond.poll import Poller, PollScheduler, AsyncSNMPPoller, PollRequest, \
+    SubWalk, WalkStats, PollRound, PollerMetrics, CorrelatedPoller
+
+MockDevice = namedtuple('MockDevice', ['name'])
+
+class MockConfig(object):
+    def __init__(self, poll_align=False, poll_jitter=0.0,
+            poll_correlator_refresh=0):
+        self.poll_align = poll_align
+        self.poll_jitter = poll_jitter
+        self.poll_correlator_refresh = poll_correlator_refresh
+
+class MockSession(object):
+    def __init__(self, requests, reqids):
+        self.requests = requests
+        self.reqids = reqids
+
+    def async_getbulk(self, nonrepeaters, maxrepetitions, oids):
+        self.requests.append((maxrepetitions, oids))
+        return self.reqids.next()
+
+class MockSessions(dict):
+    def remove_session(self, host):
+        del self[host]
+
+class MockSNMPPoller(AsyncSNMPPoller):
+    """An AsyncSNMPPoller that records GETBULKs instead of sending them."""
+    def __init__(self, window, max_inflight, hosts):
+        self.maxrepetitions = 25
+        self.window = window
+        self.max_inflight = max_inflight
+        self.max_repetitions = 100
+        self.reqmap = {}
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self.inflight_total = 0
+        self.waiting = {}
+        self.ready = collections.deque()
+        self.repetitions = {}
+        self.walk_stats = {}
+        self.callbacks = []
+        self.requests = {}
+        self.sessions = MockSessions()
+        reqids = itertools.count(1)
+        for host in hosts:
+            self.requests[host] = []
+            self.sessions[host] = MockSession(self.requests[host], reqids)
+
+    def queue_walk(self, host, n_oids, callback, errback):
+        pollreq = PollRequest('bulkwalk', callback, errback)
+        pollreq.host = host
+        pollreq.poll_round = PollRound(0)
+        pollreq.walks = [SubWalk(pollreq, 'oid%d' % i, (1, 3, 6, i))
+                for i in range(n_oids)]
+        pollreq.remaining = n_oids
+        pollreq.begin_time = 0
+        self.waiting.setdefault(host, collections.deque()).extend(
+                pollreq.walks)
+        self.ready.append(host)
+        self._dispatch()
+        return pollreq
+
+class TestAsyncSNMPPoller(TestCase):
+    def test_window(self):
+        p = MockSNMPPoller(2, 3, ['rtr_a', 'rtr_b'])
+        results = []
+        errors = []
+        a = p.queue_walk('rtr_a', 5, results.append, errors.append)
+        b = p.queue_walk('rtr_b', 2, results.append, errors.append)
+
+        # rtr_a is limited by its window, rtr_b by the global cap
+        self.assertEqual(len(p.requests['rtr_a']), 2)
+        self.assertEqual(len(p.requests['rtr_b']), 1)
+        self.assertEqual(p.inflight_total, 3)
+        self.assertEqual(len(p.waiting['rtr_a']), 3)
+
+        # finishing one of rtr_a's walks lets rtr_b in first
+        a.walks[0].results.append(('oid0.1', 1))
+        p._walk_done('rtr_a', a.walks[0])
+        p._dispatch()
+        self.assertEqual(len(p.requests['rtr_b']), 2)
+        self.assertEqual(len(p.requests['rtr_a']), 2)
+
+        for w in b.walks:
+            p._walk_done('rtr_b', w)
+        p._dispatch()
+        self.assertEqual(len(p.requests['rtr_a']), 3)
+        self.assertTrue('rtr_b' not in p.inflight)
+
+        for w in a.walks[1:]:
+            w.results.append((w.oid + '.1', 1))
+            p._walk_done('rtr_a', w)
+            p._dispatch()
+
+        self.assertEqual(p.inflight_total, 0)
+        self.assertEqual(p.waiting, {})
+        p._run_callbacks()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 2)
+        # results come back in the order of the oids
+        self.assertEqual(results[1],
+                [('oid%d.1' % i, 1) for i in range(5)])
+        self.assertEqual(p.stats()['devices']['rtr_a'].walks, 1)
+        self.assertEqual(a.poll_round.pdus, 5)
+        self.assertEqual(b.poll_round.pdus, 2)
+
+    def test_timeout(self):
+        p = MockSNMPPoller(2, 10, ['rtr_a'])
+        results = []
+        errors = []
+        a = p.queue_walk('rtr_a', 4, results.append, errors.append)
+
+        p._errback(None, None, 'rtr_a', 1)
+        self.assertEqual(errors, ['timeout'])
+        self.assertEqual(p.repetitions['rtr_a'], 12)
+
+        # the rest of the walks are abandoned without another errback
+        p._walk_done('rtr_a', a.walks[1])
+        p._dispatch()
+        self.assertEqual(p.inflight_total, 0)
+        self.assertEqual(p.waiting, {})
+        p._run_callbacks()
+        self.assertEqual(errors, ['timeout'])
+        self.assertEqual(results, [])
+        self.assertEqual(p.stats()['devices']['rtr_a'].timeouts, 1)
+
+    def test_remove_session(self):
+        p = MockSNMPPoller(2, 3, ['rtr_a', 'rtr_b'])
+        results = []
+        errors = []
+        a = p.queue_walk('rtr_a', 3, results.append, errors.append)
+        b = p.queue_walk('rtr_b', 2, results.append, errors.append)
+        self.assertEqual(p.inflight_total, 3)
+        self.assertEqual(len(p.requests['rtr_b']), 1)
+
+        # rtr_a's walks in flight never call back after its session is
+        # destroyed, their slots go to rtr_b
+        p.remove_session('rtr_a')
+        self.assertEqual(errors, ['removed'])
+        self.assertTrue('rtr_a' not in p.inflight)
+        self.assertTrue('rtr_a' not in p.waiting)
+        self.assertEqual(p.inflight_total, 2)
+        self.assertEqual(len(p.requests['rtr_b']), 2)
+        self.assertEqual([w.pollreq.host for w in p.reqmap.values()],
+                ['rtr_b', 'rtr_b'])
+
+        # a late response to a removed session is dropped
+        p._callback(None, None, 'rtr_a', 1, [])
+        p._errback(None, None, 'rtr_a', 2)
+        self.assertEqual(errors, ['removed'])
+        self.assertEqual(p.inflight_total, 2)
+
+    def test_callback_repetitions(self):
+        p = MockSNMPPoller(2, 10, ['rtr_a'])
+        results = []
+        errors = []
+        a = p.queue_walk('rtr_a', 2, results.append, errors.append)
+        self.assertEqual([r[0] for r in p.requests['rtr_a']], [25, 25])
+
+        def response(walk, n):
+            return [(walk.walk_oid + (j,), j) for j in range(n)]
+
+        # a full response doubles max-repetitions for the next GETBULK
+        p._callback(None, None, 'rtr_a', 1, response(a.walks[0], 25))
+        self.assertEqual(p.repetitions['rtr_a'], 50)
+        self.assertEqual(p.requests['rtr_a'][-1][0], 50)
+
+        # the other walk's full response to its request for 25 doesn't
+        # count as truncated
+        p._callback(None, None, 'rtr_a', 2, response(a.walks[1], 25))
+        self.assertEqual(p.repetitions['rtr_a'], 50)
+        self.assertEqual(p.requests['rtr_a'][-1][0], 50)
+
+    def test_adapt_repetitions(self):
+        p = MockSNMPPoller(2, 10, ['rtr_a'])
+        p._adapt_repetitions('rtr_a', 25, 25, True)
+        self.assertEqual(p.repetitions['rtr_a'], 50)
+        p._adapt_repetitions('rtr_a', 80, 80, True)
+        self.assertEqual(p.repetitions['rtr_a'], 100)
+        p._adapt_repetitions('rtr_a', 100, 37, True)
+        self.assertEqual(p.repetitions['rtr_a'], 37)
+        p._adapt_repetitions('rtr_a', 37, 2, True)
+        self.assertEqual(p.repetitions['rtr_a'], AsyncSNMPPoller.min_repetitions)
+        # the end of the table says nothing about the device
+        p._adapt_repetitions('rtr_a', 5, 1, False)
+        self.assertEqual(p.repetitions['rtr_a'], AsyncSNMPPoller.min_repetitions)
+
+    def test_walk_stats(self):
+        s = WalkStats()
+        self.assertEqual(s.average, 0.0)
+        s.add(1.0)
+        s.add(3.0)
+        self.assertEqual(s.average, 2.0)
+        self.assertEqual(s.last, 3.0)
+        self.assertEqual(s.max, 3.0)
+
+class TestPollScheduler(TestCase):
+    fixtures = ['oidsets.json']
+
+    def make_poller(self, device_name, **kwargs):
+        return Poller(MockConfig(**kwargs), MockDevice(device_name),
+                OIDSet.objects.get(name='FastPollHC'), None, None)
+
+    def test_scheduler(self):
+        s = PollScheduler()
+        self.assertEqual(s.next_deadline(), None)
+
+        pollers = []
+        for i, t in enumerate([30, 10, 20, 10]):
+            p = self.make_poller('rtr_%d' % i)
+            p.next_poll = t
+            pollers.append(p)
+            s.add(i, p)
+
+        self.assertEqual(s.next_deadline(), 10)
+        self.assertEqual(s.pop_due(5), [])
+        # ties come out in the order they were added
+        self.assertEqual(s.pop_due(20), [(1, pollers[1]), (3, pollers[3]),
+            (2, pollers[2])])
+        self.assertEqual(len(s), 1)
+        self.assertEqual(s.next_deadline(), 30)
+
+    def test_jitter_and_align(self):
+        p = self.make_poller('rtr_a')
+        self.assertEqual(p.offset, 0)
+        self.assertEqual(p.next_deadline(1000.5), 1030.5)
+
+        offsets = set()
+        for i in range(20):
+            p = self.make_poller('rtr_%d' % i, poll_align=True, poll_jitter=1.0)
+            self.assertTrue(0 <= p.offset < 30)
+            offsets.add(p.offset)
+
+            # the same poller always gets the same offset
+            self.assertEqual(p.offset, self.make_poller('rtr_%d' % i,
+                poll_jitter=1.0).offset)
+
+            first = p.first_deadline(1000.5)
+            self.assertTrue(1000.5 <= first < 1030.5)
+            n = (first - p.offset) / 30
+            self.assertAlmostEqual(n, round(n))
+
+            # polls stay on the boundary however late they start and
+            # missed polls are skipped
+            p.next_poll = first
+            self.assertEqual(p.next_deadline(first + 2.5), first + 30)
+            self.assertEqual(p.next_deadline(first + 65), first + 90)
+
+        self.assertTrue(len(offsets) > 10)
+
+class RecordingPoller(Poller):
+    def begin(self):
+        pass
+
+    def finish(self, data):
+        for d in data:
+            self.save(d)
+
+class TestPollerMetrics(TestCase):
+    fixtures = ['oidsets.json']
+
+    def test_metrics(self):
+        q = Queue.Queue()
+        p = RecordingPoller(MockConfig(), MockDevice('rtr_a'),
+                OIDSet.objects.get(name='FastPollHC'), None, q)
+        m = p.metrics
+
+        poll_round = PollRound(time.time() - 0.5)
+        poll_round.pdus = 3
+        p._collected(poll_round, [('ifHCInOctets.1', 10),
+            ('ifHCInOctets.2', 20)])
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(m.polls, 1)
+        self.assertTrue(m.walk_time.max >= 0.5)
+        self.assertEqual(m.pdus.max, 3)
+        self.assertEqual(m.vars.max, 2)
+        self.assertEqual(m.process_time.count, 1)
+        self.assertEqual(m.enqueue_time.count, 1)
+
+        p._failed(PollRound(time.time()), 'timeout')
+        self.assertEqual(m.timeouts, 1)
+
+        # started two polls late
+        p.collect = lambda: None
+        p.next_poll = time.time() - 65
+        p.run_once()
+        self.assertEqual(m.missed_deadlines, 2)
+
+        m2 = PollerMetrics.from_dict(json.loads(json.dumps(m.to_dict())))
+        m2.merge(m)
+        self.assertEqual(m2.polls, 2)
+        self.assertEqual(m2.pdus.count, 2)
+        self.assertEqual(m2.missed_deadlines, 4)
+
+class TestCorrelatorRefresh(TestCase):
+    fixtures = ['oidsets.json']
+
+    def make_poller(self, refresh):
+        return CorrelatedPoller(MockConfig(poll_correlator_refresh=refresh),
+                MockDevice('rtr_a'), OIDSet.objects.get(name='JnxCOS'), None,
+                Queue.Queue())
+
+    def poll(self, p, t, data):
+        """Poll at time t, returns whether ifName was walked and the
+        data of the first PollResult."""
+        p.begin_time = t
+        p.begin()
+        walked = 'ifName' in p.poll_oids
+        p.finish(data)
+        results = []
+        while not p.persistq.empty():
+            results.append(p.persistq.get().data)
+        return walked, results[0]
+
+    def test_refresh(self):
+        names = [('ifName.116', 'xe-0/0/0'), ('ifAlias.116', 'core')]
+        cos = [('jnxCosIfqQedBytes.116."best-effort"', 10)]
+        unknown = [('jnxCosIfqQedBytes.117."best-effort"', 10)]
+
+        expected = [(['xe-0/0/0', 'jnxCosIfqQedBytes', 'best-effort'], 10)]
+
+        p = self.make_poller(300)
+        self.assertEqual(self.poll(p, 1000, names + cos), (True, expected))
+
+        # the index map is kept until the refresh interval is up
+        self.assertEqual(self.poll(p, 1030, cos), (False, expected))
+        self.assertEqual(self.poll(p, 1300, names + cos), (True, expected))
+
+        # an unknown ifIndex makes the next poll walk the names again
+        self.assertEqual(self.poll(p, 1330, unknown), (False, []))
+        self.assertEqual(self.poll(p, 1360, names + cos), (True, expected))
+        self.assertEqual(self.poll(p, 1390, cos), (False, expected))
+
+        # without a refresh interval the names are walked every time
+        p = self.make_poller(0)
+        self.assertEqual(self.poll(p, 1000, names + cos), (True, expected))
+        self.assertEqual(self.poll(p, 1030, names + cos), (True, expected))
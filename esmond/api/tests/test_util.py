@@ -1,5 +1,6 @@
 from django.test import TestCase
-from esmond.util import atencode, atdecode, decode_alu_port, build_alu_sap_name
+from esmond.util import atencode, atdecode, decode_alu_port, build_alu_sap_name, \
+        HashRing, Histogram
 
 class TestAtEncoding(TestCase):
     def test_basics(self):
@@ -54,3 +55,49 @@ class TestBuildALUSAPName(TestCase):
     def test_build_alu_sap_name(self):
         self.assertEqual(build_alu_sap_name("xxx.111.337969152.2200"), 
                 "111-10/1/10-2200")
+
+class TestHashRing(TestCase):
+    def test_hash_ring(self):
+        keys = ['rtr_%d' % i for i in xrange(1000)]
+
+        ring = HashRing(range(4))
+        owner = dict([(k, ring.get_node(k)) for k in keys])
+        # every node gets a share and lookups are stable
+        self.assertEqual(set(owner.values()), set(range(4)))
+        self.assertEqual(owner, dict([(k, HashRing(range(4)).get_node(k))
+            for k in keys]))
+        self.assertEqual(ring.get_node(u'rtr_1'), owner['rtr_1'])
+
+        # adding a node only moves keys to the new node
+        ring5 = HashRing(range(5))
+        moved = [k for k in keys if ring5.get_node(k) != owner[k]]
+        self.assertTrue(all([ring5.get_node(k) == 4 for k in moved]))
+        self.assertLess(len(moved), len(keys) / 2)
+
+        self.assertRaises(ValueError, HashRing([]).get_node, 'rtr_1')
+
+class TestHistogram(TestCase):
+    def test_histogram(self):
+        h = Histogram()
+        self.assertEqual(h.percentile(50), 0)
+        self.assertEqual(h.mean, 0)
+
+        for v in [0, 1, 2, 3, 5, 100]:
+            h.add(v)
+        self.assertEqual(h.buckets[:4], [1, 1, 2, 1])
+        self.assertEqual(h.count, 6)
+        self.assertEqual(h.max, 100)
+        self.assertAlmostEqual(h.mean, 111 / 6.0)
+        self.assertEqual(h.percentile(50), 4)
+        self.assertEqual(h.percentile(100), 100)
+
+        t = Histogram(base=0.001)
+        t.add(0.0005)
+        t.add(0.003)
+        self.assertEqual(t.buckets[:3], [1, 0, 1])
+
+        g = Histogram.from_dict(h.to_dict())
+        g.merge(h)
+        self.assertEqual(g.count, 12)
+        self.assertEqual(g.buckets[:4], [2, 2, 4, 2])
+        self.assertRaises(ValueError, g.merge, t)
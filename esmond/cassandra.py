@@ -47,15 +47,22 @@ esmond schema in json-like notation:
 import ast
 import calendar
 import datetime
+import errno
 import json
 import logging
 import os
 import pprint
 import sys
+import tempfile
 import time
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import cPickle as pickle
 
 from esmond.util import get_logger
+from esmond.querycache import BlockCache
+from esmond.segmentlog import SegmentLog
 
 # Third party
 from pycassa import PycassaLogger
@@ -85,8 +92,24 @@ class CASSANDRA_DB(object):
     rate_cf = 'base_rates'
     agg_cf = 'rate_aggregations'
     stat_cf = 'stat_aggregations'
+    # Plain (non-counter) versions of rate_cf and agg_cf used when
+    # cassandra_rate_storage is absolute.
+    rate_absolute_cf = 'base_rates_absolute'
+    agg_absolute_cf = 'rate_aggregations_absolute'
     
     _queue_size = 200
+    # Rows per batch_mutate when sending a MutationBatch.
+    _send_batch_size = 1000
+    # Items per multiget when prefetching metadata.
+    _prefetch_chunk_size = 500
+    # Columns fetched per page by the query iterators.
+    _query_page_size = 1000
+    # Bins per block in the query cache.
+    query_cache_block_bins = 256
+    # Times an absolute rate write is resent after MaximumRetryException.
+    _absolute_write_retries = 3
+    # Seconds to wait after a failed write before replaying the spill.
+    _spill_retry_delay = 10
     
     def __init__(self, config, qname=None):
         """
@@ -192,6 +215,19 @@ class CASSANDRA_DB(object):
                     key_validation_class=UTF8_TYPE,
                     compaction_strategy='LeveledCompactionStrategy')
             self.log.info('Created CF: %s' % self.stat_cf)
+        # Absolute base rate and rate aggregation CFs
+        self.rate_storage = config.cassandra_rate_storage
+        if self.rate_storage == 'absolute':
+            for cf_name in (self.rate_absolute_cf, self.agg_absolute_cf):
+                if sysman.get_keyspace_column_families(self.keyspace).has_key(cf_name):
+                    continue
+                _schema_modified = True
+                sysman.create_column_family(self.keyspace, cf_name, super=True,
+                        comparator_type=LONG_TYPE,
+                        default_validation_class=LONG_TYPE,
+                        key_validation_class=UTF8_TYPE,
+                        compaction_strategy='LeveledCompactionStrategy')
+                self.log.info('Created CF: %s' % cf_name)
                     
         sysman.close()
         
@@ -229,9 +265,13 @@ class CASSANDRA_DB(object):
         self.log.info('Connected to %s' % config.cassandra_servers)
         
         # Define column family connections for the code to use.
+        if self.rate_storage == 'absolute':
+            rate_cf, agg_cf = self.rate_absolute_cf, self.agg_absolute_cf
+        else:
+            rate_cf, agg_cf = self.rate_cf, self.agg_cf
         self.raw_data = ColumnFamily(self.pool, self.raw_cf).batch(self._queue_size)
-        self.rates    = ColumnFamily(self.pool, self.rate_cf).batch(self._queue_size)
-        self.aggs     = ColumnFamily(self.pool, self.agg_cf).batch(self._queue_size)
+        self.rates    = ColumnFamily(self.pool, rate_cf).batch(self._queue_size)
+        self.aggs     = ColumnFamily(self.pool, agg_cf).batch(self._queue_size)
         self.stat_agg = ColumnFamily(self.pool, self.stat_cf).batch(self._queue_size)
 
         # Used when a cf needs to be selected on the fly.
@@ -252,9 +292,92 @@ class CASSANDRA_DB(object):
         self.stats = DatabaseMetrics(profiling=self.profiling)
         
         # Class members
-        # Just the dict for the metadata cache.
-        self.metadata_cache = {}
-        self.aggregation_cache = {}
+        # Bounded LRU caches for the metadata and stat aggregations.
+        self.metadata_cache = LRUCache(config.metadata_cache_size)
+        self.aggregation_cache = LRUCache(config.metadata_cache_size)
+
+        # Write-behind accumulator for the base rate and rate aggregation
+        # counter increments.  Increments to the same column are summed
+        # in memory and sent by flush_counters() every
+        # counter_flush_interval seconds or once counter_flush_rows rows
+        # have built up.  An interval of 0 sends them right away.
+        self.counter_flush_interval = config.counter_flush_interval
+        self.counter_flush_rows = config.counter_flush_rows
+        self._counters = MutationBatch()
+        self._last_counter_flush = time.time()
+
+        # Running totals of the open base rate and rate aggregation bins
+        # when cassandra_rate_storage is absolute, {row_key: {bin_ts: cols}}.
+        # The persister writes the totals rather than counter increments,
+        # so a write can be resent without counting it twice.
+        self.rate_totals = LRUCache(config.metadata_cache_size)
+
+        # Stat aggregation bins whose min/max in the aggregation cache
+        # has not been written yet, {row_key: {bin_ts: cols}}.  When
+        # stat_checkpoint_interval is set they are written when the bin
+        # closes or by checkpoint_stats() every stat_checkpoint_interval
+        # seconds rather than on every new min or max.
+        self.stat_checkpoint_interval = config.stat_checkpoint_interval
+        self._dirty_stats = {}
+        self._last_stat_checkpoint = time.time()
+
+        # Read-through cache of the bins of old enough blocks, shared with
+        # the other processes on the host through query_cache_dir.
+        self.query_cache = None
+        self.query_cache_min_age = config.query_cache_min_age
+        if config.query_cache_dir:
+            self.query_cache = BlockCache(config.query_cache_dir,
+                config.query_cache_size * 1024 * 1024)
+
+        # Journal of the batch writes that failed with
+        # MaximumRetryException.  replay_spill() sends them again at up to
+        # spill_replay_rate rows a second once cassandra takes writes
+        # again.  While it holds anything new writes are added behind them
+        # so a bin is never overwritten with an older value.
+        self.spill = None
+        self.spill_replay_rate = config.spill_replay_rate
+        self.spilled_rows = 0
+        self.replayed_rows = 0
+        self._spill_retry_at = 0
+        self._spill_budget = 0
+        self._last_replay = time.time()
+        # The newest spilled absolute rate and aggregation totals,
+        # {cf_name: {row_key: {bin_ts: cols}}}, so _add_to_total() doesn't
+        # read an older total from cassandra while they wait for replay.
+        self._spilled_totals = {}
+        if qname and config.spill_dir:
+            self.spill = SegmentLog(os.path.join(config.spill_dir, qname),
+                consumer='replay', segment_size=config.persist_queue_segment_size,
+                fsync=config.persist_queue_fsync,
+                fsync_interval=config.persist_queue_fsync_interval)
+            if self.rate_storage == 'absolute':
+                self._load_spilled_totals()
+
+        # Thread pool for metadata prefetch queries, created on first use.
+        self._prefetch_threads = config.metadata_prefetch_threads
+        self._prefetch_pool = None
+
+        # Warm start the metadata cache from the snapshot written when a
+        # persister worker with the same qname was last stopped.  The
+        # snapshot is removed once it is loaded: after a crash the cache
+        # may be ahead of it, so only the seek back can be trusted.
+        self.snapshot_path = None
+        if qname and config.metadata_snapshot_dir:
+            self.snapshot_path = os.path.join(config.metadata_snapshot_dir,
+                '%s.metadata_cache' % qname)
+            try:
+                n = self.metadata_cache.load(self.snapshot_path,
+                    max_age=config.metadata_snapshot_max_age)
+                self.log.info('Loaded %d metadata entries from %s' % 
+                    (n, self.snapshot_path))
+            except (IOError, EOFError, pickle.UnpicklingError), e:
+                self.log.warn('Unable to load metadata snapshot %s: %s' %
+                    (self.snapshot_path, e))
+            try:
+                os.unlink(self.snapshot_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
         
     def flush(self):
         """
@@ -263,27 +386,358 @@ class CASSANDRA_DB(object):
         in production when the batches will be self-flushing.
         """
         self.log.debug('Flush called')
+        self.flush_counters(force=True)
+        self.checkpoint_stats(force=True)
         self.raw_data.send()
         self.rates.send()
         self.aggs.send()
         self.stat_agg.send()
         
+    def flush_counters(self, force=False):
+        """
+        Send the counter increments held by the write-behind accumulator
+        if counter_flush_interval seconds have passed since the last send
+        or counter_flush_rows rows are waiting.  The force arg sends them
+        regardless - used by flush() at shutdown.
+        """
+        if not len(self._counters):
+            return
+
+        now = time.time()
+        if not force and len(self._counters) < self.counter_flush_rows and \
+                now < self._last_counter_flush + self.counter_flush_interval:
+            return
+
+        self._last_counter_flush = now
+        counters, self._counters = self._counters, MutationBatch()
+
+        self._batch_insert(self.rates, counters.rates,
+            retries=self._rate_write_retries())
+        self._batch_insert(self.aggs, counters.aggs,
+            retries=self._rate_write_retries())
+
+        self.log.debug('Sent %d counter rows (%d increments merged) in %f seconds' %
+            (len(counters), counters.merged, time.time() - now))
+
+    def checkpoint_stats(self, force=False):
+        """
+        Write the stat aggregation bins that have changed since they were
+        last written if stat_checkpoint_interval seconds have passed since
+        the last checkpoint.  The force arg skips the interval check - used
+        by flush() at shutdown.
+        """
+        if not self._dirty_stats:
+            return
+
+        now = time.time()
+        if not force and \
+                now < self._last_stat_checkpoint + self.stat_checkpoint_interval:
+            return
+
+        self._last_stat_checkpoint = now
+        dirty, self._dirty_stats = self._dirty_stats, {}
+
+        rows = {}
+        for key, cols in dirty.iteritems():
+            rows[key] = dict([(ts, dict(scol)) for ts, scol in cols.iteritems()])
+        self._batch_insert(self.stat_agg, rows)
+        self.stats.stat_written(len(rows))
+
+        self.log.debug('Checkpointed %d stat aggregation bins in %f seconds' %
+            (len(rows), time.time() - now))
+
+    def snapshot_metadata(self):
+        """
+        Write the metadata cache to the snapshot file if one is configured.
+        Only called by the persister at a clean shutdown, after flush(),
+        so the snapshot matches what has been written.
+        """
+        if not self.snapshot_path:
+            return
+
+        now = time.time()
+
+        try:
+            self.metadata_cache.save(self.snapshot_path)
+        except (IOError, OSError), e:
+            self.log.error('Unable to write metadata snapshot %s: %s' %
+                (self.snapshot_path, e))
+            return
+
+        self.log.debug('Wrote %d metadata entries to %s in %f seconds' %
+            (len(self.metadata_cache), self.snapshot_path, time.time() - now))
+
     def close(self):
         """
         Explicitly close the connection pool.
         """
         self.log.debug('Close/dispose called')
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.close()
+            self._prefetch_pool = None
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
         self.pool.dispose()
         
-    def set_raw_data(self, raw_data, ttl=None):
+    def send_batch(self, batch):
+        """
+        Send the contents of a MutationBatch (defined in this module) to
+        cassandra.  Each column family gets grouped multi-row batch_mutate
+        calls rather than the per-variable inserts done by the methods 
+        below when they are not handed a batch.
+        """
+        t = time.time()
+
+        for ttl, rows in batch.raw.iteritems():
+            self._batch_insert(self.raw_data, rows, ttl=ttl)
+        if self.counter_flush_interval:
+            if self.rate_storage == 'absolute':
+                self._counters.merge_totals(batch)
+            else:
+                self._counters.merge_counters(batch)
+            self.flush_counters()
+        else:
+            self._batch_insert(self.rates, batch.rates,
+                retries=self._rate_write_retries())
+            self._batch_insert(self.aggs, batch.aggs,
+                retries=self._rate_write_retries())
+        self._batch_insert(self.stat_agg, batch.stats)
+
+        if self.profiling: self.stats.batch_send((time.time() - t))
+
+    def _rate_write_retries(self):
+        """
+        Overwriting the absolute rate columns is idempotent so a failed
+        write can be sent again, counter increments can't.
+        """
+        if self.rate_storage == 'absolute':
+            return self._absolute_write_retries
+        return 0
+
+    def _batch_insert(self, cf, rows, ttl=None, retries=0):
+        """
+        Write a dict of {row_key: columns} to the column family underlying
+        the batch cf in as few batch_mutate calls as _send_batch_size allows.
+        If the write fails it is sent again up to retries times, only safe
+        when the columns are overwritten rather than incremented.  Rows
+        that can't be sent go to the spill journal if there is one.
+        """
+        if not rows:
+            return
+
+        if self.spill_pending():
+            self._spill_rows(cf, rows, ttl)
+        elif not self._send_rows(cf, rows, ttl=ttl, retries=retries):
+            self._spill_rows(cf, rows, ttl)
+
+    def _send_rows(self, cf, rows, ttl=None, retries=0):
+        """
+        Send the rows for _batch_insert, returns False if they could not
+        be sent.
+        """
+        _kw = {}
+        if ttl:
+            _kw['ttl'] = ttl
+
+        for attempt in range(retries + 1):
+            b = cf._column_family.batch(queue_size=self._send_batch_size)
+
+            try:
+                for key, cols in rows.iteritems():
+                    b.insert(key, cols, **_kw)
+                b.send()
+                self._expire_sent(cf, rows)
+                return True
+            except MaximumRetryException:
+                self.log.warn("batch insert to %s failed. MaximumRetryException" %
+                        cf._column_family.column_family)
+
+        return False
+
+    def _spill_rows(self, cf, rows, ttl=None):
+        """
+        Append rows that were not sent to the spill journal, in records of
+        at most _send_batch_size rows.
+        """
+        if self.spill is None:
+            return
+
+        was_empty = not self.spill_pending()
+        cf_name = cf._column_family.column_family
+        keys = rows.keys()
+        records = []
+        for i in range(0, len(keys), self._send_batch_size):
+            chunk = dict([(k, rows[k]) for k in keys[i:i + self._send_batch_size]])
+            records.append(pickle.dumps((cf_name, ttl, chunk),
+                pickle.HIGHEST_PROTOCOL))
+        self.spill.append(records)
+        self._note_spilled_totals(cf_name, rows)
+
+        if was_empty:
+            self.log.warn('spilling writes to %s' % self.spill.path)
+        self.spilled_rows += len(rows)
+        self._spill_retry_at = time.time() + self._spill_retry_delay
+
+    def _note_spilled_totals(self, cf_name, rows):
+        """Remember the absolute totals in rows spilled to cf_name."""
+        if self.rate_storage != 'absolute' or \
+                cf_name not in (self.rate_absolute_cf, self.agg_absolute_cf):
+            return
+
+        spilled = self._spilled_totals.setdefault(cf_name, {})
+        for key, cols in rows.iteritems():
+            spilled.setdefault(key, {}).update(cols)
+
+    def _load_spilled_totals(self):
+        """
+        Rebuild _spilled_totals from a spill journal left by an earlier
+        run.  The records are read and rolled back so replay_spill()
+        still sends them.
+        """
+        while True:
+            records = self.spill.read(self._send_batch_size)
+            if not records:
+                break
+            for r in records:
+                cf_name, ttl, rows = pickle.loads(r)
+                self._note_spilled_totals(cf_name, rows)
+        self.spill.rollback()
+
+    def spill_pending(self):
+        """Number of spill journal records waiting to be replayed."""
+        if self.spill is None:
+            return 0
+        return self.spill.pending()
+
+    def replay_spill(self):
+        """
+        Send the writes in the spill journal again, at most
+        spill_replay_rate rows a second and not until _spill_retry_delay
+        seconds after the last failure.  A record that fails again is
+        left for the next try.  Returns the number of rows sent.
+        """
+        if not self.spill_pending():
+            return 0
+
+        now = time.time()
+        if now < self._spill_retry_at:
+            return 0
+
+        self._spill_budget = min(self.spill_replay_rate, self._spill_budget +
+            (now - self._last_replay) * self.spill_replay_rate)
+        self._last_replay = now
+
+        cfs = dict([(cf._column_family.column_family, cf)
+            for cf in self.cf_map.values()])
+        sent = 0
+
+        while self._spill_budget > 0:
+            records = self.spill.read(1)
+            if not records:
+                # Save the position in case it moved past corrupt records.
+                self.spill.commit()
+                break
+            cf_name, ttl, rows = pickle.loads(records[0])
+            if not self._send_rows(cfs[cf_name], rows, ttl=ttl):
+                self.spill.rollback()
+                self._spill_retry_at = time.time() + self._spill_retry_delay
+                break
+            self.spill.commit()
+            self._spill_budget -= len(rows)
+            sent += len(rows)
+
+        self.replayed_rows += sent
+        if not self.spill_pending():
+            self._spilled_totals = {}
+            self.log.info('spill journal replayed')
+
+        return sent
+
+    def _insert_rate(self, cf, key, cols):
+        """
+        Write one row to the rate or aggregation cf right away, resending
+        absolute writes that fail and spilling them if they still can't
+        be sent.  The row doesn't go through the Mutator cf: a failed
+        send leaves the Mutator's buffer queued, so the row would be sent
+        again by the next send() as well as by the spill replay.
+        """
+        self._batch_insert(cf, {key: cols},
+            retries=self._rate_write_retries())
+
+    def _add_to_total(self, cf, key, ts, cols, pending=()):
+        """
+        Add cols to the running total of bin ts in row key of the
+        absolute cf and return a copy of the new total to be written.
+
+        The totals are kept in rate_totals.  A bin that isn't there is
+        looked up if the row is new to the cache (a restart, a new series
+        or an eviction) or the bin is older than the newest one (backfill),
+        otherwise it is a new bin and starts at zero.  The lookup takes
+        the last total that has not been written yet, from the pending
+        {row_key: {bin_ts: cols}} dicts (newest first) or the spill
+        journal, before reading cf.  Only the two newest bins of a row and
+        the bin just updated are kept, older ones are closed.
+        """
+        row = self.rate_totals.get(key)
+        if row is None:
+            row = self.rate_totals[key] = {}
+            lookup = True
+        else:
+            lookup = ts not in row and bool(row) and ts < max(row)
+
+        total = row.get(ts)
+        if total is None:
+            total = {}
+            if lookup:
+                total = self._unsent_total(cf, key, ts, pending)
+                if total is None:
+                    try:
+                        total = dict(cf._column_family.get(key, super_column=ts))
+                    except NotFoundException:
+                        total = {}
+            row[ts] = total
+
+        for k, v in cols.iteritems():
+            total[k] = total.get(k, 0) + v
+
+        if len(row) > 2:
+            for old_ts in sorted(row)[:-2]:
+                if old_ts != ts:
+                    del row[old_ts]
+
+        return dict(total)
+
+    def _unsent_total(self, cf, key, ts, pending=()):
+        """
+        Return a copy of the newest total for bin ts in row key of the
+        absolute cf that has not reached cassandra yet, or None.
+        """
+        for rows in pending:
+            if key in rows and ts in rows[key]:
+                return dict(rows[key][ts])
+
+        spilled = self._spilled_totals.get(cf._column_family.column_family, {})
+        if key in spilled and ts in spilled[key]:
+            return dict(spilled[key][ts])
+
+        return None
+
+    def set_raw_data(self, raw_data, ttl=None, batch=None):
         """
         Called by the persister.  Writes the raw incoming data to the appropriate
         column family.  The optional TTL option is passed in self.raw_opts and 
         is set up in the constructor.
         
         The raw_data arg passes in is an instance of the RawData class defined
-        in this module.
+        in this module.  If a MutationBatch is passed in the write is added 
+        to it rather than the raw_data batch.
         """
+        if batch is not None:
+            batch.add_raw(raw_data.get_key(), raw_data.ts_to_jstime(),
+                json.dumps(raw_data.val), ttl=ttl)
+            return
+
         _kw = {}
         if ttl: 
             _kw['ttl'] = ttl
@@ -299,7 +753,7 @@ class CASSANDRA_DB(object):
         """
         Just does a simple write to the dict being used as metadata.
         """
-        self.metadata_cache[k] = meta_d.get_document()
+        self.metadata_cache[k] = meta_d
         
     def get_metadata(self, raw_data):
         """
@@ -314,6 +768,8 @@ class CASSANDRA_DB(object):
         in this module.
         
         The return value is a Metadata object, also defined in this module.
+        It is the object held in the metadata cache, not a copy, so changes
+        to it are changes to the cache.
         """
         t = time.time()
 
@@ -334,61 +790,167 @@ class CASSANDRA_DB(object):
                     column_count=1, column_reversed=True)
                     
             if self.profiling: self.stats.meta_fetch((time.time() - t))
-                    
-            if ret:
-                # A previous value was found in the raw data, so we can
-                # seed/return that.
-                key = ret.keys()[-1]
-                ts = ret[key].keys()[0]
-                val = json.loads(ret[key][ts])
-                meta_d = Metadata(last_update=ts, last_val=val, min_ts=ts, 
-                    freq=raw_data.freq, path=raw_data.path)
-                self.log.debug('Metadata lookup from raw_data for: %s' %
-                        (raw_data.get_meta_key()))
-            else:
-                # No previous value was found (or at least not one in the defined
-                # time range) so seed/return the current value.
-                meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
-                    min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
-                self.log.debug('Initializing metadata for: %s using %s' %
-                        (raw_data.get_meta_key(), raw_data))
-            self.set_metadata(raw_data.get_meta_key(), meta_d)
+
+            meta_d = self._seed_metadata(raw_data, ret)
         else:
-            meta_d = Metadata(**self.metadata_cache[raw_data.get_meta_key()])
+            meta_d = self.metadata_cache[raw_data.get_meta_key()]
         
         return meta_d
+
+    def _seed_metadata(self, raw_data, ret):
+        """
+        Seed the metadata cache for raw_data from the results of a seek
+        back query against the raw data (an ordered dict of row key -> 
+        {ts: val} with at most one column per row) and return the new
+        Metadata object.
+        """
+        if ret:
+            # A previous value was found in the raw data, so we can
+            # seed/return that.
+            key = ret.keys()[-1]
+            ts = ret[key].keys()[0]
+            val = json.loads(ret[key][ts])
+            meta_d = Metadata(last_update=ts, last_val=val, min_ts=ts, 
+                freq=raw_data.freq, path=raw_data.path)
+            self.log.debug('Metadata lookup from raw_data for: %s' %
+                    (raw_data.get_meta_key()))
+        else:
+            # No previous value was found (or at least not one in the defined
+            # time range) so seed/return the current value.
+            meta_d = Metadata(last_update=raw_data.ts, last_val=raw_data.val,
+                min_ts=raw_data.ts, freq=raw_data.freq, path=raw_data.path)
+            self.log.debug('Initializing metadata for: %s using %s' %
+                    (raw_data.get_meta_key(), raw_data))
+        self.set_metadata(raw_data.get_meta_key(), meta_d)
+
+        return meta_d
+
+    def prefetch_metadata(self, raw_data_list):
+        """
+        Called by the persister before processing a PollResult.  Seeds the
+        metadata cache for every item in raw_data_list that is not already
+        cached using a handful of large multiget queries, run in parallel
+        on a thread pool, rather than the one query per item that 
+        get_metadata() would issue.
+        
+        The raw_data_list arg is a list of RawRateData objects defined in 
+        this module.
+        """
+        t = time.time()
+
+        # Group the misses by their seek back range - in practice all
+        # of the items in a PollResult share a timestamp.
+        misses = {}
+        seen = set()
+
+        for raw_data in raw_data_list:
+            meta_key = raw_data.get_meta_key()
+            if meta_key in seen or self.metadata_cache.has_key(meta_key):
+                continue
+            seen.add(meta_key)
+            ts_max = raw_data.ts_to_jstime() - 1 # -1ms to look at older vals
+            misses.setdefault(ts_max, []).append(raw_data)
+
+        if not misses:
+            return
+
+        queries = []
+
+        for ts_max, items in misses.items():
+            ts_min = ts_max - SEEK_BACK_THRESHOLD
+            for i in xrange(0, len(items), self._prefetch_chunk_size):
+                queries.append((ts_min, ts_max,
+                    items[i:i + self._prefetch_chunk_size]))
+
+        def fetch(q):
+            ts_min, ts_max, items = q
+            keys = []
+            for raw_data in items:
+                keys.extend(self._get_row_keys(raw_data.path, raw_data.freq,
+                    ts_min, ts_max))
+            # See get_metadata() re: the reversed range.
+            return self.raw_data._column_family.multiget(keys,
+                    column_start=ts_max, column_finish=ts_min,
+                    column_count=1, column_reversed=True,
+                    buffer_size=len(keys))
+
+        if len(queries) > 1:
+            if self._prefetch_pool is None:
+                self._prefetch_pool = ThreadPool(self._prefetch_threads)
+            results = self._prefetch_pool.map(fetch, queries)
+        else:
+            results = [fetch(queries[0])]
+
+        if self.profiling: self.stats.meta_fetch((time.time() - t))
+
+        for (ts_min, ts_max, items), ret in zip(queries, results):
+            for raw_data in items:
+                # Pull out this item's rows, keeping them in year order.
+                rows = OrderedDict()
+                for key in self._get_row_keys(raw_data.path, raw_data.freq,
+                        ts_min, ts_max):
+                    if key in ret:
+                        rows[key] = ret[key]
+                self._seed_metadata(raw_data, rows)
+
+        self.log.debug('Prefetched metadata for %d items in %d queries in %f seconds' %
+            (len(seen), len(queries), time.time() - t))
         
     def update_metadata(self, k, metadata):
         """
         Update the metadata cache with a recently updated value.  Called by the
         persister.
         
-        The metadata arg is a Metadata object defined in this module.
+        The metadata arg is a Metadata object defined in this module.  It
+        is usually the object get_metadata() returned, which is already
+        up to date in the cache.
         """
         t = time.time()
-        for i in ['last_val', 'min_ts', 'last_update']:
-            self.metadata_cache[k][i] = getattr(metadata, i)
+        try:
+            cached = self.metadata_cache[k]
+        except KeyError:
+            # evicted since get_metadata()
+            self.metadata_cache[k] = metadata
+            return
+        if cached is not metadata:
+            for i in ['last_val', 'min_ts', 'last_update']:
+                setattr(cached, i, getattr(metadata, i))
         #self.stats.meta_update((time.time() - t))
     
-    def update_rate_bin(self, ratebin):
+    def update_rate_bin(self, ratebin, batch=None):
         """
         Called by the persister.  This updates a base rate bin in the base 
         rate column family.  
         
         The ratebin arg is a BaseRateBin object defined in this module.
         """
+
+        if batch is None and self.counter_flush_interval:
+            batch = self._counters
+
+        cols = {'val': ratebin.val, 'is_valid': ratebin.is_valid}
+        if self.rate_storage == 'absolute':
+            cols = self._add_to_total(self.rates, ratebin.get_key(),
+                ratebin.ts_to_jstime(), cols,
+                [b.rates for b in (batch, self._counters) if b is not None])
         
+        if batch is not None:
+            if self.rate_storage == 'absolute':
+                batch.set_rate(ratebin.get_key(), ratebin.ts_to_jstime(), cols)
+            else:
+                batch.incr_rate(ratebin.get_key(), ratebin.ts_to_jstime(),
+                    ratebin.val, ratebin.is_valid)
+            return
+
         t = time.time()
-        # A super column insert.  Both val and is_valid are counter types.
-        try:
-            self.rates.insert(ratebin.get_key(),
-                {ratebin.ts_to_jstime(): {'val': ratebin.val, 'is_valid': ratebin.is_valid}})
-        except MaximumRetryException:
-            self.log.warn("update_rate_bin failed. MaximumRetryException")
+        # A super column insert.  Both val and is_valid are counter types
+        # unless the storage is absolute.
+        self._insert_rate(self.rates, ratebin.get_key(),
+            {ratebin.ts_to_jstime(): cols})
 
         if self.profiling: self.stats.baserate_update((time.time() - t))
         
-    def update_rate_aggregation(self, raw_data, agg_ts, freq):
+    def update_rate_aggregation(self, raw_data, agg_ts, freq, batch=None):
         """
         Called by the persister to update the rate aggregation rollups.
         
@@ -402,18 +964,76 @@ class CASSANDRA_DB(object):
             ts=agg_ts, freq=freq, val=raw_data.val, base_freq=raw_data.freq, count=1,
             min=raw_data.val, max=raw_data.val, path=raw_data.path
         )
+
+        if batch is None and self.counter_flush_interval:
+            batch = self._counters
+
+        cols = {'val': agg.val, str(agg.base_freq): 1}
+        if self.rate_storage == 'absolute':
+            cols = self._add_to_total(self.aggs, agg.get_key(),
+                agg.ts_to_jstime(), cols,
+                [b.aggs for b in (batch, self._counters) if b is not None])
+
+        if batch is not None:
+            if self.rate_storage == 'absolute':
+                batch.set_agg(agg.get_key(), agg.ts_to_jstime(), cols)
+            else:
+                batch.incr_agg(agg.get_key(), agg.ts_to_jstime(), agg.val,
+                    agg.base_freq)
+            return
         
         # Super column update.  The base rate frequency is stored as the column
         # name key that is not 'val' - this will be used by the query interface
-        # to generate the averages.  Both values are counter types.
-        try:
-            self.aggs.insert(agg.get_key(),
-                {agg.ts_to_jstime(): {'val': agg.val, str(agg.base_freq): 1}})
-        except MaximumRetryException:
-            self.log.warn("update_rate_aggregation failed. MaximumRetryException")
+        # to generate the averages.  Both values are counter types unless the
+        # storage is absolute.
+        self._insert_rate(self.aggs, agg.get_key(),
+            {agg.ts_to_jstime(): cols})
 
         if self.profiling: self.stats.aggregation_update((time.time() - t))
 
+    def migrate_rate_counters(self, log_every=10000):
+        """
+        Copy the base rate and rate aggregation counter CFs to the
+        absolute CFs used when cassandra_rate_storage is absolute.  Any
+        bins already in the absolute CFs are overwritten, so it should be
+        run with the persisters stopped.  Returns a dict of
+        {cf_name: (rows, columns)} copied.
+        """
+        ret = {}
+
+        for src_name, dst_name in ((self.rate_cf, self.rate_absolute_cf),
+                (self.agg_cf, self.agg_absolute_cf)):
+            src = ColumnFamily(self.pool, src_name)
+            dst = ColumnFamily(self.pool, dst_name)
+            rows = cols = 0
+
+            # Only list the keys here, rows can hold a year of bins so
+            # they are paged through with xget.
+            for key, ignore in src.get_range(column_count=1,
+                    buffer_size=self._query_page_size):
+                row = {}
+                for ts, scol in src.xget(key,
+                        buffer_size=self._query_page_size):
+                    row[ts] = dict(scol)
+                    cols += 1
+                    if len(row) >= self._send_batch_size:
+                        self._batch_insert(dst.batch(), {key: row},
+                            retries=self._absolute_write_retries)
+                        row = {}
+                if row:
+                    self._batch_insert(dst.batch(), {key: row},
+                        retries=self._absolute_write_retries)
+                rows += 1
+                if rows % log_every == 0:
+                    self.log.info('Copied %d rows/%d bins from %s to %s' %
+                        (rows, cols, src_name, dst_name))
+
+            self.log.info('Copied %d rows/%d bins from %s to %s' %
+                (rows, cols, src_name, dst_name))
+            ret[src_name] = (rows, cols)
+
+        return ret
+
     def get_agg_from_cache(self, agg, raw_data):
         """
         Manage aggregations using in-memory state similar to tracking
@@ -481,7 +1101,7 @@ class CASSANDRA_DB(object):
         self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]['{0}_ts'.format(minmax)] = raw_data.ts_to_jstime()
 
         
-    def update_stat_aggregation(self, raw_data, agg_ts, freq):
+    def update_stat_aggregation(self, raw_data, agg_ts, freq, batch=None):
         """
         Called by the persister to update the stat aggregations (ie: min/max).
         
@@ -492,10 +1112,21 @@ class CASSANDRA_DB(object):
         more than one batch update rather than doing it each time.
         
         The args are a RawData object, the "compressed" aggregation timestamp
-        and the frequency of the rollups in seconds.
+        and the frequency of the rollups in seconds.  If a MutationBatch is
+        passed in, the writes are added to it and will go out when the 
+        batch is sent.
+
+        When stat_checkpoint_interval is set a new min or max only marks
+        the bin as changed.  It is written when the next bin for the row
+        starts or at the next checkpoint_stats().
         """
         
         updated = False
+
+        if batch is not None:
+            stat_insert = lambda k, v: batch.set_stat(k, v)
+        else:
+            stat_insert = self.stat_agg.insert
         
         # Create the AggBin object.
         agg = AggregationBin(
@@ -503,6 +1134,21 @@ class CASSANDRA_DB(object):
             min=raw_data.val, max=raw_data.val, path=raw_data.path
         )
         
+        if self.stat_checkpoint_interval:
+            # Write the previous bin for this row if it is closing.
+            dirty = self._dirty_stats.get(agg.get_key())
+            if dirty is not None and not dirty.has_key(agg.ts_to_jstime()):
+                del self._dirty_stats[agg.get_key()]
+                for ts, scol in dirty.iteritems():
+                    stat_insert(agg.get_key(), {ts: dict(scol)})
+                self.stats.stat_written(1)
+                updated = True
+            elif dirty is not None and \
+                    not self.aggregation_cache.has_key(agg.get_key()):
+                # The row was evicted from the cache before its bin was
+                # written, put it back rather than reading the old values.
+                self.aggregation_cache[agg.get_key()] = dirty
+
         t = time.time()
 
         ret = self.get_agg_from_cache(agg, raw_data)
@@ -510,24 +1156,34 @@ class CASSANDRA_DB(object):
         if self.profiling: self.stats.stat_fetch((time.time() - t))
         
         t = time.time()
-        
-        if not ret:
+
+        if self.stat_checkpoint_interval:
+            if not ret or agg.val > ret['max'] or agg.val < ret['min']:
+                if ret:
+                    self.update_agg_cache(agg, raw_data,
+                        'max' if agg.val > ret['max'] else 'min')
+                # Keep a reference to the cached bin so later changes
+                # and evictions from the cache don't lose it.
+                self._dirty_stats[agg.get_key()] = {agg.ts_to_jstime():
+                    self.aggregation_cache[agg.get_key()][agg.ts_to_jstime()]}
+                self.stats.stat_deferred()
+        elif not ret:
             # Bin does not exist, so initialize min and max with the same val.
             # self.stat_agg.insert(agg.get_key(),
             #     {agg.ts_to_jstime(): {'min': agg.val, 'max': agg.val}})
-            self.stat_agg.insert(agg.get_key(),
+            stat_insert(agg.get_key(),
                 {agg.ts_to_jstime(): {'min': agg.val, 'max': agg.val, 'min_ts': raw_data.ts_to_jstime(), 'max_ts': raw_data.ts_to_jstime()}})
             updated = True
         elif agg.val > ret['max']:
             # Update max.
             self.update_agg_cache(agg, raw_data, 'max')
-            self.stat_agg.insert(agg.get_key(),
+            stat_insert(agg.get_key(),
                 {agg.ts_to_jstime(): {'max': agg.val, 'max_ts': raw_data.ts_to_jstime()}})
             updated = True
         elif agg.val < ret['min']:
             self.update_agg_cache(agg, raw_data, 'min')
             # Update min.
-            self.stat_agg.insert(agg.get_key(),
+            stat_insert(agg.get_key(),
                 {agg.ts_to_jstime(): {'min': agg.val, 'min_ts': raw_data.ts_to_jstime()}})
             updated = True
         else:
@@ -581,27 +1237,116 @@ class CASSANDRA_DB(object):
 
         return found
         
-    def query_baserate_timerange(self, path=None, freq=None, 
+    def _xget_timerange(self, cf, path, freq, ts_min, ts_max,
+            column_count=None):
+        """
+        Iterate over the (ts, value) columns between ts_min and ts_max in
+        every row covering the range, in row then column order.  Columns
+        are fetched a page at a time so there is no need to count them
+        first.  If column_count is given, at most that many columns are
+        returned from each row.
+        """
+        # Only the base rate and rate aggregation bins go through the
+        # query cache, see _xget_cached().
+        cached = self.query_cache is not None and freq and not column_count \
+            and (cf is self.rates or cf is self.aggs)
+
+        for key in self._get_row_keys(path, freq, ts_min, ts_max):
+            if cached:
+                cols = self._xget_cached(cf, key, freq, ts_min, ts_max)
+            else:
+                cols = cf._column_family.xget(key,
+                    column_start=ts_min, column_finish=ts_max,
+                    column_count=column_count,
+                    buffer_size=self._query_page_size)
+            for col in cols:
+                yield col
+
+    def _xget_cached(self, cf, key, freq, ts_min, ts_max):
+        """
+        Iterate over the columns between ts_min and ts_max in row key
+        through the query cache.
+
+        The row is split into blocks of query_cache_block_bins bins.
+        Blocks that ended more than query_cache_min_age seconds (and at
+        least 3 bins) ago won't change any more so they are read whole
+        and kept in the cache.  The rest of the range is always read from
+        Cassandra.
+        """
+        block = freq * self.query_cache_block_bins
+        cutoff = int(time.time() * 1000) - \
+            max(self.query_cache_min_age * 1000, freq * 3)
+        ts_min = int(ts_min)
+        ts_max = int(ts_max)
+
+        start = ts_min - ts_min % block
+        while start + block <= cutoff and start <= ts_max:
+            cache_key = self._query_cache_key(cf, key, start)
+            cols = self.query_cache.get(cache_key)
+            if cols is None:
+                cols = list(cf._column_family.xget(key,
+                    column_start=start, column_finish=start + block - 1,
+                    buffer_size=self._query_page_size))
+                self.query_cache.put(cache_key, cols)
+
+            for ts, val in cols:
+                if ts_min <= ts <= ts_max:
+                    yield ts, val
+
+            start += block
+
+        if start <= ts_max:
+            for col in cf._column_family.xget(key,
+                    column_start=max(start, ts_min), column_finish=ts_max,
+                    buffer_size=self._query_page_size):
+                yield col
+
+    def _query_cache_key(self, cf, key, start):
+        return '%s:%s:%d' % (cf._column_family.column_family, key, start)
+
+    def expire_query_cache(self, cf, key, freq, ts):
+        """
+        Remove the query cache block holding bin ts of row key in the
+        rates or aggs cf.  Called by the REST API after it writes to a
+        bin, which may be in a block that is already cached.  Writes sent
+        through _batch_insert() are expired by _expire_sent().
+        """
+        if self.query_cache is None:
+            return
+
+        block = int(freq) * self.query_cache_block_bins
+        ts = int(ts)
+        self.query_cache.delete(self._query_cache_key(cf, key,
+            ts - ts % block))
+
+    def _expire_sent(self, cf, rows):
+        """
+        Remove the query cache blocks old enough to be cached that rows
+        just sent to the rates or aggs cf were written to.  The persister
+        writes bins that old when it replays the spill journal or works
+        through a queue backlog.
+        """
+        if self.query_cache is None or not (cf is self.rates or cf is self.aggs):
+            return
+
+        now = int(time.time() * 1000)
+        for key, cols in rows.iteritems():
+            # rate and aggregation row keys end in :freq:year
+            freq = int(key.rsplit(KEY_DELIMITER, 2)[1])
+            block = freq * self.query_cache_block_bins
+            cutoff = now - max(self.query_cache_min_age * 1000, freq * 3)
+            starts = set([int(ts) - int(ts) % block for ts in cols])
+            for start in starts:
+                # Blocks this recent are not cached yet, see _xget_cached().
+                if start + block <= cutoff:
+                    self.query_cache.delete(self._query_cache_key(cf, key,
+                        start))
+
+    def iter_baserate_timerange(self, path=None, freq=None, 
             ts_min=None, ts_max=None, cf='average', column_count=None):
         """
-        Query interface method to retrieve the base rates (generally average 
-        but could be delta as well).
+        Generator version of query_baserate_timerange.
         """
-        cols = column_count
-        if cols is None:
-            ret_count = self.rates._column_family.multiget_count(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in ret_count.keys():
-                cols += ret_count[i]
-            cols += 5
-
-        ret = self.rates._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max,
-                column_count=cols)
-        
         if cf not in ['average', 'delta']:
             self.log.error('Not a valid option: %s - defaulting to average' % cf)
             cf = 'average'
@@ -609,23 +1354,27 @@ class CASSANDRA_DB(object):
         # Divisors to return either the average or a delta.
         if freq is None: freq = 1000
         value_divisors = { 'average': int(freq/1000), 'delta': 1 }
+        divisor = value_divisors[cf]
         
+        for kk,vv in self._xget_timerange(self.rates, path, freq,
+                ts_min, ts_max, column_count):
+            yield {'ts': kk, 'val': float(vv['val']) / divisor, 
+                    'is_valid': vv['is_valid']}
+
+    def query_baserate_timerange(self, path=None, freq=None, 
+            ts_min=None, ts_max=None, cf='average', column_count=None):
+        """
+        Query interface method to retrieve the base rates (generally average 
+        but could be delta as well).
+        """
         # Just return the results and format elsewhere.
-        results = []
-        
-        for k,v in ret.items():
-            for kk,vv in v.items():
-                results.append({'ts': kk, 'val': float(vv['val']) / value_divisors[cf], 
-                                        'is_valid': vv['is_valid']})
-            
-        return results
+        return list(self.iter_baserate_timerange(path=path, freq=freq,
+            ts_min=ts_min, ts_max=ts_max, cf=cf, column_count=column_count))
 
-    def query_aggregation_timerange(self, path=None, freq=None, 
+    def iter_aggregation_timerange(self, path=None, freq=None, 
                 ts_min=None, ts_max=None, cf=None, column_count=None):
         """
-        Query interface method to retrieve the aggregation rollups - could
-        be average/min/max.  Different column families will be queried 
-        depending on what value "cf" is set to.
+        Generator version of query_aggregation_timerange.
         """
                 
         if cf not in AGG_TYPES:
@@ -633,101 +1382,60 @@ class CASSANDRA_DB(object):
             cf = 'average'
         
         if cf == 'average' or cf == 'raw':
-            cols = column_count
-            if cols is None:
-                ret_count = self.aggs._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in ret_count.keys():
-                    cols += ret_count[i]
-                cols += 5
-
-            # print cols
-            ret = self.aggs._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-
-            # Just return the results and format elsewhere.
-            results = []
-            
-            for k,v in ret.items():
-                for kk,vv in v.items():
-                    ts = kk
-                    val = None
-                    base_freq = None
-                    count = None
-                    for kkk in vv.keys():
-                        if kkk == 'val':
-                            val = vv[kkk]
-                        else:
-                            base_freq = kkk
-                            count = vv[kkk]
-                    ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
-                    if cf == 'average':
-                        datum = {'ts': ts, 'val': ab.average, 'cf': ab.cf}
+            for kk,vv in self._xget_timerange(self.aggs, path, freq,
+                    ts_min, ts_max, column_count):
+                ts = kk
+                val = None
+                base_freq = None
+                count = None
+                for kkk in vv.keys():
+                    if kkk == 'val':
+                        val = vv[kkk]
                     else:
-                        datum = {'ts': ts, 'val': ab.val, 'cf': ab.cf}
-                    results.append(datum)
+                        base_freq = kkk
+                        count = vv[kkk]
+                ab = AggregationBin(**{'ts': ts, 'val': val,'base_freq': int(base_freq), 'count': count, 'cf': cf})
+                if cf == 'average':
+                    yield {'ts': ts, 'val': ab.average, 'cf': ab.cf}
+                else:
+                    yield {'ts': ts, 'val': ab.val, 'cf': ab.cf}
         elif cf == 'min' or cf == 'max':
-            cols = column_count
-            if cols is None:
-                ret_count = self.stat_agg._column_family.multiget_count(
-                        self._get_row_keys(path,freq,ts_min,ts_max),
-                        column_start=ts_min, column_finish=ts_max)
-                cols = 0
-                for i in ret_count.keys():
-                    cols += ret_count[i]
-                cols += 5
-
-            ret = self.stat_agg._column_family.multiget(
-                    self._get_row_keys(path,freq,ts_min,ts_max), 
-                    column_start=ts_min, column_finish=ts_max,
-                    column_count=cols)
-            
-            results = []
-
-            for k,v in ret.items():
-                for kk,vv in v.items():
-                    ts = kk
-                    if cf == 'min':
-                        datum = {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
-                        results.append(datum)
-                    else:
-                        datum = {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
-                        results.append(datum)
-        
-        return results
+            for kk,vv in self._xget_timerange(self.stat_agg, path, freq,
+                    ts_min, ts_max, column_count):
+                ts = kk
+                if cf == 'min':
+                    yield {'ts': ts, 'val': vv['min'], 'cf': cf, 'm_ts': vv.get('min_ts', None)}
+                else:
+                    yield {'ts': ts, 'val': vv['max'], 'cf': cf, 'm_ts': vv.get('max_ts', None)}
+
+    def query_aggregation_timerange(self, path=None, freq=None, 
+                ts_min=None, ts_max=None, cf=None, column_count=None):
+        """
+        Query interface method to retrieve the aggregation rollups - could
+        be average/min/max.  Different column families will be queried 
+        depending on what value "cf" is set to.
+        """
+        # Just return the results and format elsewhere.
+        return list(self.iter_aggregation_timerange(path=path, freq=freq,
+            ts_min=ts_min, ts_max=ts_max, cf=cf, column_count=column_count))
             
+    def iter_raw_data(self, path=None, freq=None,
+                ts_min=None, ts_max=None, column_count=None):
+        """
+        Generator version of query_raw_data.
+        """
+        for kk,vv in self._xget_timerange(self.raw_data, path, freq,
+                ts_min, ts_max, column_count):
+            yield {'ts': kk, 'val': json.loads(vv)}
+
     def query_raw_data(self, path=None, freq=None,
                 ts_min=None, ts_max=None, column_count=None):
         """
         Query interface to query the raw data.
         """
-        cols = column_count
-        if cols is None:
-            ret_count = self.raw_data._column_family.multiget_count(
-                    self._get_row_keys(path,freq,ts_min,ts_max),
-                    column_start=ts_min, column_finish=ts_max)
-            cols = 0
-            for i in ret_count.keys():
-                cols += ret_count[i]
-            cols += 5
-
-        ret = self.raw_data._column_family.multiget(
-                self._get_row_keys(path,freq,ts_min,ts_max), 
-                column_start=ts_min, column_finish=ts_max,
-                column_count=cols)
-
         # Just return the results and format elsewhere.
-        results = []
-
-        for k,v in ret.items():
-            for kk,vv in v.items():
-                results.append({'ts': kk, 'val': json.loads(vv)})
-        
-        return results
+        return list(self.iter_raw_data(path=path, freq=freq,
+            ts_min=ts_min, ts_max=ts_max, column_count=column_count))
 
     def query_raw_first(self, path=None, freq=None, year=None):
         """
@@ -767,6 +1475,190 @@ class CASSANDRA_DB(object):
 
 # Stats/timing code for connection class
 
+class LRUCache(object):
+    """
+    Dict-like cache that holds at most max_entries items and evicts the
+    least recently used entry when it is full.  A max_entries of zero or
+    None leaves the cache unbounded.
+
+    The contents can be written to/read from a binary snapshot file so
+    a restarted persister comes back up with a warm cache.
+    """
+
+    # 2: the metadata cache holds Metadata objects rather than dicts
+    _snapshot_version = 2
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._d = OrderedDict()
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, k):
+        return k in self._d
+
+    def has_key(self, k):
+        return k in self._d
+
+    def __getitem__(self, k):
+        # Move the entry to the most recently used end.
+        v = self._d.pop(k)
+        self._d[k] = v
+        return v
+
+    def __setitem__(self, k, v):
+        if k in self._d:
+            del self._d[k]
+        elif self.max_entries and len(self._d) >= self.max_entries:
+            self._d.popitem(last=False)
+            self.evictions += 1
+        self._d[k] = v
+
+    def __delitem__(self, k):
+        del self._d[k]
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def items(self):
+        return self._d.items()
+
+    def clear(self):
+        self._d.clear()
+
+    def save(self, path):
+        """
+        Write the cache contents to path.  The snapshot is written to a 
+        temporary file and renamed into place so a crash while writing 
+        does not leave a truncated snapshot behind.
+        """
+        d = os.path.dirname(path)
+        fd, tmp = tempfile.mkstemp(dir=d, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            pickle.dump((self._snapshot_version, time.time(), self._d.items()),
+                f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmp, path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def load(self, path, max_age=None):
+        """
+        Load entries from a snapshot written by save() and return the number
+        of entries loaded.  Snapshots older than max_age seconds are ignored
+        since the seek back will find better values at that point.
+        """
+        if not os.path.exists(path):
+            return 0
+
+        f = open(path, 'rb')
+        try:
+            version, saved, items = pickle.load(f)
+        finally:
+            f.close()
+
+        if version != self._snapshot_version:
+            return 0
+
+        if max_age and time.time() - saved > max_age:
+            return 0
+
+        # Items are in least to most recently used order so the most
+        # recently used entries survive if the snapshot is too big.
+        for k, v in items:
+            self[k] = v
+
+        return len(self)
+
+class MutationBatch(object):
+    """
+    Collects the mutations generated while processing a PollResult so
+    they can be handed to CASSANDRA_DB.send_batch() and written as one
+    grouped multi-row mutation per column family.
+
+    Rows are kept in the {row_key: {column: value}} form that pycassa
+    expects.  Counter increments to the same column are summed as they
+    are added and stat aggregation writes to the same column are merged.
+    When cassandra_rate_storage is absolute the rate and aggregation bins
+    hold totals, set with set_rate/set_agg, and a later value replaces
+    an earlier one.
+    The merged attribute counts the increments that were folded into an
+    existing column rather than needing a write of their own.
+    """
+    def __init__(self):
+        # raw rows are grouped by ttl since that is set per insert.
+        self.raw = {}
+        self.rates = {}
+        self.aggs = {}
+        self.stats = {}
+        self.merged = 0
+
+    def __len__(self):
+        return sum([len(x) for x in self.raw.values()]) + len(self.rates) + \
+            len(self.aggs) + len(self.stats)
+
+    def add_raw(self, key, ts, val, ttl=None):
+        self.raw.setdefault(ttl, {}).setdefault(key, {})[ts] = val
+
+    def _incr(self, rows, key, ts, cols):
+        row = rows.setdefault(key, {})
+        if ts in row:
+            self.merged += 1
+            scol = row[ts]
+        else:
+            scol = row[ts] = {}
+        for k, v in cols.iteritems():
+            scol[k] = scol.get(k, 0) + v
+
+    def incr_rate(self, key, ts, val, is_valid):
+        self._incr(self.rates, key, ts, {'val': val, 'is_valid': is_valid})
+
+    def incr_agg(self, key, ts, val, base_freq):
+        self._incr(self.aggs, key, ts, {'val': val, str(base_freq): 1})
+
+    def merge_counters(self, other):
+        """Add the rate and aggregation increments of another batch."""
+        for rows, other_rows in ((self.rates, other.rates),
+                (self.aggs, other.aggs)):
+            for key, cols in other_rows.iteritems():
+                for ts, scol in cols.iteritems():
+                    self._incr(rows, key, ts, scol)
+
+    def _set(self, rows, key, ts, cols):
+        row = rows.setdefault(key, {})
+        if ts in row:
+            self.merged += 1
+        row[ts] = cols
+
+    def set_rate(self, key, ts, cols):
+        """Set the absolute value of a base rate bin."""
+        self._set(self.rates, key, ts, cols)
+
+    def set_agg(self, key, ts, cols):
+        """Set the absolute value of a rate aggregation bin."""
+        self._set(self.aggs, key, ts, cols)
+
+    def merge_totals(self, other):
+        """Take the absolute rate and aggregation values of a newer batch."""
+        for rows, other_rows in ((self.rates, other.rates),
+                (self.aggs, other.aggs)):
+            for key, cols in other_rows.iteritems():
+                for ts, scol in cols.iteritems():
+                    self._set(rows, key, ts, scol)
+
+    def set_stat(self, key, cols):
+        row = self.stats.setdefault(key, {})
+        for ts, scol in cols.iteritems():
+            row.setdefault(ts, {}).update(scol)
+
 class DatabaseMetrics(object):
     """
     Code to handle calculating timing statistics for discrete database
@@ -782,12 +1674,19 @@ class DatabaseMetrics(object):
         'meta_fetch',
         'stat_fetch', 
         'stat_update',
+        'batch_send',
     ]
     _all_metrics = _individual_metrics + ['total', 'all']
     
     def __init__(self, profiling=False):
         
         self.profiling = profiling
+
+        # Stat aggregation writes held back by the stat checkpointing and
+        # the number of bins written in their place.  These are kept
+        # whether or not profiling is on.
+        self.deferred_stats = 0
+        self.written_stats = 0
         
         if not self.profiling:
             return
@@ -824,6 +1723,20 @@ class DatabaseMetrics(object):
 
     def stat_update(self, t):
         self._increment('stat_update', t)
+
+    def batch_send(self, t):
+        self._increment('batch_send', t)
+
+    def stat_deferred(self):
+        self.deferred_stats += 1
+
+    def stat_written(self, n):
+        self.written_stats += n
+
+    @property
+    def stat_mutations_avoided(self):
+        """Number of stat aggregation writes saved by checkpointing."""
+        return self.deferred_stats - self.written_stats
         
     def report(self, metric='all'):
         """
@@ -872,6 +1785,8 @@ class DatabaseMetrics(object):
                     continue
                 else:
                     self.report(m)
+            s = 'Avoided %s stat aggregation writes' % \
+                self.stat_mutations_avoided
                     
         if len(s): print s
 
@@ -884,8 +1799,14 @@ class DataContainerBase(object):
     """
     Base class for the other encapsulation objects.  Mostly provides 
     utility methods for subclasses.
+
+    The containers use __slots__ since the persister keeps one Metadata
+    per series in its cache and creates several of the others per
+    sample.  Subclasses must list any attributes they add in __slots__.
     """
     
+    __slots__ = ('path',)
+
     _doc_properties = []
     
     def __init__(self, path):
@@ -906,10 +1827,11 @@ class DataContainerBase(object):
         Return a dictionary of the attrs/props in the object.
         """
         doc = {}
-        for k,v in self.__dict__.items():
-            if k.startswith('_'):
-                continue
-            doc[k] = v
+        for cls in type(self).__mro__:
+            for k in getattr(cls, '__slots__', ()):
+                if k.startswith('_'):
+                    continue
+                doc[k] = getattr(self, k)
             
         for p in self._doc_properties:
             doc[p] = getattr(self, '%s' % p)
@@ -948,6 +1870,8 @@ class RawData(DataContainerBase):
     Can be instantiated from args when reading from persist queue, or via **kw
     when reading data back out of Cassandra.
     """
+    __slots__ = ('_ts', 'val')
+
     _doc_properties = ['ts']
 
     def __init__(self, path=None, ts=None, val=None):
@@ -979,6 +1903,8 @@ class RawRateData(RawData):
     """
     Container for raw data for rate based rows.
     """
+    __slots__ = ('freq',)
+
     _doc_properties = ['ts']
 
     def __init__(self, path=None, ts=None, val=None, freq=None):
@@ -1023,6 +1949,8 @@ class Metadata(DataContainerBase):
     Container for metadata information.
     """
     
+    __slots__ = ('_min_ts', '_last_update', 'last_val', 'freq')
+
     _doc_properties = ['min_ts', 'last_update']
     
     def __init__(self, path=None, last_update=None, last_val=None, min_ts=None, freq=None):
@@ -1075,6 +2003,8 @@ class BaseRateBin(RawRateData):
     Container for base rates.  Has 'average' property to return the averages.
     """
     
+    __slots__ = ('is_valid',)
+
     _doc_properties = ['ts']
     
     def __init__(self, path=None, ts=None, val=None, freq=None, is_valid=1):
@@ -1091,6 +2021,8 @@ class AggregationBin(BaseRateBin):
     Container for aggregation rollups.  Also has 'average' property to generage averages.
     """
     
+    __slots__ = ('count', 'min', 'max', 'base_freq', 'cf')
+
     def __init__(self, path=None, ts=None, val=None, freq=None, base_freq=None, count=None, 
             min=None, max=None, cf=None):
         BaseRateBin.__init__(self, path, ts, val, freq)
@@ -1113,15 +2045,10 @@ def escape_path(path):
 
     return escaped
 
-def get_rowkey(path, freq=None, year=None):
+def build_rowkey(path, freq=None, year=None):
     """
-    Given a path and some additional data build the Cassandra row key.
-
-    The freq and year arguments are used for internal book keeping inside
-    Cassandra.
+    Build the Cassandra row key for a path without the RowKeyCache.
     """
-
-
     appends = []
     if freq:
         appends.append(str(freq))
@@ -1130,6 +2057,78 @@ def get_rowkey(path, freq=None, year=None):
 
     return KEY_DELIMITER.join(escape_path(path) + appends)
 
+class RowKeyCache(object):
+    """
+    Memoizes row keys.  The same few thousand paths are turned into row
+    keys for every poll and query so the escaped path prefix of each path
+    and the row key of each (path, freq, year) are kept rather than
+    escaped and joined again.
+
+    Each dict is simply emptied when it reaches max_entries, which keeps
+    lookups to a single dict access and is cheap to refill.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.prefixes = {}
+        self.keys = {}
+        self.resets = 0
+
+    def prefix(self, path):
+        """Return the escaped and joined path."""
+        path = tuple(path)
+        try:
+            return self.prefixes[path]
+        except KeyError:
+            pass
+
+        if len(self.prefixes) >= self.max_entries:
+            self.prefixes.clear()
+            self.resets += 1
+
+        prefix = KEY_DELIMITER.join(escape_path(path))
+        self.prefixes[path] = prefix
+        return prefix
+
+    def get(self, path, freq=None, year=None):
+        """Return the same row key as build_rowkey()."""
+        k = (tuple(path), freq, year)
+        try:
+            return self.keys[k]
+        except KeyError:
+            pass
+
+        parts = []
+        if path:
+            parts.append(self.prefix(path))
+        if freq:
+            parts.append(str(freq))
+        if year:
+            parts.append(str(year))
+
+        if len(self.keys) >= self.max_entries:
+            self.keys.clear()
+            self.resets += 1
+
+        key = KEY_DELIMITER.join(parts)
+        self.keys[k] = key
+        return key
+
+    def clear(self):
+        self.prefixes.clear()
+        self.keys.clear()
+
+_rowkey_cache = RowKeyCache()
+
+def get_rowkey(path, freq=None, year=None):
+    """
+    Given a path and some additional data build the Cassandra row key.
+
+    The freq and year arguments are used for internal book keeping inside
+    Cassandra.  Keys come from the process wide RowKeyCache.
+    """
+    return _rowkey_cache.get(path, freq, year)
+
 def _split_rowkey(s, escape='\\'):
     """
     Return the elements of the rowkey taking escaping into account.
@@ -50,14 +50,18 @@ class EsmondConfig(object):
         self.agg_tsdb_root = None
         self.allowed_hosts = []
         self.api_anon_limit = None
+        self.api_bulk_concurrency = 8
         self.api_throttle_at = None
         self.api_throttle_timeframe = None
         self.api_throttle_expiration = None
         self.cassandra_keyspace = 'esmond'
         self.cassandra_pass = None
+        self.cassandra_rate_storage = 'counter'
         self.cassandra_servers = []
         self.cassandra_user = None
         self.cassandra_replicas = 1
+        self.counter_flush_interval = 0
+        self.counter_flush_rows = 100000
         # Leave this here so testing code can explicitly set but remove
         # from config file parsing.
         self.db_clear_on_testing = False
@@ -71,20 +75,43 @@ class EsmondConfig(object):
         self.espoll_persist_uri = None
         self.htpasswd_file = None
         self.mib_dirs = []
+        self.metadata_cache_size = 1000000
+        self.metadata_prefetch_threads = 4
+        self.metadata_snapshot_dir = None
+        self.metadata_snapshot_max_age = 60*60
         self.mibs = []
+        self.persist_queue_dir = None
+        self.persist_queue_fsync = 'interval'
+        self.persist_queue_fsync_interval = 1
+        self.persist_queue_segment_size = 64*1024*1024
         self.pid_dir = None
+        self.poll_align = False
+        self.poll_correlator_refresh = 0
+        self.poll_jitter = 0.0
         self.poll_retries = 5
+        self.poll_shards = 1
+        self.poll_stats_dir = None
         self.poll_timeout = 2
         self.profile_persister = False
+        self.query_cache_dir = None
+        self.query_cache_min_age = 60*60
+        self.query_cache_size = 256
         self.reload_interval = 1*10
         self.rrd_path = None
         self.send_error_email = False
+        self.snmp_max_inflight = 1000
+        self.snmp_max_repetitions = 100
+        self.snmp_window = 4
+        self.spill_dir = None
+        self.spill_max_pending = 1000
+        self.spill_replay_rate = 5000
         self.sql_db_engine = ''
         self.sql_db_host = ''
         self.sql_db_name = ''
         self.sql_db_password = ''
         self.sql_db_port = ''
         self.sql_db_user = ''
+        self.stat_checkpoint_interval = 0
         self.streaming_log_dir = None
         self.syslog_facility = None
         self.syslog_priority = None
@@ -111,12 +138,16 @@ class EsmondConfig(object):
                 'agg_tsdb_root',
                 'allowed_hosts',
                 'api_anon_limit',
+                'api_bulk_concurrency',
                 'api_throttle_at',
                 'api_throttle_timeframe',
                 'api_throttle_expiration',
                 'cassandra_pass',
+                'cassandra_rate_storage',
                 'cassandra_servers',
                 'cassandra_user',
+                'counter_flush_interval',
+                'counter_flush_rows',
                 'db_profile_on_testing',
                 'db_uri',
                 'debug',
@@ -127,20 +158,43 @@ class EsmondConfig(object):
                 'espersistd_uri',
                 'espoll_persist_uri',
                 'htpasswd_file',
+                'metadata_cache_size',
+                'metadata_prefetch_threads',
+                'metadata_snapshot_dir',
+                'metadata_snapshot_max_age',
                 'mib_dirs',
                 'mibs',
+                'persist_queue_dir',
+                'persist_queue_fsync',
+                'persist_queue_fsync_interval',
+                'persist_queue_segment_size',
                 'pid_dir',
+                'poll_align',
+                'poll_correlator_refresh',
+                'poll_jitter',
                 'poll_retries',
+                'poll_shards',
+                'poll_stats_dir',
                 'poll_timeout',
                 'profile_persister',
+                'query_cache_dir',
+                'query_cache_min_age',
+                'query_cache_size',
                 'reload_interval',
                 'rrd_path',
+                'snmp_max_inflight',
+                'snmp_max_repetitions',
+                'snmp_window',
+                'spill_dir',
+                'spill_max_pending',
+                'spill_replay_rate',
                 'sql_db_engine',
                 'sql_db_host',
                 'sql_db_name',
                 'sql_db_password',
                 'sql_db_port',
                 'sql_db_user',
+                'stat_checkpoint_interval',
                 'streaming_log_dir',
                 'syslog_facility',
                 'syslog_priority',
@@ -155,6 +209,7 @@ class EsmondConfig(object):
             'db_profile_on_testing',
             'profile_persister',
             'debug',
+            'poll_align',
         )
 
         for key, val in cfg.items('main'):
@@ -167,10 +222,31 @@ class EsmondConfig(object):
             self.persist_map[key] = val.replace(" ", "").split(",")
 
         self.persist_queues = {}
+        self.persist_queue_types = {}
         for key, val in cfg.items("persist_queues"):
             if key == 'esmond_root': continue
-            self.persist_queues[key] = val.split(':', 1)
-            self.persist_queues[key][1] = int(self.persist_queues[key][1])
+            # PersisterClass:nworkers[:queue_type]
+            parts = val.split(':')
+            self.persist_queues[key] = [parts[0], int(parts[1])]
+            if len(parts) > 2:
+                qtype = parts[2].strip()
+            else:
+                qtype = 'memcached'
+            if qtype not in ('memcached', 'segment'):
+                raise ConfigError("invalid config: unknown queue type %s for %s" %
+                        (qtype, key))
+            self.persist_queue_types[key] = qtype
+
+        # Optional: the format used to write results to each queue.
+        self.persist_queue_serializers = {}
+        if cfg.has_section("persist_serializers"):
+            for key, val in cfg.items("persist_serializers"):
+                if key == 'esmond_root': continue
+                val = val.strip()
+                if val not in ('json', 'binary'):
+                    raise ConfigError("invalid config: unknown serializer %s for %s" %
+                            (val, key))
+                self.persist_queue_serializers[key] = val
 
         if self.espoll_persist_uri:
             self.espoll_persist_uri = \
@@ -189,20 +265,70 @@ class EsmondConfig(object):
             self.mibs = map(str.strip, self.mibs.split(','))
         if self.cassandra_servers:
             self.cassandra_servers = map(str.strip, self.cassandra_servers.split(','))
+        if self.cassandra_rate_storage not in ('counter', 'absolute'):
+            raise ConfigError("invalid config: unknown cassandra_rate_storage %s" %
+                    self.cassandra_rate_storage)
         if self.poll_timeout:
             self.poll_timeout = int(self.poll_timeout)
         if self.poll_retries:
             self.poll_retries = int(self.poll_retries)
+        if self.poll_shards:
+            self.poll_shards = int(self.poll_shards)
+        if self.poll_correlator_refresh:
+            self.poll_correlator_refresh = int(self.poll_correlator_refresh)
+        if self.poll_jitter:
+            self.poll_jitter = float(self.poll_jitter)
+            if not 0 <= self.poll_jitter <= 1:
+                raise ConfigError("invalid config: poll_jitter must be "
+                        "between 0 and 1: %s" % self.poll_jitter)
         if self.reload_interval:
             self.reload_interval = int(self.reload_interval)
+        if self.query_cache_min_age:
+            self.query_cache_min_age = int(self.query_cache_min_age)
+        if self.query_cache_size:
+            self.query_cache_size = int(self.query_cache_size)
+        if self.snmp_max_inflight:
+            self.snmp_max_inflight = int(self.snmp_max_inflight)
+        if self.snmp_max_repetitions:
+            self.snmp_max_repetitions = int(self.snmp_max_repetitions)
+        if self.snmp_window:
+            self.snmp_window = int(self.snmp_window)
+        if self.spill_max_pending:
+            self.spill_max_pending = int(self.spill_max_pending)
+            if self.spill_max_pending < 0:
+                raise ConfigError("invalid config: spill_max_pending must "
+                        "not be negative: %s" % self.spill_max_pending)
+        if self.spill_replay_rate:
+            self.spill_replay_rate = int(self.spill_replay_rate)
         if self.api_anon_limit:
             self.api_anon_limit = int(self.api_anon_limit)
+        if self.api_bulk_concurrency:
+            self.api_bulk_concurrency = int(self.api_bulk_concurrency)
         if self.api_throttle_at:
              self.api_throttle_at = int(self.api_throttle_at)
         if self.api_throttle_timeframe:
             self.api_throttle_timeframe = int(self.api_throttle_timeframe)
         if self.api_throttle_expiration:
             self.api_throttle_expiration = int(self.api_throttle_expiration)
+        if self.metadata_cache_size:
+            self.metadata_cache_size = int(self.metadata_cache_size)
+        if self.counter_flush_interval:
+            self.counter_flush_interval = int(self.counter_flush_interval)
+        if self.counter_flush_rows:
+            self.counter_flush_rows = int(self.counter_flush_rows)
+        if self.stat_checkpoint_interval:
+            self.stat_checkpoint_interval = int(self.stat_checkpoint_interval)
+        if self.persist_queue_fsync_interval:
+            self.persist_queue_fsync_interval = int(self.persist_queue_fsync_interval)
+        if self.persist_queue_segment_size:
+            self.persist_queue_segment_size = int(self.persist_queue_segment_size)
+        if self.persist_queue_fsync not in ('always', 'interval', 'never'):
+            raise ConfigError("invalid config: unknown persist_queue_fsync %s" %
+                    self.persist_queue_fsync)
+        if self.metadata_prefetch_threads:
+            self.metadata_prefetch_threads = int(self.metadata_prefetch_threads)
+        if self.metadata_snapshot_max_age:
+            self.metadata_snapshot_max_age = int(self.metadata_snapshot_max_age)
 
 
 
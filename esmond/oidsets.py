@@ -0,0 +1,153 @@
+"""
+Process wide cache of the OIDSet configuration used by the pollers and
+persisters.
+
+The OIDSets and their OIDs are read from the database in a few queries
+and turned into immutable OIDSetInfo/OIDInfo descriptors with the
+poller_args already parsed.  Looking an OIDSet up in the cache costs a
+dict lookup rather than an ORM query on every poll or PollResult.
+
+Calling load() again re-reads the tables.  Only the descriptors of
+OIDSets that changed are replaced and the cache version is bumped if
+anything changed, so holders of a descriptor can tell that it is stale.
+A name that is not in the cache is looked for in the database at most
+once every reload_interval seconds.
+"""
+
+import time
+
+from collections import namedtuple
+
+from esmond.api.models import OIDSet, OIDSetMember
+
+OIDInfo = namedtuple('OIDInfo', ['name', 'aggregate', 'oid_type',
+    'endpoint_alias'])
+
+OIDSetInfo = namedtuple('OIDSetInfo', ['name', 'frequency', 'frequency_ms',
+    'ttl', 'aggregates', 'set_name', 'poller', 'poller_args', 'oids'])
+
+class FrozenDict(dict):
+    """A dict that can't be changed after it is created."""
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+def parse_poller_args(poller_args):
+    """Parse an OIDSet poller_args string of space separated key=value
+    pairs into a dict."""
+    d = {}
+    if poller_args:
+        for arg in poller_args.split():
+            (k, v) = arg.split('=')
+            d[k] = v
+    return d
+
+def make_oidset_info(oidset, oids):
+    """Build the OIDSetInfo for an OIDSet model instance and a list of
+    OIDInfos."""
+    return OIDSetInfo(
+        name=oidset.name,
+        frequency=oidset.frequency,
+        frequency_ms=oidset.frequency_ms,
+        ttl=oidset.ttl,
+        aggregates=tuple(oidset.aggregates),
+        set_name=oidset.set_name,
+        poller=oidset.poller.name,
+        poller_args=FrozenDict(parse_poller_args(oidset.poller_args)),
+        oids=tuple(sorted(oids, key=lambda o: o.name)),
+    )
+
+class OIDSetCache(object):
+    """Cache of OIDSetInfo descriptors keyed by OIDSet name.
+
+    The oidsets and oids attributes are replaced rather than changed in
+    place by load() so readers never see a half loaded cache."""
+    def __init__(self, reload_interval=10):
+        self.version = 0
+        self.oidsets = {}
+        self.oids = {}
+        self.last_load = None
+        self.reload_interval = reload_interval
+        # time of the load() each unknown (attr, name) was last looked for in
+        self.missed = {}
+
+    def load(self):
+        """Read the OIDSets from the database and replace the descriptors
+        that have changed.  Returns the number of OIDSets added, changed or
+        removed."""
+        members = {}
+        for m in OIDSetMember.objects.select_related('oid', 'oid__oid_type'):
+            members.setdefault(m.oid_set_id, []).append(OIDInfo(
+                name=m.oid.name, aggregate=m.oid.aggregate,
+                oid_type=m.oid.oid_type.name,
+                endpoint_alias=m.oid.endpoint_alias))
+
+        oidsets = {}
+        oids = {}
+        changed = 0
+
+        for oidset in OIDSet.objects.select_related('poller'):
+            info = make_oidset_info(oidset, members.get(oidset.id, []))
+            old = self.oidsets.get(info.name)
+            if old == info:
+                info = old
+            else:
+                changed += 1
+            oidsets[info.name] = info
+            for oid in info.oids:
+                oids[oid.name] = oid
+
+        changed += len(set(self.oidsets) - set(oidsets))
+
+        self.oidsets = oidsets
+        self.oids = oids
+        self.last_load = time.time()
+        self.missed = dict([(k, t) for k, t in self.missed.iteritems()
+            if self.last_load < t + self.reload_interval])
+        if changed:
+            self.version += 1
+
+        return changed
+
+    def refresh(self, max_age):
+        """load() if the cache is more than max_age seconds old."""
+        if self.last_load is None or time.time() > self.last_load + max_age:
+            return self.load()
+        return 0
+
+    def _lookup(self, attr, name):
+        try:
+            return getattr(self, attr)[name]
+        except KeyError:
+            pass
+
+        # Only reload for a name that hasn't missed recently, otherwise
+        # every result for an unknown OIDSet would re-read the tables.
+        missed = self.missed.get((attr, name))
+        if missed is not None and time.time() < missed + self.reload_interval:
+            raise KeyError(name)
+
+        self.load()
+        try:
+            return getattr(self, attr)[name]
+        except KeyError:
+            self.missed[(attr, name)] = self.last_load
+            raise
+
+    def get(self, name):
+        """Return the OIDSetInfo for name, loading the cache if it has not
+        been loaded or name is not in it and hasn't missed in the last
+        reload_interval seconds.  Raises KeyError for unknown OIDSets."""
+        return self._lookup('oidsets', name)
+
+    def get_oid(self, name):
+        """Return the OIDInfo for the OID called name."""
+        return self._lookup('oids', name)
+
+_oidset_cache = OIDSetCache()
+
+def get_oidset_cache():
+    """Return the process wide OIDSetCache."""
+    return _oidset_cache
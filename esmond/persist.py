@@ -8,6 +8,7 @@ import time
 import signal
 import errno
 import datetime
+import functools
 import cProfile
 import pstats
 import __main__
@@ -35,12 +36,18 @@ from esmond.util import setproctitle, init_logging, get_logger, \
 from esmond.util import daemonize, setup_exc_handler, max_datetime
 from esmond.config import get_opt_parser, get_config, get_config_path
 from esmond.error import ConfigError
-from esmond.api.dataseries import fit_to_bins
+from esmond.api import dataseries
+from esmond.api.dataseries import fit_to_bins, fit_to_bins_batch
+from esmond.oidsets import get_oidset_cache
 
-from esmond.api.models import Device, OIDSet, IfRef, ALUSAPRef, LSPOpStatus, \
+from esmond.api.models import Device, IfRef, ALUSAPRef, LSPOpStatus, \
                               OutletRef
 
-from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin, AggregationBin, MaximumRetryException
+from esmond.cassandra import CASSANDRA_DB, RawRateData, BaseRateBin, AggregationBin, \
+     MaximumRetryException, MutationBatch
+from esmond.segmentlog import SegmentLog
+from esmond import serialization
+from esmond.serialization import JSONResultSerializer, get_serializer
 
 
 try:
@@ -54,6 +61,9 @@ except ImportError:
 PERSIST_SLEEP_TIME = 1
 HEARTBEAT_FREQ_MULTIPLIER = 3
 
+# Compares unequal to anything, for attributes a history table row lacks.
+_missing = object()
+
 class PollResult(object):
     """PollResult contains the results of a polling run.
 
@@ -96,14 +106,17 @@ class PollResult(object):
         """Produce a pickle which represents this ``PollResult``."""
         return pickle.dumps(self)
 
-    def json(self):
-        return json.dumps(dict(
+    def as_dict(self):
+        return dict(
             oidset_name=self.oidset_name,
             device_name=self.device_name,
             oid_name=self.oid_name,
             timestamp=self.timestamp,
             data=self.data,
-            metadata=self.metadata))
+            metadata=self.metadata)
+
+    def json(self):
+        return json.dumps(self.as_dict())
 
 class PersistQueueEmpty:
     pass
@@ -111,6 +124,8 @@ class PersistQueueEmpty:
 class PollPersister(object):
     """A PollPersister implements a storage method for PollResults."""
     STATS_INTERVAL = 60
+    # Max number of PollResults taken from the queue at a time.
+    BATCH_SIZE = 100
 
     def __init__(self, config, qname, persistq):
         self.log = get_logger("espersistd.%s" % qname)
@@ -130,11 +145,35 @@ class PollPersister(object):
     def store(self, result):
         pass
 
+    def store_batch(self, results):
+        """Store a list of PollResults taken from the queue together.
+        Can be overridden in subclasses that can do better than storing
+        them one at a time."""
+        for result in results:
+            self.store(result)
+
     def flush(self):
         """Can be overridden in subclasses if one wishes to perform
         some maintenance during a sleep state."""
         pass
 
+    def idle(self):
+        """Can be overridden in subclasses to do work on every pass that
+        finds the queue empty, unlike flush() which is only called on the
+        first one."""
+        pass
+
+    def backpressure(self):
+        """Can be overridden in subclasses to stop taking work from the
+        queue until they have caught up.  flush() is called while
+        waiting."""
+        return False
+
+    def log_stats(self):
+        self.log.info("%d records written, %f records/sec" % \
+                (self.data_count,
+                    float(self.data_count) / self.STATS_INTERVAL))
+
     def stop(self, x, y):
         self.log.debug("stop")
         self.running = False
@@ -150,36 +189,36 @@ class PollPersister(object):
             pr.enable()
 
         while self.running:
+            if self.backpressure():
+                self.flush()
+                time.sleep(PERSIST_SLEEP_TIME)
+                continue
+
             try:
-                task = self.persistq.get()
+                tasks = self.persistq.get_many(self.BATCH_SIZE,
+                        timeout=PERSIST_SLEEP_TIME)
             except PersistQueueEmpty:
                 break
 
-            # XXX(jdugan): task can be None for two reasons here:
-            # 1. there was no result
-            # 2. the result was None
-            # this means that Nones are consumed very slowly, this should be
-            # revisited.
-
-            if task:
-                self.store(task)
-                self.data_count += len(task.data)
+            if tasks:
+                self.store_batch(tasks)
+                for task in tasks:
+                    self.data_count += len(task.data)
                 now = time.time()
                 if now > self.last_stats + self.STATS_INTERVAL:
-                    self.log.info("%d records written, %f records/sec" % \
-                            (self.data_count,
-                                float(self.data_count) / self.STATS_INTERVAL))
+                    self.log_stats()
                     self.data_count = 0
                     self.last_stats = now
-                del task
+                del tasks
                 self.sleeping = False
             else:
+                # get_many() has already waited PERSIST_SLEEP_TIME for work.
                 if not self.sleeping:
                     self.flush()
                     self.sleeping = True
                     if self.config.debug:
                         django.db.reset_queries()
-                time.sleep(PERSIST_SLEEP_TIME)
+                self.idle()
 
         if self.config.profile_persister:
             pr.disable()
@@ -243,37 +282,26 @@ if tsdb:
 
             self.tsdb = tsdb.TSDB(self.config.tsdb_root)
 
-            self.oidsets = {}
-            self.poller_args = {}
-            self.oids = {}
+            self.oidsets = get_oidset_cache()
+            self.oidsets.reload_interval = config.reload_interval
+            self.oidsets.load()
             self.oid_type_map = {}
 
-            oidsets = OIDSet.objects.all()
-
-            for oidset in oidsets:
-                self.oidsets[oidset.name] = oidset
-                d = {}
-                if oidset.poller_args:
-                    for arg in oidset.poller_args.split():
-                        (k, v) = arg.split('=')
-                        d[k] = v
-                    self.poller_args[oidset.name] = d
-
-                for oid in oidset.oids.all():
-                    self.oids[oid.name] = oid
+            for oidset in self.oidsets.oidsets.itervalues():
+                for oid in oidset.oids:
                     try:
                         self.oid_type_map[oid.name] = eval("tsdb.row.%s" % \
-                                oid.oid_type.name)
+                                oid.oid_type)
                     except AttributeError:
                         self.log.warning(
                                 "warning don't have a TSDBRow for %s in %s" %
-                                (oid.oid_type.name, oidset.name))
+                                (oid.oid_type, oidset.name))
 
         def store(self, result):
-            oidset = self.oidsets[result.oidset_name]
-            set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
+            oidset = self.oidsets.get(result.oidset_name)
+            set_name = oidset.set_name
             basename = os.path.join(result.device_name, set_name)
-            oid = self.oids[result.oid_name]
+            oid = self.oidsets.get_oid(result.oid_name)
             flags = result.metadata['tsdb_flags']
 
             var_type = self.oid_type_map[oid.name]
@@ -314,7 +342,7 @@ if tsdb:
 
         def _create_var(self, var_type, var, oidset, oid):
             self.log.debug("creating TSDBVar: %s" % str(var))
-            chunk_mapper = eval(self.poller_args[oidset.name]['chunk_mapper'])
+            chunk_mapper = eval(oidset.poller_args['chunk_mapper'])
 
             tsdb_var = self.tsdb.add_var(var, var_type,
                     oidset.frequency, chunk_mapper)
@@ -327,7 +355,7 @@ if tsdb:
             return tsdb_var
 
         def _create_agg(self, tsdb_var, oidset, period):
-            chunk_mapper = eval(self.poller_args[oidset.name]['chunk_mapper'])
+            chunk_mapper = eval(oidset.poller_args['chunk_mapper'])
             if period == oidset.frequency:
                 aggs = ['average', 'delta']
             else:
@@ -341,14 +369,12 @@ if tsdb:
         def _create_aggs(self, tsdb_var, oidset):
             self._create_agg(tsdb_var, oidset, oidset.frequency)
 
-            if 'aggregates' in self.poller_args[oidset.name]:
-                aggregates = self.poller_args[oidset.name]['aggregates'].split(',')
-                for agg in aggregates:
-                    self._create_agg(tsdb_var, oidset, int(agg))
+            for agg in oidset.aggregates:
+                self._create_agg(tsdb_var, oidset, agg)
 
         def _repair_var_metadata(self, var_type, var, oidset, oid):
             self.log.error("var needs repair, skipping: %s" % var)
-            #chunk_mapper = eval(self.poller_args[oidset.name]['chunk_mapper'])
+            #chunk_mapper = eval(oidset.poller_args['chunk_mapper'])
 
         def _aggregate(self, tsdb_var, var_name, timestamp, uptime_name, oidset):
             try:
@@ -397,6 +423,15 @@ class CassandraPollPersister(PollPersister):
 
     """
 
+    # Collect the mutations for a whole PollResult and send them as one
+    # grouped batch per column family.  Set to False to write var by var.
+    batch_writes = True
+    # store_batch() sends the batch early once it holds this many rows.
+    max_batch_rows = 50000
+    # Results with at least this many vars to aggregate have their base
+    # rate bins computed in one pass with fit_to_bins_batch (needs numpy).
+    batch_fit_min_vars = 32
+
     def __init__(self, config, qname, persistq):
         PollPersister.__init__(self, config, qname, persistq)
         # The clear on testing arg - set in the config file if the
@@ -408,23 +443,15 @@ class CassandraPollPersister(PollPersister):
 
         self.ns = "snmp"
 
-        self.oidsets = {}
-        self.poller_args = {}
-        self.oids = {}
-
-        oidsets = OIDSet.objects.all()
+        # OIDSet descriptors from the process wide cache, reloaded every
+        # reload_interval seconds.
+        self.oidsets = get_oidset_cache()
+        self.oidsets.reload_interval = config.reload_interval
+        self.oidsets.load()
 
-        for oidset in oidsets:
-            self.oidsets[oidset.name] = oidset
-            d = {}
-            if oidset.poller_args:
-                for arg in oidset.poller_args.split():
-                    (k, v) = arg.split('=')
-                    d[k] = v
-                self.poller_args[oidset.name] = d
-
-            for oid in oidset.oids.all():
-                self.oids[oid.name] = oid
+        # Set while the spill journal is being replayed after growing
+        # past spill_max_pending, see backpressure().
+        self.spill_full = False
 
     def flush(self):
         self.log.debug('flush state called.')
@@ -432,16 +459,94 @@ class CassandraPollPersister(PollPersister):
             self.db.flush()
         except MaximumRetryException:
             self.log.warn("flush failed. MaximumRetryException")
+        self.db.replay_spill()
+
+    def idle(self):
+        # Keep replaying the spill journal while there is nothing to do.
+        self.db.replay_spill()
+
+    def backpressure(self):
+        """Stop taking results from the queue once the spill journal holds
+        spill_max_pending records and until it has all been replayed.  They
+        are safer in the queue than spilled behind a failing cluster.  A
+        spill_max_pending of 0 turns this off."""
+        if self.db.spill is None or not self.config.spill_max_pending:
+            return False
+
+        pending = self.db.spill_pending()
+        if not self.spill_full and pending >= self.config.spill_max_pending:
+            self.log.warn('%d spilled writes pending, not taking more work'
+                % pending)
+            self.spill_full = True
+        elif self.spill_full and not pending:
+            self.log.info('spill journal empty, taking work again')
+            self.spill_full = False
+        return self.spill_full
+
+    def log_stats(self):
+        PollPersister.log_stats(self)
+        if self.db.spill is not None:
+            self.log.info("spill: %d records pending, %d rows spilled, "
+                "%d rows replayed" % (self.db.spill_pending(),
+                    self.db.spilled_rows, self.db.replayed_rows))
 
     def store(self, result):
-        oidset = self.oidsets[result.oidset_name]
-        set_name = self.poller_args[oidset.name].get('set_name', oidset.name)
+        # All of the mutations for this result are collected and sent to
+        # cassandra together at the end rather than var by var.
+        if self.batch_writes:
+            batch = MutationBatch()
+        else:
+            batch = None
+
+        self._store(result, batch)
+
+        if batch is not None:
+            self.db.send_batch(batch)
+        else:
+            self.db.flush_counters()
+
+        self.db.checkpoint_stats()
+        self.db.replay_spill()
+
+    def store_batch(self, results):
+        if not self.batch_writes:
+            PollPersister.store_batch(self, results)
+            return
+
+        # Collect the mutations for all of the results and send them
+        # together, sending early if the batch gets too big.
+        batch = MutationBatch()
+
+        for result in results:
+            self._store(result, batch)
+            if len(batch) >= self.max_batch_rows:
+                self.db.send_batch(batch)
+                batch = MutationBatch()
+
+        self.db.send_batch(batch)
+        self.db.checkpoint_stats()
+        self.db.replay_spill()
+
+    def _store(self, result, batch):
+        self.oidsets.refresh(self.config.reload_interval)
+        oidset = self.oidsets.get(result.oidset_name)
+        set_name = oidset.set_name
         basepath = [self.ns, result.device_name, set_name]
-        oid = self.oids[result.oid_name]
+        oid = self.oidsets.get_oid(result.oid_name)
         
         t0 = time.time()
         nvar = 0
 
+        # These are the same for every var in the result so only work 
+        # them out once.
+        ts = result.timestamp * 1000
+        freq_ms = oidset.frequency_ms
+        ttl = oidset.ttl
+        aggregates = oidset.aggregates
+        agg_timestamps = None
+
+        raw_data_list = []
+
         for var, val in result.data:
             if set_name == "SparkySet": # This is pure hack. A new row type should be created for floats
                 val = float(val) * 100
@@ -455,16 +560,26 @@ class CassandraPollPersister(PollPersister):
                 continue
                 
             # Create data encapsulation object (defined in cassandra.py 
-            # module) and store the raw input.
-
-            raw_data = RawRateData(path=var_path, ts=result.timestamp * 1000,
-                    val=val, freq=oidset.frequency_ms)
+            # module).
+            raw_data_list.append(RawRateData(path=var_path, ts=ts, val=val,
+                freq=freq_ms))
+
+        # Look up the metadata for any vars not in the cache in a few 
+        # large queries rather than one per var.
+        if oid.aggregate:
+            self.db.prefetch_metadata(raw_data_list)
+            rate_updates = self.fit_base_rates(raw_data_list)
+        else:
+            rate_updates = {}
 
-            self.db.set_raw_data(raw_data, ttl=oidset.ttl)
+        for raw_data in raw_data_list:
+            # Store the raw input.
+            self.db.set_raw_data(raw_data, ttl=ttl, batch=batch)
 
             # Generate aggregations if apropos.
             if oid.aggregate:
-                delta_v = self.aggregate_base_rate(raw_data)
+                delta_v = self.aggregate_base_rate(raw_data, batch=batch,
+                    updates=rate_updates.get(raw_data.get_meta_key()))
                 # XXX: not implemented
                 #uptime_name = os.path.join(basename, 'sysUpTime')
                 
@@ -472,14 +587,65 @@ class CassandraPollPersister(PollPersister):
                     # We got a good delta back - generate rollups.
                     # Just swap the delta into the raw data object.
                     raw_data.val = delta_v
-                    self.generate_aggregations(raw_data, oidset.aggregates)
+                    if agg_timestamps is None:
+                        agg_timestamps = dict([(freq, self._agg_timestamp(raw_data, freq))
+                            for freq in aggregates])
+                    self.generate_aggregations(raw_data, aggregates,
+                        batch=batch, agg_timestamps=agg_timestamps)
             else:
                 pass
 
         self.log.debug("stored %d vars in %f seconds: %s" % (nvar,
             time.time() - t0, result))
 
-    def aggregate_base_rate(self, data):
+    def fit_base_rates(self, raw_data_list):
+        """
+        Compute the base rate bin updates for a list of RawRateData objects
+        in one pass with fit_to_bins_batch.
+
+        Returns a dict mapping meta keys to the same dict of updates
+        fit_to_bins would return.  Vars that aggregate_base_rate will not
+        fit to bins (first values, counter wraps, heartbeat gaps) are left
+        out and so is everything if numpy is not installed or the list is
+        shorter than batch_fit_min_vars.
+        """
+        if dataseries.numpy is None or \
+                len(raw_data_list) < self.batch_fit_min_vars:
+            return {}
+
+        keys = []
+        ts_prev, val_prev, ts_curr, val_curr = [], [], [], []
+        freq = raw_data_list[0].freq
+
+        for data in raw_data_list:
+            if data.freq != freq or not isinstance(data.val, (int, long)):
+                return {}
+            metadata = self.db.get_metadata(data)
+            last_data_ts = metadata.ts_to_jstime('last_update')
+            curr_data_ts = data.ts_to_jstime()
+            delta_t = curr_data_ts - last_data_ts
+            if delta_t <= 0 or delta_t > freq * HEARTBEAT_FREQ_MULTIPLIER or \
+                    data.val < metadata.last_val:
+                continue
+            keys.append(data.get_meta_key())
+            ts_prev.append(last_data_ts)
+            val_prev.append(metadata.last_val)
+            ts_curr.append(curr_data_ts)
+            val_curr.append(data.val)
+
+        if not keys or len(set(keys)) != len(keys):
+            return {}
+
+        index, bins, vals = fit_to_bins_batch(freq, ts_prev, val_prev,
+                ts_curr, val_curr)
+
+        rate_updates = dict([(k, {}) for k in keys])
+        for i, b, v in zip(index.tolist(), bins.tolist(), vals.tolist()):
+            rate_updates[keys[i]][b] = v
+
+        return rate_updates
+
+    def aggregate_base_rate(self, data, batch=None, updates=None):
         """
         Given incoming data that is meant for aggregation, generate and 
         store the base rate deltas, update the metadata cache, and if a valid 
@@ -487,7 +653,10 @@ class CassandraPollPersister(PollPersister):
         higher-level rollup aggregations.
         
         The data arg passed in is a RawData encapsulation object as
-        defined in the cassandra.py module.  
+        defined in the cassandra.py module.  The optional batch arg is a 
+        MutationBatch that the rate bin writes are added to.  The optional
+        updates arg is the precomputed result of fit_to_bins for this data
+        (see fit_base_rates).
         
         All of this logic is copied/adapted from the TSDB aggregator.py
         module.
@@ -565,7 +734,7 @@ class CassandraPollPersister(PollPersister):
             # Update only the "current" bin and return.
             curr_bin = BaseRateBin(ts=curr_slot, freq=data.freq, val=curr_frac,
                 path=data.path)
-            self.db.update_rate_bin(curr_bin)
+            self.db.update_rate_bin(curr_bin, batch=batch)
             
             metadata.refresh_from_raw(data)
             self.db.update_metadata(data.get_meta_key(), metadata)
@@ -573,14 +742,16 @@ class CassandraPollPersister(PollPersister):
             return
 
 
-        updates = fit_to_bins(data.freq, last_data_ts, metadata.last_val,
-                curr_data_ts, data.val)
-        # Now, write the new valid data between the appropriate bins.
+        if updates is None:
+            updates = fit_to_bins(data.freq, last_data_ts, metadata.last_val,
+                    curr_data_ts, data.val)
+        # Now, write the new valid data between the appropriate bins,
+        # oldest first so absolute totals only ever close older bins.
 
-        for bin_name, val in updates.iteritems():
-            update_bin = BaseRateBin(ts=bin_name, freq=data.freq, val=val,
-                path=data.path)
-            self.db.update_rate_bin(update_bin)
+        for bin_name in sorted(updates):
+            update_bin = BaseRateBin(ts=bin_name, freq=data.freq,
+                val=updates[bin_name], path=data.path)
+            self.db.update_rate_bin(update_bin, batch=batch)
 
         # Gotten to the final success condition, so update the metadata
         # cache with values from the current data input and return the 
@@ -602,7 +773,8 @@ class CassandraPollPersister(PollPersister):
         """
         return datetime.datetime.utcfromtimestamp((data.ts_to_unixtime() / freq) * freq)
 
-    def generate_aggregations(self, data, aggregate_freqs):
+    def generate_aggregations(self, data, aggregate_freqs, batch=None,
+            agg_timestamps=None):
         """
         Given a data encapsulation object that has been updated with the 
         current delta, iterate through the frequencies in oidset.aggregates
@@ -615,110 +787,159 @@ class CassandraPollPersister(PollPersister):
         
         Since the stat aggregations are read from/not just written to, 
         track if a new value has been generated (min/max will only be updated
-        periodically), and if so, explicitly flush the stat_agg batch.
+        periodically), and if so, explicitly flush the stat_agg batch.  When
+        a MutationBatch is passed in the writes go out with it instead.  With
+        stat_checkpoint_interval set most of the stat writes are held back
+        until the bin closes or the next checkpoint.
+
+        The optional agg_timestamps arg is a dict of precomputed aggregation
+        bin timestamps keyed by frequency.
         """
         stat_updated = False
 
         for freq in aggregate_freqs:
-            self.db.update_rate_aggregation(data, self._agg_timestamp(data, freq), freq*1000)
-            updated = self.db.update_stat_aggregation(data, 
-                                        self._agg_timestamp(data, freq), freq*1000)
+            if agg_timestamps is not None:
+                agg_ts = agg_timestamps[freq]
+            else:
+                agg_ts = self._agg_timestamp(data, freq)
+            self.db.update_rate_aggregation(data, agg_ts, freq*1000, batch=batch)
+            updated = self.db.update_stat_aggregation(data, agg_ts, freq*1000,
+                                        batch=batch)
             if updated: stat_updated = True
                                 
-        if stat_updated:
+        if stat_updated and batch is None:
             self.db.stat_agg.send()
 
     def stop(self, x, y):
         self.log.debug("flushing and stopping cassandra poll persister")
         self.db.flush()
+        self.db.snapshot_metadata()
         self.running = False
             
         
 
 class HistoryTablePersister(PollPersister):
-    """Provides common methods for table histories."""
-
-    def update_db(self):
-        """Compare the database to the poll results and update.
+    """Provides common methods for table histories.
 
-        This assumes that the database object has a begin_time and end_time
-        and that self.new_data has the dictionary representing the new data
-        and that self.old_data contains the database objects representing the
-        old data.  It uses _new_row_from_dict() to create a new object when
-        needed."""
+    Subclasses set model to the history table's model and key to the
+    attribute that identifies a row and implement _build_objs() to turn
+    self.data into a dict of the new attributes of each row.
 
-        adds = 0
-        changes = 0
-        deletes = 0
-
-        # iterate through what is currently in the database
-        for old in self.old_data:
-            # there is an entry in the new data: has anything changed?
-            key = getattr(old, self.key)
-            if key in self.new_data:
-                new = self.new_data[key]
-                attrs = new.keys()
-                attrs.remove(self.key)
-                changed = False
-
-                for attr in attrs:
-                    if not hasattr(old, attr):
-                        self.log.error("Field " + attr + " is not contained in the object: %s. Adding it." % str(old))
-                        changed = True
-                        break
-
-                    if getattr(old, attr) != new[attr]:
-                        changed = True
-                        break
-
-                if changed:
-                    old.end_time = now()
-                    old.save()
-                    new_row = self._new_row_from_obj(new)
-                    new_row.save()
-                    changes += 1
-
-                del self.new_data[key]
-            # no entry in self.new_data: interface is gone, update db
-            else:
-                old.end_time = now()
-                old.save()
-                deletes += 1
-
-        # anything left in self.new_data is something new
-        for new in self.new_data:
-            new_row = self._new_row_from_obj(self.new_data[new])
-            new_row.save()
-            adds += 1
+    The fingerprints of each device's rows are kept as of the last time
+    update_db() brought the database up to date, so a poll where nothing
+    changed doesn't touch the database at all.  They are trusted for
+    fingerprint_max_age seconds in case something else changes the
+    table."""
 
-        return (adds, changes, deletes)
+    model = None
+    key = None
 
+    fingerprint_max_age = 60*60
+    # Max number of rows ended per UPDATE.
+    update_chunk_size = 500
 
-class IfRefPollPersister(HistoryTablePersister):
-    int_oids = ('ifSpeed', 'ifHighSpeed', 'ifMtu', 'ifType',
-            'ifOperStatus', 'ifAdminStatus')
+    def __init__(self, config, qname, persistq):
+        PollPersister.__init__(self, config, qname, persistq)
+        self.fingerprints = {}
 
     def store(self, result):
         t0 = time.time()
         self.data = result.data
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = IfRef.objects.active().filter(device=self.device)
+        self.device_name = result.device_name
 
         self.new_data = self._build_objs()
         nvar = len(self.new_data)
-        self.key = 'ifName'
 
         adds, changes, deletes = self.update_db()
 
         self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
             nvar, adds, changes, deletes, time.time() - t0, result))
 
-    def _new_row_from_obj(self, obj):
-        obj['device'] = self.device
-        obj['begin_time'] = now()
-        obj['end_time'] = max_datetime
-        return IfRef(**obj)
+    def _new_row_from_obj(self, obj, begin_time):
+        row = dict(obj, device=self.device, begin_time=begin_time,
+                end_time=max_datetime)
+        return self.model(**row)
+
+    def _values(self, obj):
+        """The attributes of a row other than the key in a fixed order."""
+        return tuple([(k, obj[k]) for k in sorted(obj) if k != self.key])
+
+    def _old_values(self, old, new):
+        """The attributes of the database object old in the same order as
+        _values(new)."""
+        values = []
+        for k in sorted(new):
+            if k == self.key:
+                continue
+            if not hasattr(old, k):
+                self.log.error("Field " + k + " is not contained in the object: %s. Adding it." % str(old))
+            values.append((k, getattr(old, k, _missing)))
+        return tuple(values)
+
+    def update_db(self):
+        """Compare the database to the poll results and update.
+
+        self.new_data maps self.key to the dict of attributes of each row
+        the device has now.  The rows that changed or are gone get their
+        end_time set with one UPDATE (per update_chunk_size rows) and the
+        new versions are added with bulk_create.  Returns the number of
+        adds, changes and deletes."""
+
+        fingerprints = dict([(k, hash(self._values(v)))
+            for k, v in self.new_data.iteritems()])
+
+        cached = self.fingerprints.get(self.device_name)
+        if cached and cached[1] == fingerprints and \
+                time.time() < cached[0] + self.fingerprint_max_age:
+            return (0, 0, 0)
+
+        self.device = Device.objects.active().get(name=self.device_name)
+        t = now()
+
+        ended = []
+        new_rows = []
+        changes = 0
+        seen = set()
+
+        # iterate through what is currently in the database
+        for old in self.model.objects.filter(device=self.device,
+                end_time__gt=t):
+            key = getattr(old, self.key)
+            # no entry in self.new_data: interface is gone, end it
+            if key not in self.new_data or key in seen:
+                ended.append(old.pk)
+                continue
+
+            seen.add(key)
+            new = self.new_data[key]
+            if self._old_values(old, new) != self._values(new):
+                ended.append(old.pk)
+                new_rows.append(self._new_row_from_obj(new, t))
+                changes += 1
+
+        # anything not in the database is something new
+        for key, new in self.new_data.iteritems():
+            if key not in seen:
+                new_rows.append(self._new_row_from_obj(new, t))
+
+        for i in range(0, len(ended), self.update_chunk_size):
+            self.model.objects.filter(
+                pk__in=ended[i:i + self.update_chunk_size]).update(end_time=t)
+
+        if new_rows:
+            self.model.objects.bulk_create(new_rows)
+
+        self.fingerprints[self.device_name] = (time.time(), fingerprints)
+
+        return (len(new_rows) - changes, changes, len(ended) - changes)
+
+
+class IfRefPollPersister(HistoryTablePersister):
+    model = IfRef
+    key = 'ifName'
+
+    int_oids = ('ifSpeed', 'ifHighSpeed', 'ifMtu', 'ifType',
+            'ifOperStatus', 'ifAdminStatus')
 
     def _build_objs(self):
         ifref_objs = {}
@@ -750,30 +971,10 @@ class IfRefPollPersister(HistoryTablePersister):
         return ifref_objs
 
 class ALUSAPRefPersister(HistoryTablePersister):
-    int_oids = ('sapIngressQosPolicyId', 'sapEgressQosPolicyId')
-
-    def store(self, result):
-        self.data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = ALUSAPRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'name'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
-
-    def _new_row_from_obj(self, obj):
-        obj['device'] = self.device
-        obj['begin_time'] = now()
-        obj['end_time'] = max_datetime
+    model = ALUSAPRef
+    key = 'name'
 
-        return ALUSAPRef(**obj)
+    int_oids = ('sapIngressQosPolicyId', 'sapEgressQosPolicyId')
 
     def _build_objs(self):
         objs = {}
@@ -795,36 +996,24 @@ class ALUSAPRefPersister(HistoryTablePersister):
         return objs
 
 class LSPOpStatusPersister(HistoryTablePersister):
-    def __init__(self, config, qname):
-        HistoryTablePersister.__init__(self, config, qname)
-
-    def store(self, result):
-        self.lsp_data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = LSPOpStatus.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'name'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
+    model = LSPOpStatus
+    key = 'name'
 
-    def _new_row_from_obj(self, obj):
-        obj['device'] = self.device
-        obj['begin_time'] = now()
-        obj['end_time'] = max_datetime
-
-        return LSPOpStatus(**obj)
+    # LSPOpStatus field for each polled OID
+    oid_fields = {
+        'mplsLspInfoState': 'state',
+        'mplsLspInfoFrom': 'srcAddr',
+        'mplsLspInfoTo': 'dstAddr',
+    }
 
     def _build_objs(self):
         lsp_objs = {}
 
-        for k, entries in self.lsp_data.iteritems():
+        for k, entries in self.data.iteritems():
+            if k not in self.oid_fields:
+                continue
+            field = self.oid_fields[k]
+
             for name, val in entries:
                 name = name.split('.')[-1].replace("'", "")
 
@@ -832,10 +1021,10 @@ class LSPOpStatusPersister(HistoryTablePersister):
                     lsp_objs[name] = dict(name=name)
 
                 o = lsp_objs[name]
-                if k == 'mplsLspInfoState':
-                    o[k] = int(val)
+                if field == 'state':
+                    o[field] = int(val)
                 else:
-                    o[k] = val
+                    o[field] = val
 
         return lsp_objs
 
@@ -878,30 +1067,10 @@ class InfIfRefPollPersister(IfRefPollPersister):
 
 class SentryOutletRefPollPersister(HistoryTablePersister):
     """Save information about outlets for a Sentry PDU."""
-    int_oids = ('outletStatus', 'outletControlState')
-
-    def store(self, result):
-        self.data = result.data
-        t0 = time.time()
-
-        self.device = Device.objects.active().get(name=result.device_name)
-        self.old_data = OutletRef.objects.active().filter(device=self.device)
-
-        self.new_data = self._build_objs()
-        nvar = len(self.new_data)
-        self.key = 'outletID'
-
-        adds, changes, deletes = self.update_db()
-
-        self.log.debug("processed %d vars [%d/%d/%d] in %f seconds: %s" % (
-            nvar, adds, changes, deletes, time.time() - t0, result))
-
-    def _new_row_from_obj(self, obj):
-        obj['device'] = self.device
-        obj['begin_time'] = now()
-        obj['end_time'] = max_datetime
+    model = OutletRef
+    key = 'outletID'
 
-        return OutletRef(**obj)
+    int_oids = ('outletStatus', 'outletControlState')
 
     def _build_objs(self):
         objs = {}
@@ -929,8 +1098,13 @@ class SentryOutletRefPollPersister(HistoryTablePersister):
 
 class PersistQueue(object):
     """Abstract base class for a persistence queue."""
-    def __init__(self, qname):
+
+    # Seconds between checks for new items in get_many().
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, qname, serializer=None):
         self.qname = qname
+        self.serializer = serializer or JSONResultSerializer()
 
     def get(self, block=False):
         pass
@@ -938,10 +1112,35 @@ class PersistQueue(object):
     def put(self, val):
         pass
 
+    def get_many(self, n, timeout=0):
+        """Return a list of up to n items, waiting up to timeout seconds
+        for there to be any."""
+        deadline = time.time() + timeout
+        while True:
+            items = self._get_many(n)
+            if items or time.time() >= deadline:
+                return items
+            time.sleep(self.POLL_INTERVAL)
+
+    def _get_many(self, n):
+        """Return up to n items without waiting.  Subclasses should 
+        override this if they can do better than calling get() n times."""
+        items = []
+        while len(items) < n:
+            val = self.get()
+            if val is None:
+                break
+            items.append(val)
+        return items
+
+    def put_many(self, vals):
+        for val in vals:
+            self.put(val)
+
     def serialize(self, val):
         # return pickle.dumps(val)
         try:
-            return val.json() # .dumps() is being called in the PollResult method
+            return self.serializer.dumps(val.as_dict())
         except Exception as e:
             m = 'Poll Result {0} could not be serialized: {1}'.format(val, e)
             if hasattr(self, 'log'):
@@ -953,7 +1152,8 @@ class PersistQueue(object):
 
     def deserialize(self, val):
         # return pickle.loads(val)
-        return json.loads(val)
+        # Results may have been written by any serializer.
+        return serialization.loads(val)
 
 class JsonSerializer(object):
     """This is passed to memcache.Client() to replace default use of 
@@ -982,9 +1182,12 @@ class MemcachedPersistQueue(PersistQueue):
     """
 
     PREFIX = '_mcpq_'
+    # Every check for new items is a round trip to memcached, so check
+    # no more often than the persisters did before get_many().
+    POLL_INTERVAL = PERSIST_SLEEP_TIME
 
-    def __init__(self, qname, memcached_uri):
-        super(MemcachedPersistQueue, self).__init__(qname)
+    def __init__(self, qname, memcached_uri, serializer=None):
+        super(MemcachedPersistQueue, self).__init__(qname, serializer)
 
         self.log = get_logger("MemcachedPersistQueue_%s" % self.qname)
 
@@ -1040,6 +1243,52 @@ class MemcachedPersistQueue(PersistQueue):
 
             qid = self.mc.incr(self.last_read)
 
+    def _key(self, qid):
+        return '%s_%s_%d' % (self.PREFIX, self.qname, qid)
+
+    def put_many(self, vals):
+        sers = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                sers.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        if not sers:
+            return
+
+        # Reserve a block of qids with one incr.
+        last = self.mc.incr(self.last_added, len(sers))
+        first = last - len(sers) + 1
+
+        mapping = {}
+        for qid, ser in zip(xrange(first, last + 1), sers):
+            mapping[self._key(qid)] = ser
+
+        failed = self.mc.set_multi(mapping)
+        if failed:
+            self.log.error("memcache 'set_multi' failed for %d items! Polling data lost!" %
+                    len(failed))
+
+    def _get_many(self, n):
+        n = min(n, len(self))
+        if n <= 0:
+            return []
+
+        # Claim a block of qids with one incr.
+        last = self.mc.incr(self.last_read, n)
+        keys = [self._key(qid) for qid in xrange(last - n + 1, last + 1)]
+
+        vals = self.mc.get_multi(keys)
+        if len(vals) < n:
+            self.log.error("missing data: %d items missing (qids %d-%d)" %
+                    (n - len(vals), last - n + 1, last))
+        if vals:
+            self.mc.delete_multi(vals.keys())
+
+        return [PollResult(**self.deserialize(vals[k])) for k in keys if k in vals]
+
     def __len__(self):
         n = self.mc.get(self.last_added) - self.mc.get(self.last_read)
         if n < 0:
@@ -1051,6 +1300,66 @@ class MemcachedPersistQueue(PersistQueue):
         self.mc.set(self.last_read, 0)
 
 
+class SegmentPersistQueue(PersistQueue):
+    """A queue stored in an append-only segment log on local disk.
+
+    Each queue is a SegmentLog in its own directory under ``queue_dir``.
+    Producers leave ``consumer`` as None.  The persister worker reading the
+    queue passes a consumer name and its read position is saved to disk
+    the next time it asks for more work, so a restarted worker picks up
+    any results it had not finished storing.
+    """
+
+    def __init__(self, qname, queue_dir, config=None, consumer=None,
+            serializer=None):
+        super(SegmentPersistQueue, self).__init__(qname, serializer)
+
+        self.log = get_logger("SegmentPersistQueue_%s" % self.qname)
+
+        kw = {}
+        if config:
+            kw = dict(segment_size=config.persist_queue_segment_size,
+                fsync=config.persist_queue_fsync,
+                fsync_interval=config.persist_queue_fsync_interval)
+
+        self.segments = SegmentLog(os.path.join(queue_dir, qname),
+            consumer=consumer, **kw)
+
+    def __str__(self):
+        la, lr = self.segments.counts()
+        return '<SegmentPersistQueue: %s last_added: %d, last_read: %d>' \
+                % (self.qname, la, lr)
+
+    def put(self, val):
+        self.put_many([val])
+
+    def put_many(self, vals):
+        payloads = []
+        for val in vals:
+            ser = self.serialize(val)
+            if ser:
+                payloads.append(ser)
+            else:
+                self.log.error("failed to serialize: %s" % str(val))
+
+        self.segments.append(payloads)
+
+    def get(self, block=False):
+        results = self._get_many(1)
+        if results:
+            return results[0]
+        return None
+
+    def _get_many(self, n):
+        # Everything handed out by the previous call has been stored by
+        # the time the worker asks for more.
+        self.segments.commit()
+        return [PollResult(**self.deserialize(p)) for p in self.segments.read(n)]
+
+    def __len__(self):
+        return self.segments.pending()
+
+
 class PersistClient(object):
     def __init__(self, name, config):
         self.config = config
@@ -1111,7 +1420,15 @@ class MultiWorkerQueue(object):
         workerq.put(result)
 
 
-class MemcachedPersistHandler(object):
+class PersistHandler(object):
+    """Base class for the handlers espolld uses to put PollResults on the
+    persist queues.
+
+    A handler looks after the queues in ``persist_queues`` with a queue type
+    that matches ``queue_type``.  Subclasses implement ``make_queue``.
+    """
+    queue_type = None
+
     def __init__(self, name, config, uri):
         self.queues = {}
         self.config = config
@@ -1119,12 +1436,20 @@ class MemcachedPersistHandler(object):
         self.log = get_logger(name)
 
         for qname in config.persist_queues:
+            if config.persist_queue_types[qname] != self.queue_type:
+                continue
             num_workers = self.config.persist_queues[qname][1]
+            make_queue = functools.partial(self.make_queue,
+                    serializer=get_serializer(
+                        config.persist_queue_serializers.get(qname, 'json')))
             if num_workers > 1:
                 self.queues[qname] = MultiWorkerQueue(qname,
-                        MemcachedPersistQueue, uri, num_workers)
+                        make_queue, uri, num_workers)
             else:
-                self.queues[qname] = MemcachedPersistQueue(qname, uri)
+                self.queues[qname] = make_queue(qname, uri)
+
+    def make_queue(self, qname, uri, serializer=None):
+        raise NotImplementedError
 
     def put(self, result):
         try:
@@ -1137,11 +1462,31 @@ class MemcachedPersistHandler(object):
             try:
                 q = self.queues[qname]
             except KeyError:
-                self.log.error("unknown queue: %s" % (qname,))
+                # Queues of another type belong to another handler.
+                if not self.config.persist_queues.has_key(qname):
+                    self.log.error("unknown queue: %s" % (qname,))
+                continue
 
             q.put(result)
 
 
+class MemcachedPersistHandler(PersistHandler):
+    queue_type = 'memcached'
+
+    def make_queue(self, qname, uri, serializer=None):
+        return MemcachedPersistQueue(qname, uri, serializer=serializer)
+
+
+class SegmentPersistHandler(PersistHandler):
+    """The uri is the directory holding the queue segment logs and should
+    be the same as ``persist_queue_dir``."""
+    queue_type = 'segment'
+
+    def make_queue(self, qname, uri, serializer=None):
+        return SegmentPersistQueue(qname, uri, self.config,
+                serializer=serializer)
+
+
 def do_profile(func_name, myglobals, mylocals):
     import cProfile
     import pstats
@@ -1201,19 +1546,40 @@ class QueueStats:
                 self.last_added[0])
 
 
+class SegmentQueueStats(QueueStats):
+    """QueueStats for a SegmentPersistQueue - the counts come from the
+    segment log rather than memcached."""
+
+    def __init__(self, queue_dir, qname):
+        QueueStats.__init__(self, None, qname)
+        self.segments = SegmentLog(os.path.join(queue_dir, qname))
+
+    def update_stats(self):
+        counts = self.segments.counts(consumer='persister')
+        for k, v in zip(('last_added', 'last_read'), counts):
+            l = getattr(self, k)
+            l.pop()
+            l.insert(0, v)
+
+
 def stats(name, config, opts):
     stats = {}
     mc = memcache.Client(['127.0.0.1:11211'])
 
+    def queue_stats(qname, k):
+        if config.persist_queue_types[qname] == 'segment':
+            return SegmentQueueStats(config.persist_queue_dir, k)
+        return QueueStats(mc, k)
+
     for qname, qinfo in config.persist_queues.iteritems():
         (qclass, nworkers) = qinfo
         if nworkers == 1:
-                stats[qname] = QueueStats(mc, qname)
+                stats[qname] = queue_stats(qname, qname)
                 stats[qname].update_stats()
         else:
             for i in range(1, nworkers + 1):
                 k = "%s_%d" % (qname, i)
-                stats[k] = QueueStats(mc, k)
+                stats[k] = queue_stats(qname, k)
                 stats[k].update_stats()
 
     keys = stats.keys()
@@ -1241,6 +1607,7 @@ def worker(name, config, opts):
     os.umask(0022)
 
     (qclass, nworkers) = config.persist_queues[opts.qname]
+    qtype = config.persist_queue_types[opts.qname]
     if nworkers > 1:
         name += '_%s' % opts.number
         opts.qname += '_%s' % opts.number
@@ -1249,8 +1616,16 @@ def worker(name, config, opts):
             debug=opts.debug)
 
     setproctitle(name)
+
+    persistq = None
+    if qtype == 'segment':
+        if not config.persist_queue_dir:
+            raise ConfigError("persist_queue_dir must be set for segment queues")
+        persistq = SegmentPersistQueue(opts.qname, config.persist_queue_dir,
+            config, consumer='persister')
+
     klass = eval(qclass)
-    worker = klass(config, opts.qname, persistq=None)
+    worker = klass(config, opts.qname, persistq=persistq)
 
     worker.run()
     # do_profile("worker.run()", globals(), locals())
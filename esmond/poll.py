@@ -6,6 +6,15 @@ import re
 import socket
 import threading
 import Queue
+import errno
+import collections
+import heapq
+import hashlib
+import itertools
+import glob
+import json
+import __main__
+from subprocess import Popen, PIPE, STDOUT
 
 import django
 
@@ -13,11 +22,12 @@ from DLNetSNMP import SNMPManager, oid_to_str, str_to_oid, SnmpError
 
 from esmond.util import setproctitle, init_logging, get_logger, \
         build_alu_sap_name
-from esmond.util import daemonize, setup_exc_handler
+from esmond.util import daemonize, setup_exc_handler, HashRing, Histogram
 from esmond.config import get_opt_parser, get_config, get_config_path
 from esmond.error import ConfigError, PollerError
 from esmond.persist import PollResult, PersistClient
 from esmond.api.models import Device, IfRef, OIDSet
+from esmond.oidsets import get_oidset_cache
 
 try:
     import tsdb
@@ -368,18 +378,60 @@ class PersistThread(threading.Thread):
         self.state = self.REMOVE
 
 
+class PollScheduler(object):
+    """Heap of pollers ordered by the time of their next poll.
+
+    Stopped pollers are not removed from the heap, the PollManager skips
+    entries whose poller is no longer running when they come due."""
+
+    def __init__(self):
+        self.heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, key, poller):
+        heapq.heappush(self.heap, (poller.next_poll, next(self._seq), key,
+            poller))
+
+    def next_deadline(self):
+        """Time of the earliest poll, None if there are no pollers."""
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        """Remove and return the (key, poller) pairs due at or before now
+        in deadline order."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, seq, key, poller = heapq.heappop(self.heap)
+            due.append((key, poller))
+        return due
+
+
 class PollManager(object):
     """Manage polling and sending data to be persisted.
 
     The main polling is done asynchronously in the main thread.  There is a
     second thread which handles the interactions with the persistence
-    system."""
+    system.
+
+    If shard is given this is one of the worker processes started by a
+    PollSupervisor and it only polls the devices that the consistent hash
+    of the device name puts in its shard (see poll_shards).  A SIGHUP makes
+    it re-read poll_shards from the config file and pick up or drop devices
+    to match at the next reload."""
 
-    def __init__(self, name, opts, args, config):
+    STATS_INTERVAL = 60
+
+    def __init__(self, name, opts, args, config, shard=None):
         self.name = name
         self.opts = opts
         self.args = args
         self.config = config
+        self.shard = shard
 
         self.hostname = socket.gethostname()
 
@@ -388,22 +440,44 @@ class PollManager(object):
         self.running = False
         self.last_reload = time.time()
         self.last_penalty_empty = time.time()
+        self.last_stats = time.time()
+        self.last_poll_count = 0
+        self.reshard = False
 
         self.reload_interval = 30
         self.penalty_interval = 300
 
-        self.devices = Device.objects.active_as_dict()
+        self.ring = None
+        if self.shard is not None:
+            self.ring = HashRing(range(self.config.poll_shards))
+
+        self.devices = self._active_devices()
+        self.oidset_cache = get_oidset_cache()
+        self.oidset_cache.reload_interval = self.config.reload_interval
+        self.oidset_cache.load()
 
         self.persistq = Queue.Queue()
         self.snmp_poller = AsyncSNMPPoller(config=self.config,
                 name="espolld.snmp_poller")
         self.pollers = {}
+        self.scheduler = PollScheduler()
+
+    def _active_devices(self):
+        """The active devices this PollManager polls, all of them unless
+        it is a shard."""
+        devices = Device.objects.active_as_dict()
+        if self.ring is not None:
+            devices = dict([(k, v) for k, v in devices.iteritems()
+                if self.ring.get_node(k) == self.shard])
+        return devices
 
     def start_polling(self):
         self.log.debug("starting, %d devices configured" % len(self.devices))
 
         signal.signal(signal.SIGINT, self.stop_polling)
         signal.signal(signal.SIGTERM, self.stop_polling)
+        if self.shard is not None:
+            signal.signal(signal.SIGHUP, self.request_reshard)
         self.running = True
 
         self.threads = {}
@@ -423,18 +497,41 @@ class PollManager(object):
         self.last_reload = time.time()
 
         while self.running:
-            for poller in self.pollers.itervalues():
+            for key, poller in self.scheduler.pop_due(time.time()):
+                if self.pollers.get(key) is not poller:
+                    continue  # stopped or restarted since it was scheduled
                 poller.run_once()
+                self.scheduler.add(key, poller)
+
+            if self.reshard:
+                self.reshard = False
+                self.update_shards()
 
             if self.last_reload + self.config.reload_interval <= time.time():
                 if self.config.debug:
                     django.db.reset_queries()
                 self.reload()
 
-            time.sleep(1)
+            if self.last_stats + self.STATS_INTERVAL <= time.time():
+                self.log_stats()
+
+            self._sleep_until_due()
 
         self.shutdown()
 
+    def _sleep_until_due(self):
+        """Sleep until the next poll, reload or stats report is due.
+        Signals cut the sleep short."""
+        wake = min(self.last_reload + self.config.reload_interval,
+                self.last_stats + self.STATS_INTERVAL)
+        deadline = self.scheduler.next_deadline()
+        if deadline is not None:
+            wake = min(wake, deadline)
+
+        delay = wake - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
     def _start_thread(self, name, t):
         t.setDaemon(True)
         t.setName(name)
@@ -488,6 +585,7 @@ class PollManager(object):
             return
 
         self.pollers[key] = poller
+        self.scheduler.add(key, poller)
 
     def _stop_poller(self, poller_name):
         self.log.info("stopping poller %s" % poller_name)
@@ -501,6 +599,78 @@ class PollManager(object):
         self.log.info("stopping (signal: %d)" % (signum, ))
         self.running = False
 
+    def request_reshard(self, signum, frame):
+        self.reshard = True
+
+    def update_shards(self):
+        """Re-read poll_shards and move devices to match.  Only the devices
+        whose shard changed are started or stopped."""
+        try:
+            nshards = get_config(self.opts.config_file, self.opts).poll_shards
+        except ConfigError, e:
+            self.log.error("unable to reread config: %s" % e)
+            return
+
+        if self.shard >= nshards:
+            self.log.info("shard %d no longer configured, stopping" %
+                    self.shard)
+            self.running = False
+            return
+
+        if nshards != len(self.ring.nodes):
+            self.log.info("resharding from %d to %d shards" %
+                    (len(self.ring.nodes), nshards))
+            self.config.poll_shards = nshards
+            self.ring = HashRing(range(nshards))
+            self.reload()
+
+    def log_stats(self):
+        """Log the number of devices, pollers and polls since the last
+        time."""
+        now = time.time()
+        poll_count = sum([p.polling_round for p in self.pollers.itervalues()])
+        polls = max(poll_count - self.last_poll_count, 0)
+
+        if self.shard is not None:
+            shard = "shard %d/%d: " % (self.shard, len(self.ring.nodes))
+        else:
+            shard = ""
+
+        self.log.info("%s%d devices, %d pollers, %d polls (%f polls/sec), "
+                "%d results queued" % (shard, len(self.devices),
+                    len(self.pollers), polls, polls / (now - self.last_stats),
+                    self.persistq.qsize()))
+
+        snmp = self.snmp_poller.stats()
+        slowest = sorted(snmp['devices'].iteritems(),
+                key=lambda x: x[1].last, reverse=True)[:5]
+        self.log.info("%sSNMP walks: %d in flight, %d waiting, slowest: %s" % (
+            shard, snmp['inflight'], snmp['waiting'],
+            ", ".join(["%s %.2fs (avg %.2fs, %d timeouts)" % (host,
+                s.last, s.average, s.timeouts) for host, s in slowest])))
+
+        if self.config.poll_stats_dir:
+            self.dump_stats()
+
+        self.last_poll_count = poll_count
+        self.last_stats = now
+
+    def dump_stats(self):
+        """Write the PollerMetrics of all the pollers to NAME.stats in
+        poll_stats_dir for espolld -r stats."""
+        path = os.path.join(self.config.poll_stats_dir, "%s.stats" % self.name)
+        stats = dict(name=self.name, time=time.time(),
+                pollers=dict([(k, p.metrics.to_dict())
+                    for k, p in self.pollers.items()]))
+
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(stats, f)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            self.log.error("unable to write stats to %s: %s" % (path, e))
+
     def shutdown(self):
         self.log.info("shutting down")
 
@@ -515,7 +685,11 @@ class PollManager(object):
 
         self.log.debug("reloading devices and oidsets")
 
-        new_devices = Device.objects.active_as_dict()
+        if self.oidset_cache.load():
+            self.log.info("oidsets changed, cache version %d" %
+                    self.oidset_cache.version)
+
+        new_devices = self._active_devices()
 
         new_device_set = set(new_devices.iterkeys())
         old_device_set = set(self.devices.iterkeys())
@@ -561,6 +735,57 @@ class PollManager(object):
         self.last_reload = time.time()
 
 
+class PollRound(object):
+    """State of one polling round passed down to the AsyncSNMPPoller."""
+    def __init__(self, begin_time):
+        self.begin_time = begin_time
+        self.pdus = 0
+
+
+class PollerMetrics(object):
+    """Histograms and counters describing the polls of a Poller.
+
+    walk_time is the time from the start of the poll until all the data was
+    returned, process_time the time finish() took to correlate and
+    translate it less enqueue_time, the time spent putting the
+    PollResults on the persist queue.  pdus and vars are the number of
+    GETBULKs sent and variables returned per poll."""
+
+    histograms = ('walk_time', 'process_time', 'enqueue_time', 'pdus',
+            'vars')
+    counters = ('polls', 'missed_deadlines', 'timeouts')
+
+    def __init__(self):
+        self.walk_time = Histogram(base=0.001)
+        self.process_time = Histogram(base=0.001)
+        self.enqueue_time = Histogram(base=0.001)
+        self.pdus = Histogram()
+        self.vars = Histogram()
+        self.polls = 0
+        self.missed_deadlines = 0
+        self.timeouts = 0
+
+    def merge(self, other):
+        for k in self.histograms:
+            getattr(self, k).merge(getattr(other, k))
+        for k in self.counters:
+            setattr(self, k, getattr(self, k) + getattr(other, k))
+
+    def to_dict(self):
+        d = dict([(k, getattr(self, k).to_dict()) for k in self.histograms])
+        d.update([(k, getattr(self, k)) for k in self.counters])
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        m = cls()
+        for k in cls.histograms:
+            setattr(m, k, Histogram.from_dict(d[k]))
+        for k in cls.counters:
+            setattr(m, k, d[k])
+        return m
+
+
 class Poller(object):
     """The Poller class is the base for all pollers.
 
@@ -576,37 +801,82 @@ class Poller(object):
     def __init__(self, config, device, oidset, poller, persistq):
         self.config = config
         self.device = device
-        self.oidset = oidset
+        # The OIDSet comes from the process wide cache (see esmond.oidsets)
+        # so polling doesn't query the database.
+        self.oidset_cache = get_oidset_cache()
+        self.oidset = self.oidset_cache.get(oidset.name)
         self.poller = poller
         self.persistq = persistq
 
         self.name = "espolld." + self.device.name + "." + self.oidset.name
 
-        self.next_poll = int(time.time() - 1)
-        self.oids = self.oidset.oids
+        # Spread the pollers over poll_jitter of the polling interval
+        # with a fixed offset per poller so a restart keeps the same
+        # phase.  With poll_align set polls stay on the frequency
+        # boundary plus offset rather than drifting by however long each
+        # poll took to start.
+        self.poll_align = config.poll_align
+        self.offset = self.oidset.frequency * config.poll_jitter * \
+            (int(hashlib.md5(self.name.encode('utf-8')).hexdigest()[:8], 16) /
+                float(2**32))
+
+        if self.poll_align or self.offset:
+            self.next_poll = self.first_deadline(time.time())
+        else:
+            self.next_poll = int(time.time() - 1)
         # in some pollers we poll oids beyond the ones which are used
         # for that poller, so we make a copy in poll_oids
-        self.poll_oids = [o.name for o in self.oids.all()]
+        self.poll_oids = [o.name for o in self.oidset.oids]
         self.running = True
         self.log = get_logger(self.name)
 
-        self.poller_args = {}
-        if self.oidset.poller_args is not None:
-            for arg in self.oidset.poller_args.split():
-                (var, val) = arg.split('=')
-                self.poller_args[var] = val
+        self.poller_args = dict(self.oidset.poller_args)
 
         self.polling_round = 0
+        self.metrics = PollerMetrics()
+        self.enqueue_time = 0.0
 
     def __str__(self):
         return '<%s: %s %s>' % (self.__name__, self.device.name,
                 self.oidset.name)
 
+    @property
+    def oids(self):
+        """The OIDInfos of the OIDSet as of the last cache reload."""
+        return self.oidset_cache.oidsets.get(self.oidset.name, self.oidset).oids
+
+    def first_deadline(self, now):
+        """The first frequency boundary plus offset at or after now."""
+        freq = self.oidset.frequency
+        t = now - (now % freq) + self.offset
+        if t < now:
+            t += freq
+        return t
+
+    def next_deadline(self, now):
+        """The time of the poll after the one starting at now."""
+        freq = self.oidset.frequency
+        if not self.poll_align:
+            return now + freq
+
+        # Stay pinned to the boundaries, skipping any polls that were
+        # missed entirely.
+        missed = int((now - self.next_poll) // freq)
+        if missed > 0:
+            self.log.warning("skipped %d polls" % missed)
+        else:
+            missed = 0
+        return self.next_poll + (missed + 1) * freq
+
     def run_once(self):
         if self.time_to_poll():
             self.log.debug("grabbing data")
             self.begin_time = time.time()
-            self.next_poll = self.begin_time + self.oidset.frequency
+            missed = int((self.begin_time - self.next_poll) //
+                    self.oidset.frequency)
+            if missed > 0:
+                self.metrics.missed_deadlines += missed
+            self.next_poll = self.next_deadline(self.begin_time)
 
             self.begin()
             self.collect()
@@ -629,8 +899,29 @@ class Poller(object):
         called with the data.  If collect encounters erros the error() method
         is called."""
 
-        self.poller.bulkwalk(self.device.name, self.poll_oids, self.finish,
-                self.error)
+        poll_round = PollRound(self.begin_time)
+        self.poller.bulkwalk(self.device.name, self.poll_oids,
+                lambda data: self._collected(poll_round, data),
+                lambda error: self._failed(poll_round, error),
+                poll_round=poll_round)
+
+    def _collected(self, poll_round, data):
+        """Record the metrics for a poll around the call to finish()."""
+        now = time.time()
+        self.metrics.polls += 1
+        self.metrics.walk_time.add(now - poll_round.begin_time)
+        self.metrics.pdus.add(poll_round.pdus)
+        self.metrics.vars.add(len(data))
+
+        self.enqueue_time = 0.0
+        self.finish(data)
+        self.metrics.enqueue_time.add(self.enqueue_time)
+        self.metrics.process_time.add(
+                time.time() - now - self.enqueue_time)
+
+    def _failed(self, poll_round, error):
+        self.metrics.timeouts += 1
+        self.error(error)
 
     def finish(self, data):
         """finish is called once all the data has been retrieved.
@@ -649,7 +940,9 @@ class Poller(object):
 
     def save(self, pr):
         """Save PollResults."""
+        t0 = time.time()
         self.persistq.put(pr)
+        self.enqueue_time += time.time() - t0
 
     def shudown(self):
         """shutdown is called as the poller is shutting down
@@ -673,34 +966,61 @@ class Poller(object):
 
 class CorrelatedPoller(Poller):
     """Handles polling of an OIDSet for a device and uses a correlator to
-    determine the name of the variable to use to store values."""
+    determine the name of the variable to use to store values.
+
+    If poll_correlator_refresh is set the correlator keeps its index maps
+    between polls and the OIDs it needs (ifName, ifAlias, ...) are only
+    walked again every poll_correlator_refresh seconds or on the poll after
+    an unknown index shows up."""
     def __init__(self, config, device, oidset, poller, persistq):
         Poller.__init__(self, config, device, oidset, poller, persistq)
 
         self.correlator = eval(self.poller_args['correlator'])()
+        self.data_oids = list(self.poll_oids)
         self.poll_oids.extend(self.correlator.oids)
 
+        self.correlator_refresh = config.poll_correlator_refresh
+        self.correlator_time = None
+        self.correlator_expired = True
+        self.setup_correlator = True
+
         self.results = {}
 
     def begin(self):
-        pass
+        self.setup_correlator = self.correlator_stale(self.begin_time)
+        if self.setup_correlator:
+            self.poll_oids = self.data_oids + self.correlator.oids
+        else:
+            self.poll_oids = list(self.data_oids)
+
+    def correlator_stale(self, now):
+        """True if the correlation OIDs need to be walked this poll."""
+        return not self.correlator_refresh or self.correlator_expired or \
+            now >= self.correlator_time + self.correlator_refresh
+
+    def _setup_correlator(self, data):
+        if self.setup_correlator:
+            self.correlator.setup(data)
+            self.correlator_time = self.begin_time
+            self.correlator_expired = False
 
     def finish(self, data):
-        self.correlator.setup(data)
+        self._setup_correlator(data)
 
         ts = time.time()
         metadata = dict(tsdb_flags=ROW_VALID)
 
-        for oid in self.oidset.oids.all():
+        for oid in self.oids:
             dataout = []
             # qualified names are returned unqualified
             if "::" in oid.name:
-                oid.name = oid.name.split("::")[-1]
+                oid = oid._replace(name=oid.name.split("::")[-1])
             for var, val in filter_data(oid.name, data):
                 try:
                     varname = self.correlator.lookup(oid, var)
                 except PollUnknownIfIndex:
                     self.log.error("unknown ifIndex: %s %s" % (var, str(val)))
+                    self.correlator_expired = True
                     continue
 
                 if varname:
@@ -718,36 +1038,31 @@ class CorrelatedPoller(Poller):
         self.log.debug("grabbed %d vars in %f seconds" %
                         (len(data), time.time() - self.begin_time))
 
-class TranslatedPoller(Poller):
+class TranslatedPoller(CorrelatedPoller):
     """Handles polling of an OIDSet for a device and uses a correlator to
     determine the name of the variable to use to store values. Also uses
     a translator to perform any needed translation of the values."""
     def __init__(self, config, device, oidset, poller, persistq):
-        Poller.__init__(self, config, device, oidset, poller, persistq)
+        CorrelatedPoller.__init__(self, config, device, oidset, poller,
+                persistq)
 
         self.translator = eval(self.poller_args['translator'])()
-        self.correlator = eval(self.poller_args['correlator'])()
-        self.poll_oids.extend(self.correlator.oids)
-
-        self.results = {}
-
-    def begin(self):
-        pass
 
     def finish(self, data):
-        self.correlator.setup(data)
+        self._setup_correlator(data)
         ts = time.time()
         metadata = dict(tsdb_flags=ROW_VALID)
-        for oid in self.oidset.oids.all():
+        for oid in self.oids:
             correlated_data = []
             # qualified names are returned unqualified
             if "::" in oid.name:
-                oid.name = oid.name.split("::")[-1]
+                oid = oid._replace(name=oid.name.split("::")[-1])
             for var, val in filter_data(oid.name, data):
                 try:
                     varname = self.correlator.lookup(oid, var)
                 except PollUnknownIfIndex:
                     self.log.error("unknown ifIndex: %s %s" % (var, str(val)))
+                    self.correlator_expired = True
                     continue
                 if varname:
                     correlated_data.append((varname, val))
@@ -778,7 +1093,7 @@ class UncorrelatedPoller(Poller):
 
     def finish(self, data):
         dataout = {}
-        for oid in self.oidset.oids.all():
+        for oid in self.oids:
             dataout[oid.name] = filter_data(oid.name, data)
             if self.translator:
                 dataout[oid.name] = self.translator.translate(dataout[oid.name])
@@ -802,22 +1117,97 @@ class PollRequest(object):
 
         self.results = []
 
+        # bulkwalk state, see AsyncSNMPPoller.bulkwalk
+        self.host = None
+        self.walks = []
+        self.remaining = 0
+        self.failed = False
+        self.begin_time = None
+        self.poll_round = None
+
     def append(self, oid, value):
         self.results.append((oid, value))
 
 
+class SubWalk(object):
+    """The walk of one OID of a bulkwalk PollRequest.
+
+    A bulkwalk is split into one SubWalk per OID.  Each SubWalk is a chain
+    of GETBULKs and holds a slot in its device's window until it is
+    done."""
+    type = 'subwalk'
+
+    def __init__(self, pollreq, oid, walk_oid):
+        self.pollreq = pollreq
+        self.oid = oid
+        self.walk_oid = walk_oid
+        self.results = []
+        # max-repetitions of the GETBULK in flight
+        self.repetitions = None
+
+
+class WalkStats(object):
+    """Walk latency and timeout counts for a device."""
+
+    def __init__(self):
+        self.walks = 0
+        self.timeouts = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.walks += 1
+        self.total += latency
+        self.last = latency
+        self.max = max(self.max, latency)
+
+    @property
+    def average(self):
+        if not self.walks:
+            return 0.0
+        return self.total / self.walks
+
+
 class AsyncSNMPPoller(object):
     """Manage all polling requests and responses.
 
-    AsyncPoller manages all the polling using DLNetSNMP."""
+    AsyncPoller manages all the polling using DLNetSNMP.
+
+    The OIDs of a bulkwalk are walked concurrently, at most snmp_window at
+    a time per device and snmp_max_inflight at a time over all devices.
+    The rest wait their turn.  The GETBULK max-repetitions starts at
+    maxrepetitions for each device and adapts to it: it doubles (up to
+    snmp_max_repetitions) while full responses come back, drops to the
+    number of rows the device actually returned when it sends fewer, and
+    halves on a timeout."""
+
+    min_repetitions = 5
 
     def __init__(self, config=None, name="AsyncSNMPPoller", maxrepetitions=25):
         self.maxrepetitions = maxrepetitions
         self.name = name
         self.config = config
 
+        self.window = getattr(config, 'snmp_window', 4)
+        self.max_inflight = getattr(config, 'snmp_max_inflight', 1000)
+        self.max_repetitions = getattr(config, 'snmp_max_repetitions', 100)
+
         self.reqmap = {}
 
+        # The bulkwalk state is shared with the DLNetSNMP processing
+        # thread.
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self.inflight_total = 0
+        self.waiting = {}
+        self.ready = collections.deque()
+        self.repetitions = {}
+        self.walk_stats = {}
+        # PollRequest callbacks are queued and run once the lock is
+        # released since they do all of the processing of the results.
+        self.callbacks = []
+
         self.sessions = SNMPManager(local_dir="/usr/local/share/snmp",
                 threaded_processor=True)
 
@@ -846,40 +1236,83 @@ class AsyncSNMPPoller(object):
             raise PollerError(str(e))
 
     def remove_session(self, host):
+        with self.lock:
+            # The GETBULKs in flight to host may never be answered once
+            # its session is gone, so free their slots and fail the
+            # bulkwalks they and the waiting SubWalks belong to.
+            walks = list(self.waiting.pop(host, ()))
+            for reqid, req in self.reqmap.items():
+                if req.type == 'subwalk' and req.pollreq.host == host:
+                    del self.reqmap[reqid]
+                    walks.append(req)
+            self.inflight_total -= self.inflight.pop(host, 0)
+
+            for walk in walks:
+                pollreq = walk.pollreq
+                if not pollreq.failed:
+                    pollreq.failed = True
+                    self.callbacks.append(
+                        lambda pollreq=pollreq: pollreq.errback("removed"))
+
+            self.repetitions.pop(host, None)
+            self.walk_stats.pop(host, None)
+            self._dispatch()
+
         self.sessions.remove_session(host)
+        self._run_callbacks()
 
     def shutdown(self):
         self.sessions.destroy()  # BWAHAHAHAH
 
-    def bulkwalk(self, host, oids, callback, errback):
+    def stats(self):
+        """Return a dict of the WalkStats for each device plus the current
+        number of requests in flight and waiting."""
+        with self.lock:
+            return dict(devices=dict(self.walk_stats),
+                inflight=self.inflight_total,
+                waiting=sum([len(q) for q in self.waiting.itervalues()]))
+
+    def bulkwalk(self, host, oids, callback, errback, poll_round=None):
         """Gathers all rows for the given objects in a table.
 
         A single SNMP GETBULK is not guaranteed to get all the objects
         referred to by the OID in a table.  `bulkwalk` implements a simple
         mechanism for gathering all rows for the given OIDs using GETBULK
-        messages multiple times if necessary."""
+        messages multiple times if necessary.  The callback gets the rows
+        in the order of oids.  The pdus of poll_round, if given, counts
+        the GETBULKs sent."""
 
         try:
             session = self.sessions[host]
         except KeyError:
             raise PollerError("no session defined for %s" % host)
 
-        oids = [str(o) for o in oids]  # make a copy of the oids list
+        pollreq = PollRequest('bulkwalk', callback, errback)
+        pollreq.host = host
+        pollreq.poll_round = poll_round
 
-        oid = oids.pop(0)
-        #print "oid >%s<" % (oid)
-        noid = str_to_oid(oid)  # avoid the noid!
-        if noid is None:
-            # XXX tell someone: raise exception?
-            self.log.error("unable to resolve OID: %s" % oid)
+        for oid in oids:
+            oid = str(oid)
+            noid = str_to_oid(oid)  # avoid the noid!
+            if noid is None:
+                # XXX tell someone: raise exception?
+                self.log.error("unable to resolve OID: %s" % oid)
+                continue
+            pollreq.walks.append(SubWalk(pollreq, oid, tuple(noid)))
+
+        if not pollreq.walks:
             return
-        noid = tuple(noid)
 
-        pollreq = PollRequest('bulkwalk', callback, errback,
-                walk_oid=noid, additional_oids=oids)
-        reqid = self.sessions[host].async_getbulk(
-                0, self.maxrepetitions, [oid])
-        self.reqmap[reqid] = pollreq
+        pollreq.remaining = len(pollreq.walks)
+        pollreq.begin_time = time.time()
+
+        with self.lock:
+            self.waiting.setdefault(host, collections.deque()).extend(
+                pollreq.walks)
+            self.ready.append(host)
+            self._dispatch()
+
+        self._run_callbacks()
 
     def bulkget(self, host, nonrepeaters, maxrepetitions, oids, callback,
             errback):
@@ -893,6 +1326,93 @@ class AsyncSNMPPoller(object):
         reqid = sessions[host].async_get(oids)
         self.reqmap[reqid] = pollreq
 
+    def _run_callbacks(self):
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    # ***
+    # *** the methods below are called with self.lock held
+    # ***
+
+    def _dispatch(self):
+        """Start waiting SubWalks while their device's window and the
+        global cap allow."""
+        while self.ready and self.inflight_total < self.max_inflight:
+            host = self.ready.popleft()
+            q = self.waiting.get(host)
+            while q and self.inflight.get(host, 0) < self.window and \
+                    self.inflight_total < self.max_inflight:
+                walk = q.popleft()
+                if walk.pollreq.failed:
+                    continue
+                self.inflight[host] = self.inflight.get(host, 0) + 1
+                self.inflight_total += 1
+                self._getbulk(host, walk, walk.oid)
+
+            if not q:
+                self.waiting.pop(host, None)
+            elif self.inflight.get(host, 0) < self.window:
+                # stopped by the global cap, keep its place in line
+                self.ready.appendleft(host)
+                break
+
+    def _getbulk(self, host, walk, oid):
+        walk.repetitions = self.repetitions.get(host, self.maxrepetitions)
+        try:
+            reqid = self.sessions[host].async_getbulk(0, walk.repetitions,
+                [oid])
+        except (KeyError, SnmpError), e:
+            self.log.error("getbulk failed for %s: %s" % (host, e))
+            self._walk_done(host, walk, failed=True)
+            return
+        self.reqmap[reqid] = walk
+        if walk.pollreq.poll_round is not None:
+            walk.pollreq.poll_round.pdus += 1
+
+    def _walk_done(self, host, walk, failed=False):
+        """Free the SubWalk's slot and queue the callback or errback of its
+        PollRequest if it was the last one or failed.  The caller must
+        _dispatch() to fill the slot."""
+        self.inflight[host] -= 1
+        self.inflight_total -= 1
+        if not self.inflight[host]:
+            del self.inflight[host]
+
+        pollreq = walk.pollreq
+        if not pollreq.failed:
+            if failed:
+                pollreq.failed = True
+                self.walk_stats.setdefault(host, WalkStats()).timeouts += 1
+                # XXX look into getting actual error messages
+                self.callbacks.append(lambda: pollreq.errback("timeout"))
+            else:
+                pollreq.remaining -= 1
+                if not pollreq.remaining:
+                    self.walk_stats.setdefault(host, WalkStats()).add(
+                        time.time() - pollreq.begin_time)
+                    for w in pollreq.walks:
+                        pollreq.results.extend(w.results)
+                    self.callbacks.append(
+                        lambda: pollreq.callback(pollreq.results))
+
+        if host in self.waiting:
+            self.ready.append(host)
+
+    def _adapt_repetitions(self, host, requested, rows, more):
+        """Tune max-repetitions for host from a response with rows varbinds
+        that requested max-repetitions."""
+        if not more:
+            return
+        if rows >= requested:
+            reps = min(requested * 2, self.max_repetitions)
+        else:
+            # the device sent less than asked for, probably to fit its
+            # maximum message size
+            reps = max(rows, self.min_repetitions)
+        self.repetitions[host] = reps
+
     # ***
     # *** these methods execute inside the DLNetSNMP session processing thread
     # ***
@@ -900,58 +1420,61 @@ class AsyncSNMPPoller(object):
     def _callback(self, manager, slot, session, reqid, r):
         """_callback manages reponses, performing coalescing for bulkwalks."""
 
-        pollreq = self.reqmap[reqid]
-
-        #print "_callback yo!", pollreq.type, len(r), type(r)
-        #for d in r:
-        #    print "  %s %s" % (oid_to_str(d[0]), str(d[1]))
-
-        if len(r) == 0:
-            #print "_callback NO DATA!!!?!?!?! WTF?!?!?!?!"
-            return
+        with self.lock:
+            pollreq = self.reqmap.pop(reqid, None)
+            if pollreq is None:
+                # its session was removed, see remove_session()
+                return
 
-        if pollreq.type != 'bulkwalk':
-            pollreq.callback(r)
-            #print "_callback wtf!"
-        else:
-            last = ''
-            done = False
-            for last, v in r:
-                if last[:len(pollreq.walk_oid)] != pollreq.walk_oid:
-                    done = True
-                    break
-
-                soid = oid_to_str(last).split('::')[-1]
-                pollreq.results.append((soid, v))
-
-            if done:
-                #print '_callback bulkwalk done', last
-                if pollreq.additional_oids:
-                    #print "MORE", pollreq.additional_oids
-                    oid = pollreq.additional_oids.pop(0)
-                    #print "2>%s<" % oid
-                    pollreq.walk_oid = tuple(str_to_oid(oid))
-                    new_reqid = self.sessions[session].async_getbulk(0,
-                        self.maxrepetitions, [oid])
-                    self.reqmap[new_reqid] = pollreq
-                else:
-                    pollreq.callback(pollreq.results)
+            if pollreq.type != 'subwalk':
+                if len(r) != 0:
+                    self.callbacks.append(lambda: pollreq.callback(r))
             else:
-                #print '_callback bulkwalk not done', last, oid_to_str(last)
-                # get more data
-                new_reqid = self.sessions[session].async_getbulk(0,
-                    self.maxrepetitions, [last])
-                self.reqmap[new_reqid] = pollreq
+                walk = pollreq
+                last = None
+                done = len(r) == 0
+                for last, v in r:
+                    if last[:len(walk.walk_oid)] != walk.walk_oid:
+                        done = True
+                        break
+
+                    soid = oid_to_str(last).split('::')[-1]
+                    walk.results.append((soid, v))
+
+                # compare with what this GETBULK asked for, other responses
+                # may have changed the device's max-repetitions since
+                self._adapt_repetitions(session, walk.repetitions, len(r),
+                        not done)
+
+                if done or walk.pollreq.failed:
+                    self._walk_done(session, walk)
+                else:
+                    # get more data
+                    self._getbulk(session, walk, last)
 
-        del self.reqmap[reqid]
+            self._dispatch()
 
-    def _errback(self, manager, slot, session, reqid):
-        pollreq = self.reqmap[reqid]
+        self._run_callbacks()
 
-        del self.reqmap[reqid]
+    def _errback(self, manager, slot, session, reqid):
+        with self.lock:
+            pollreq = self.reqmap.pop(reqid, None)
+            if pollreq is None:
+                return
+
+            if pollreq.type != 'subwalk':
+                # XXX look into getting actual error messages
+                self.callbacks.append(lambda: pollreq.errback("timeout"))
+            else:
+                # back off in case the device can't answer big requests
+                # in time
+                reps = min(self.repetitions.get(session, self.maxrepetitions),
+                        pollreq.repetitions)
+                self.repetitions[session] = max(reps / 2, self.min_repetitions)
+                self._walk_done(session, pollreq, failed=True)
+                self._dispatch()
 
-        # XXX look into getting actual error messages
-        pollreq.errback("timeout")
+        self._run_callbacks()
 
 
 def espoll():
@@ -1006,6 +1529,8 @@ def espoll():
     except PollerError, e:
         print str(e)
 
+    # poll right away rather than at the poller's scheduled time
+    poller.next_poll = time.time()
     poller.run_once()
 
     time.sleep(12)
@@ -1021,19 +1546,211 @@ def espoll():
     snmp_poller.shutdown()
 
 
+def poll_stats(config, opts):
+    """Print the slowest pollers from the stats written by espolld every
+    STATS_INTERVAL, merged over all the shards.  -n sets how many pollers
+    to show."""
+    if not config.poll_stats_dir:
+        print >>sys.stderr, "poll_stats_dir is not set"
+        sys.exit(1)
+
+    try:
+        top = int(opts.number)
+    except ValueError:
+        top = 20
+
+    header = "%40s %7s %8s %8s %8s %6s %7s %8s %8s %6s %8s"
+    row = "%40s % 7d %8.3f %8.3f %8.3f % 6d % 7d %8.3f %8.3f % 6d % 8d"
+
+    def values(name, m):
+        return (name[-40:], m.polls, m.walk_time.percentile(50),
+                m.walk_time.percentile(95), m.walk_time.max,
+                m.pdus.percentile(95), m.vars.percentile(95),
+                m.process_time.percentile(95), m.enqueue_time.percentile(95),
+                m.missed_deadlines, m.timeouts)
+
+    while True:
+        pollers = {}
+        total = PollerMetrics()
+        for fn in glob.glob(os.path.join(config.poll_stats_dir,
+                "espolld*.stats")):
+            try:
+                with open(fn) as f:
+                    stats = json.load(f)
+            except (IOError, ValueError):
+                continue
+
+            # left behind by a shard that no longer exists
+            if stats['time'] < time.time() - 3 * PollManager.STATS_INTERVAL:
+                continue
+
+            for k, v in stats['pollers'].iteritems():
+                pollers[k] = PollerMetrics.from_dict(v)
+                total.merge(pollers[k])
+
+        print header % ("poller", "polls", "walk p50", "walk p95",
+                "walk max", "pdus", "vars", "proc p95", "enq p95", "missed",
+                "timeouts")
+        for k, m in sorted(pollers.iteritems(),
+                key=lambda x: x[1].walk_time.percentile(95),
+                reverse=True)[:top]:
+            print row % values(k, m)
+        print row % values("TOTAL", total)
+        print ""
+        time.sleep(5)
+
+
+class PollSupervisor(object):
+    """Run poll_shards espolld worker processes and restart them if they
+    die.
+
+    Each worker is a PollManager polling the devices that the consistent
+    hash of the device name assigns to its shard, so adding or removing a
+    shard only moves about 1/N of the devices.  On SIGHUP the supervisor
+    re-reads poll_shards, starts or stops workers to match and passes the
+    SIGHUP on so the remaining workers pick up their new devices."""
+
+    def __init__(self, name, opts, config):
+        self.name = name
+        self.opts = opts
+        self.config = config
+        self.running = False
+
+        self.processes = {}
+
+        # Set by SIGHUP, run() reshards once os.wait() is interrupted.
+        self.reshard = False
+
+        self.log = get_logger(name)
+        # save the location of the calling script for later use
+        # (os.path.abspath uses current directory and daemonize does a cd /)
+        self.caller_path = os.path.abspath(__main__.__file__)
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGHUP, self.request_reshard)
+
+    def start_child(self, shard):
+        args = [sys.executable, self.caller_path,
+                '-r', 'worker',
+                '-n', str(shard),
+                '-f', self.opts.config_file]
+
+        p = Popen(args, stdout=PIPE, stderr=STDOUT)
+
+        self.processes[p.pid] = (p, shard)
+
+    def _stop_child(self, pid):
+        p, shard = self.processes.pop(pid)
+        self.log.info("killing pid %d: shard %d" % (pid, shard))
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+    def request_reshard(self, signum, frame):
+        self.reshard = True
+
+    def update_shards(self):
+        """Re-read poll_shards, stop the workers of shards no longer
+        configured, start the new ones and pass SIGHUP on to the rest."""
+        try:
+            nshards = get_config(self.opts.config_file, self.opts).poll_shards
+        except ConfigError, e:
+            self.log.error("unable to reread config: %s" % e)
+            return
+
+        self.log.info("resharding from %d to %d shards" %
+                (self.config.poll_shards, nshards))
+
+        running = dict([(shard, pid) for pid, (p, shard)
+            in self.processes.iteritems()])
+
+        for shard, pid in running.iteritems():
+            if shard >= nshards:
+                self._stop_child(pid)
+            else:
+                os.kill(pid, signal.SIGHUP)
+
+        self.config.poll_shards = nshards
+        for shard in range(nshards):
+            if shard not in running:
+                self.start_child(shard)
+
+    def run(self):
+        self.log.info("starting %d shards" % self.config.poll_shards)
+        self.running = True
+
+        for shard in range(self.config.poll_shards):
+            self.start_child(shard)
+
+        while self.running:
+            if self.reshard:
+                self.reshard = False
+                self.update_shards()
+
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.ECHILD):
+                    if e.errno == errno.ECHILD:
+                        time.sleep(1)
+                    continue
+                else:
+                    raise
+
+            if pid not in self.processes:
+                continue
+
+            p, shard = self.processes.pop(pid)
+            self.log.error("child died: pid %d, shard %d" % (pid, shard))
+            for line in p.stdout.readlines():
+                self.log.error("pid %d: %s" % (pid, line))
+
+            if shard < self.config.poll_shards:
+                self.start_child(shard)
+
+        for pid in self.processes.keys():
+            self._stop_child(pid)
+
+        self.log.info("exiting")
+
+    def stop(self, x, y):
+        self.log.info("stopping")
+        self.running = False
+
+
 def espolld():
-    """Entry point for espolld."""
+    """Entry point for espolld.
+
+    With poll_shards greater than 1 espolld runs a PollSupervisor which
+    starts one worker process (-r worker -n SHARD) per shard.  -r stats
+    shows the slowest pollers if poll_stats_dir is set."""
     argv = sys.argv
     oparse = get_opt_parser(default_config_file=get_config_path())
+    oparse.add_option("-r", "--role", dest="role", default="manager")
+    oparse.add_option("-n", "--number", dest="number", default="")
     (opts, args) = oparse.parse_args(args=argv)
 
+    opts.config_file = os.path.abspath(opts.config_file)
+
     try:
         config = get_config(opts.config_file, opts)
     except ConfigError, e:
         print e
         sys.exit(1)
 
+    if opts.role == 'stats':
+        poll_stats(config, opts)
+        return
+
     name = "espolld"
+    shard = None
+
+    if opts.role == 'worker':
+        shard = int(opts.number)
+        name += ".shard_%d" % shard
+    elif opts.role != 'manager':
+        print >>sys.stderr, "unknown role: %s" % opts.role
+        sys.exit(1)
 
     init_logging(name, config.syslog_facility, level=config.syslog_priority,
             debug=opts.debug)
@@ -1045,13 +1762,23 @@ def espolld():
         exc_handler = setup_exc_handler(name, config)
         exc_handler.install()
 
-        daemonize(name, config.pid_dir,
-                log_stdout_stderr=config.syslog_facility)
+        # workers are already running under the daemonized supervisor
+        if shard is None:
+            daemonize(name, config.pid_dir,
+                    log_stdout_stderr=config.syslog_facility)
 
     os.umask(0022)
 
+    if shard is None and config.poll_shards > 1:
+        try:
+            PollSupervisor(name, opts, config).run()
+        except Exception, e:
+            log.error("Problem with poll supervisor: %s" % e, exc_info=True)
+            sys.exit(1)
+        return
+
     try:
-        poller = PollManager(name, opts, args, config)
+        poller = PollManager(name, opts, args, config, shard=shard)
 
         poller.start_polling()
     except Exception, e:
@@ -0,0 +1,142 @@
+"""
+File backed cache of blocks of columns read from Cassandra.
+
+The REST API reads the same closed base rate and aggregation bins over
+and over for dashboards.  Once a bin is old enough it can't change, so
+CASSANDRA_DB keeps blocks of them here (see CASSANDRA_DB._xget_cached)
+rather than asking Cassandra again.
+
+Each block is a pickle in its own file named by the md5 of its key, so
+the cache is shared by every WSGI worker on the host and survives
+restarts.  Files are written to a temporary name and renamed into place,
+so readers never see a partial block.  A hit touches the file's mtime
+and when the files add up to more than max_bytes the least recently used
+ones are removed.
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+import cPickle as pickle
+
+class BlockCache(object):
+    """A cache of picklable values in the files of a directory, at most
+    max_bytes in size."""
+
+    # Evict down to this fraction of max_bytes so every write past the
+    # cap doesn't rescan the directory.
+    low_water = 0.9
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Other processes write to the directory too, so this is only an
+        # estimate until the next evict() rescans it.
+        self.size = sum([size for mtime, size, fn in self._files()])
+
+    def _filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.md5(key).hexdigest())
+
+    def _files(self):
+        files = []
+        for fn in os.listdir(self.path):
+            if fn.startswith('.tmp'):
+                continue
+            fn = os.path.join(self.path, fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue  # removed by another process
+            files.append((st.st_mtime, st.st_size, fn))
+        return files
+
+    def get(self, key):
+        """Return the value stored for key or None."""
+        fn = self._filename(key)
+        try:
+            f = open(fn, 'rb')
+            try:
+                stored_key, value = pickle.load(f)
+            finally:
+                f.close()
+        except IOError:
+            self.misses += 1
+            return None
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            self._remove(fn)
+            self.misses += 1
+            return None
+
+        if stored_key != key:
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store value for key, evicting old entries if the cache is
+        full."""
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        try:
+            f = os.fdopen(fd, 'wb')
+            pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            self.size += os.path.getsize(tmp)
+            os.rename(tmp, self._filename(key))
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def delete(self, key):
+        """Remove the value stored for key, if there is one."""
+        self._remove(self._filename(key))
+
+    def _remove(self, fn):
+        try:
+            os.unlink(fn)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used files until the cache is below
+        low_water of max_bytes."""
+        files = self._files()
+        files.sort()
+        size = sum([s for mtime, s, fn in files])
+        target = self.max_bytes * self.low_water
+        for mtime, s, fn in files:
+            if size <= target:
+                break
+            self._remove(fn)
+            size -= s
+            self.evictions += 1
+        self.size = size
+
+    def clear(self):
+        for mtime, size, fn in self._files():
+            self._remove(fn)
+        self.size = 0
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Append-only segment log used as an on-disk work queue.
+
+A log is a directory holding numbered segment files and a small ``head``
+file.  The head file records the segment currently being written to, the
+end of the valid data in that segment and the total number of records ever
+appended.  Each record in a segment is stored as::
+
+    [4 byte length][4 byte crc32][payload]
+
+Writers append under an exclusive flock() on the head file so more than
+one process can write to the same log.  Readers map segments with mmap and
+keep their position in a per-consumer offset file, so every consumer sees
+every record and picks up where it left off after a restart.  Segments
+that every consumer has read past are deleted.
+"""
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from esmond.util import get_logger
+
+RECORD_HEADER = struct.Struct('>II')
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+class SegmentLogError(Exception):
+    pass
+
+class SegmentLog(object):
+    """An append-only log stored as a directory of segment files.
+
+    ``path``
+        directory holding the log, created if it does not exist.
+    ``consumer``
+        name of the reader using this instance.  Writers leave this as None.
+    ``segment_size``
+        a new segment is started once the current one reaches this many
+        bytes.
+    ``fsync``
+        one of 'always' (fsync after every append and commit), 'interval'
+        (at most once every ``fsync_interval`` seconds) or 'never' (leave it
+        to the OS).
+    """
+
+    HEAD = 'head'
+    HEAD_FMT = '%020d %020d %020d\n'
+    SEGMENT_SUFFIX = '.seg'
+    OFFSET_SUFFIX = '.offset'
+
+    def __init__(self, path, consumer=None, segment_size=64*1024*1024,
+            fsync='interval', fsync_interval=1):
+        if fsync not in FSYNC_POLICIES:
+            raise SegmentLogError('unknown fsync policy: %s' % fsync)
+
+        self.path = path
+        self.consumer = consumer
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.log = get_logger('SegmentLog')
+
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._head_fd = os.open(os.path.join(path, self.HEAD),
+            os.O_RDWR | os.O_CREAT, 0644)
+        self._last_sync = 0
+
+        # Writer state.
+        self._seg_fd = None
+        self._seg_no = None
+
+        # Reader state - the position only advances in memory until
+        # commit() is called.
+        self._map = None
+        self._map_no = None
+        if consumer:
+            self._committed = self._read_offset(consumer)
+            self._position = self._committed
+
+    def close(self):
+        if self._seg_fd is not None:
+            os.close(self._seg_fd)
+            self._seg_fd = None
+        self._unmap()
+        os.close(self._head_fd)
+
+    def _segment_path(self, seg_no):
+        return os.path.join(self.path, '%020d%s' % (seg_no, self.SEGMENT_SUFFIX))
+
+    def _offset_path(self, consumer):
+        return os.path.join(self.path, consumer + self.OFFSET_SUFFIX)
+
+    def _read_head(self):
+        """Return (segment number, end of valid data, records appended)."""
+        os.lseek(self._head_fd, 0, os.SEEK_SET)
+        buf = os.read(self._head_fd, 128)
+        if not buf:
+            return 0, 0, 0
+        seg_no, end, count = buf.split()
+        return int(seg_no), int(end), int(count)
+
+    def _write_head(self, seg_no, end, count):
+        # Fixed width so the head is always overwritten in one write.
+        os.lseek(self._head_fd, 0, os.SEEK_SET)
+        self._write(self._head_fd, self.HEAD_FMT % (seg_no, end, count))
+
+    def _read_offset(self, consumer):
+        """Return (segment number, offset, records read) for consumer."""
+        try:
+            f = open(self._offset_path(consumer))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0, 0, 0
+        try:
+            seg_no, offset, count = f.read().split()
+        finally:
+            f.close()
+        return int(seg_no), int(offset), int(count)
+
+    def _write(self, fd, buf):
+        while buf:
+            n = os.write(fd, buf)
+            buf = buf[n:]
+
+    def _should_sync(self):
+        if self.fsync == 'always':
+            return True
+        if self.fsync == 'interval':
+            now = time.time()
+            if now >= self._last_sync + self.fsync_interval:
+                self._last_sync = now
+                return True
+        return False
+
+    def _segment_fd(self, seg_no):
+        if seg_no != self._seg_no:
+            if self._seg_fd is not None:
+                os.close(self._seg_fd)
+            self._seg_fd = os.open(self._segment_path(seg_no),
+                os.O_RDWR | os.O_CREAT, 0644)
+            self._seg_no = seg_no
+        return self._seg_fd
+
+    def append(self, payloads):
+        """Append a list of strings to the log as one write."""
+        if not payloads:
+            return
+
+        records = []
+        for p in payloads:
+            if not p:
+                raise SegmentLogError('can not append an empty record')
+            records.append(RECORD_HEADER.pack(len(p), zlib.crc32(p) & 0xffffffff))
+            records.append(p)
+        buf = ''.join(records)
+
+        fcntl.flock(self._head_fd, fcntl.LOCK_EX)
+        try:
+            seg_no, end, count = self._read_head()
+
+            fd = self._segment_fd(seg_no)
+
+            # Anything past the end recorded in the head was left behind
+            # by a writer that died part way through an append.
+            if os.fstat(fd).st_size != end:
+                os.ftruncate(fd, end)
+
+            if end >= self.segment_size:
+                seg_no += 1
+                end = 0
+                fd = self._segment_fd(seg_no)
+
+            os.lseek(fd, end, os.SEEK_SET)
+            self._write(fd, buf)
+
+            sync = self._should_sync()
+            if sync:
+                os.fsync(fd)
+
+            self._write_head(seg_no, end + len(buf), count + len(payloads))
+
+            if sync:
+                os.fsync(self._head_fd)
+        finally:
+            fcntl.flock(self._head_fd, fcntl.LOCK_UN)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._map_no = None
+
+    def _mapping(self, seg_no, size):
+        """Return an mmap of segment seg_no at least size bytes long."""
+        if self._map_no == seg_no and len(self._map) >= size:
+            return self._map
+
+        self._unmap()
+
+        try:
+            fd = os.open(self._segment_path(seg_no), os.O_RDONLY)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            if os.fstat(fd).st_size < max(size, 1):
+                return None
+            self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            self._map_no = seg_no
+        finally:
+            os.close(fd)
+
+        return self._map
+
+    def read(self, n):
+        """Return up to n records from the consumer's current position."""
+        records = []
+
+        fcntl.flock(self._head_fd, fcntl.LOCK_SH)
+        try:
+            head_no, head_end, head_count = self._read_head()
+        finally:
+            fcntl.flock(self._head_fd, fcntl.LOCK_UN)
+
+        seg_no, offset, count = self._position
+
+        while len(records) < n and seg_no <= head_no:
+            if seg_no == head_no:
+                limit = head_end
+            else:
+                try:
+                    limit = os.path.getsize(self._segment_path(seg_no))
+                except OSError:
+                    limit = 0
+
+            if offset < limit:
+                m = self._mapping(seg_no, limit)
+                if m is None:
+                    limit = offset
+
+            while len(records) < n and offset < limit:
+                if offset + RECORD_HEADER.size > limit:
+                    self.log.error('truncated record header in %s at %d' %
+                        (self._segment_path(seg_no), offset))
+                    offset = limit
+                    break
+
+                length, crc = RECORD_HEADER.unpack_from(m, offset)
+                start = offset + RECORD_HEADER.size
+
+                if length == 0 or start + length > limit:
+                    self.log.error('bad record length in %s at %d' %
+                        (self._segment_path(seg_no), offset))
+                    offset = limit
+                    break
+
+                p = m[start:start + length]
+                offset = start + length
+
+                if zlib.crc32(p) & 0xffffffff != crc:
+                    self.log.error('bad record checksum in %s at %d' %
+                        (self._segment_path(seg_no), start))
+                    count += 1
+                    continue
+
+                records.append(p)
+                count += 1
+
+            if offset >= limit and seg_no < head_no:
+                seg_no += 1
+                offset = 0
+            else:
+                break
+
+        # Records lost to a bad header are skipped without knowing how many
+        # there were, so once the reader reaches the head take its count
+        # rather than leave pending() stuck above 0.
+        if seg_no == head_no and offset >= head_end:
+            count = head_count
+
+        self._position = (seg_no, offset, count)
+
+        return records
+
+    def rollback(self):
+        """Go back to the last committed position so the records read
+        since are read again."""
+        self._position = self._committed
+
+    def commit(self):
+        """Save the consumer's position and remove fully read segments."""
+        if self._position == self._committed:
+            return
+
+        path = self._offset_path(self.consumer)
+        tmp = path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write('%d %d %d\n' % self._position)
+            f.flush()
+            if self._should_sync():
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+        old_no = self._committed[0]
+        self._committed = self._position
+
+        if self._position[0] > old_no:
+            self.cleanup()
+
+    def cleanup(self):
+        """Remove segments that every consumer has read past."""
+        consumers = [f[:-len(self.OFFSET_SUFFIX)] for f in os.listdir(self.path)
+            if f.endswith(self.OFFSET_SUFFIX)]
+        if not consumers:
+            return
+
+        low = min([self._read_offset(c)[0] for c in consumers])
+
+        for f in os.listdir(self.path):
+            if not f.endswith(self.SEGMENT_SUFFIX):
+                continue
+            if int(f[:-len(self.SEGMENT_SUFFIX)]) < low:
+                try:
+                    os.unlink(os.path.join(self.path, f))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def counts(self, consumer=None):
+        """Return (records appended, records read by consumer)."""
+        consumer = consumer or self.consumer
+        appended = self._read_head()[2]
+        if consumer is None:
+            read = 0
+        elif consumer == self.consumer:
+            read = self._position[2]
+        else:
+            read = self._read_offset(consumer)[2]
+        return appended, read
+
+    def pending(self):
+        """Number of records the consumer has not read yet."""
+        appended, read = self.counts()
+        return max(appended - read, 0)
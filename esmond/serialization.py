@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Serializers for PollResults on the persist queues.
+
+Two formats are available:
+
+``json``
+    the original format, a JSON object.
+``binary``
+    a compact binary format.  Every string in the result (device, oidset and
+    oid names, variable names, etc) is stored once in a string table and
+    referred to by index.  Integers are zigzag varints.  The usual
+    ``data`` payload - a list of ([name, ...], counter) pairs - is stored as
+    packed arrays of string indexes and int64 counters.
+
+Which format is written is configured per queue (see ``persist_serializers``
+in the config docs).  ``loads`` detects the format from the first byte so a
+reader handles either, and the binary serializer falls back to JSON for any
+result it can not encode.
+"""
+
+import json
+import struct
+
+from itertools import chain, count, izip
+
+MAGIC = '\x93'
+VERSION = 1
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+UINT64_MAX = 2**64 - 1
+
+SEQUENCE_TYPES = set([list, tuple])
+INT_TYPES = set([int, long])
+STRING_TYPES = set([str, unicode])
+
+class SerializationError(Exception):
+    pass
+
+def _varint(n):
+    """Encode a non-negative integer as a varint."""
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _read_varint(buf, pos):
+    n = shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+def _zigzag(n):
+    if n >= 0:
+        return n << 1
+    return ((-n) << 1) - 1
+
+def _unzigzag(n):
+    if n & 1:
+        return -((n + 1) >> 1)
+    return n >> 1
+
+def _index_format(n):
+    """Smallest struct format that holds indexes up to n."""
+    if n < 2**8:
+        return 'B'
+    elif n < 2**16:
+        return 'H'
+    return 'I'
+
+class JSONResultSerializer(object):
+    name = 'json'
+
+    def dumps(self, d):
+        return json.dumps(d)
+
+    def loads(self, s):
+        return json.loads(s)
+
+class _Encoder(object):
+    """Encodes one result, building up the string table as it goes."""
+
+    def __init__(self):
+        self.strings = {}
+        self.table = []
+        self.out = []
+
+    def intern(self, s):
+        try:
+            return self.strings[s]
+        except KeyError:
+            i = self.strings[s] = len(self.table)
+            self.table.append(s)
+            return i
+
+    def intern_many(self, names):
+        strings = self.strings
+        new = [s for s in set(names) if s not in strings]
+        strings.update(izip(new, count(len(self.table))))
+        self.table.extend(new)
+        return map(strings.__getitem__, names)
+
+    def string_table(self):
+        """The strings are stored as one NUL separated UTF-8 block so they
+        can be decoded in one go."""
+        blob = '\x00'.join([type(s) is unicode and s.encode('utf-8') or s
+            for s in self.table])
+        if blob.count('\x00') != max(len(self.table) - 1, 0):
+            raise SerializationError('NUL in string')
+        # Make sure the strings decode the way JSON would.
+        blob.decode('utf-8')
+        return _varint(len(self.table)) + _varint(len(blob)) + blob
+
+    def encode(self, v):
+        out = self.out
+        t = type(v)
+
+        if t is str or t is unicode:
+            out.append('s' + _varint(self.intern(v)))
+        elif t is bool:
+            out.append(v and 'T' or 'F')
+        elif t is int or t is long:
+            out.append('i' + _varint(_zigzag(v)))
+        elif t is float:
+            out.append('d' + struct.pack('>d', v))
+        elif v is None:
+            out.append('N')
+        elif t is list or t is tuple:
+            if not self.encode_pairs(v):
+                out.append('l' + _varint(len(v)))
+                for i in v:
+                    self.encode(i)
+        elif t is dict:
+            out.append('m' + _varint(len(v)))
+            for k, i in v.iteritems():
+                self.encode(k)
+                self.encode(i)
+        else:
+            raise SerializationError('can not encode %s' % t)
+
+    def encode_pairs(self, l):
+        """Pack a list of ([name, ...], int) pairs as arrays.  Returns False
+        without encoding anything if l is not of that form."""
+        # The checks are done with map() and set() rather than a loop over
+        # the items as this is the bulk of every result.
+        if not l or not set(map(type, l)) <= SEQUENCE_TYPES or \
+                set(map(len, l)) != set([2]):
+            return False
+
+        paths, vals = zip(*l)
+        if not set(map(type, paths)) <= SEQUENCE_TYPES or \
+                not set(map(type, vals)) <= INT_TYPES:
+            return False
+
+        lens = set(map(len, paths))
+        if len(lens) != 1:
+            return False
+        k = lens.pop()
+
+        names = list(chain.from_iterable(paths))
+        if not set(map(type, names)) <= STRING_TYPES:
+            return False
+
+        lo = min(vals)
+        hi = max(vals)
+        if lo >= INT64_MIN and hi <= INT64_MAX:
+            vfmt = 'q'
+        elif lo >= 0 and hi <= UINT64_MAX:
+            vfmt = 'Q'
+        else:
+            return False
+
+        idx = self.intern_many(names)
+        ifmt = _index_format(len(self.table) - 1)
+
+        self.out.append(''.join(['P', _varint(len(l)), _varint(k), ifmt, vfmt,
+            struct.pack('>%d%s' % (len(idx), ifmt), *idx),
+            struct.pack('>%d%s' % (len(vals), vfmt), *vals)]))
+
+        return True
+
+class _Decoder(object):
+    def __init__(self, buf, pos):
+        self.buf = buf
+        n, pos = _read_varint(buf, pos)
+        l, pos = _read_varint(buf, pos)
+        if n:
+            self.table = buf[pos:pos + l].decode('utf-8').split(u'\x00')
+        else:
+            self.table = []
+        self.pos = pos + l
+
+    def decode(self):
+        buf = self.buf
+        tag = buf[self.pos]
+        self.pos += 1
+
+        if tag == 's':
+            i, self.pos = _read_varint(buf, self.pos)
+            return self.table[i]
+        elif tag == 'i':
+            n, self.pos = _read_varint(buf, self.pos)
+            return _unzigzag(n)
+        elif tag == 'P':
+            return self.decode_pairs()
+        elif tag == 'l':
+            n, self.pos = _read_varint(buf, self.pos)
+            return [self.decode() for i in xrange(n)]
+        elif tag == 'm':
+            n, self.pos = _read_varint(buf, self.pos)
+            d = {}
+            for i in xrange(n):
+                k = self.decode()
+                d[k] = self.decode()
+            return d
+        elif tag == 'd':
+            v = struct.unpack_from('>d', buf, self.pos)[0]
+            self.pos += 8
+            return v
+        elif tag == 'N':
+            return None
+        elif tag == 'T':
+            return True
+        elif tag == 'F':
+            return False
+        raise SerializationError('unknown tag %r at %d' % (tag, self.pos - 1))
+
+    def decode_pairs(self):
+        buf = self.buf
+        n, pos = _read_varint(buf, self.pos)
+        k, pos = _read_varint(buf, pos)
+        ifmt = buf[pos]
+        vfmt = buf[pos + 1]
+        pos += 2
+
+        fmt = '>%d%s' % (n * k, ifmt)
+        idx = struct.unpack_from(fmt, buf, pos)
+        pos += struct.calcsize(fmt)
+        fmt = '>%d%s' % (n, vfmt)
+        vals = struct.unpack_from(fmt, buf, pos)
+        self.pos = pos + struct.calcsize(fmt)
+
+        names = map(self.table.__getitem__, idx)
+        if k == 2:
+            # The common case - [oid, interface] pairs.
+            return [[[a, b], v] for a, b, v in izip(names[0::2], names[1::2], vals)]
+
+        return [[names[i*k:(i+1)*k], vals[i]] for i in xrange(n)]
+
+class BinaryResultSerializer(object):
+    name = 'binary'
+
+    def dumps(self, d):
+        enc = _Encoder()
+        try:
+            enc.encode(d)
+            table = enc.string_table()
+        except (SerializationError, UnicodeDecodeError, struct.error):
+            return json.dumps(d)
+        return ''.join([MAGIC, chr(VERSION), table] + enc.out)
+
+    def loads(self, s):
+        if s[0] != MAGIC:
+            return json.loads(s)
+        if ord(s[1]) != VERSION:
+            raise SerializationError('unknown binary version %d' % ord(s[1]))
+        return _Decoder(s, 2).decode()
+
+SERIALIZERS = {
+    'json': JSONResultSerializer,
+    'binary': BinaryResultSerializer,
+}
+
+def get_serializer(name):
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise SerializationError('unknown serializer: %s' % name)
+
+def loads(s):
+    """Decode a result written by any of the serializers."""
+    if s and s[0] == MAGIC:
+        return BinaryResultSerializer().loads(s)
+    return json.loads(s)
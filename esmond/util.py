@@ -13,6 +13,9 @@ from StringIO import StringIO
 import traceback
 import inspect
 import tempfile
+import hashlib
+import bisect
+import math
 from optparse import OptionParser
 
 from django.utils.timezone import utc, make_aware
@@ -464,6 +467,111 @@ def build_alu_sap_name(s):
     return "-".join((service, decode_alu_port(port), vlan))
 
 
+class HashRing(object):
+    """Consistent hash ring mapping keys to nodes.
+
+    Each node is placed on the ring replicas times at the md5 of
+    "node:i" and a key belongs to the first node point after the md5 of
+    the key.  Adding or removing a node only moves the keys next to that
+    node's points, about 1/N of them."""
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+
+        points = []
+        for node in self.nodes:
+            for i in xrange(replicas):
+                points.append((self._hash('%s:%d' % (node, i)), node))
+        points.sort()
+
+        self._keys = [h for h, node in points]
+        self._nodes = [node for h, node in points]
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """Return the node key belongs to."""
+        if not self._keys:
+            raise ValueError("HashRing has no nodes")
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[i]
+
+class Histogram(object):
+    """Histogram with exponentially sized buckets.
+
+    Bucket 0 holds values below base and bucket i values in
+    [base * 2**(i-1), base * 2**i), the last bucket holds everything
+    larger.  Percentiles are the upper bound of the bucket they fall in,
+    so they are within a factor of 2.  The buckets are a fixed length list
+    so another thread can read them while values are added."""
+
+    def __init__(self, base=1, nbuckets=32):
+        self.base = base
+        self.buckets = [0] * nbuckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def _bucket(self, value):
+        if value < self.base:
+            return 0
+        i = int(math.log(float(value) / self.base, 2)) + 1
+        return min(i, len(self.buckets) - 1)
+
+    def add(self, value):
+        self.buckets[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0
+        return self.total / float(self.count)
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the pth
+        percentile, capped at the largest value seen."""
+        if not self.count:
+            return 0
+        target = max(int(math.ceil(self.count * p / 100.0)), 1)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(self.base * 2 ** i, self.max)
+        return self.max
+
+    def merge(self, other):
+        """Add the values of other, which must have the same buckets."""
+        if other.base != self.base or \
+                len(other.buckets) != len(self.buckets):
+            raise ValueError("can't merge histograms with different buckets")
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def to_dict(self):
+        return dict(base=self.base, buckets=list(self.buckets),
+                count=self.count, total=self.total, max=self.max)
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(base=d['base'], nbuckets=len(d['buckets']))
+        h.buckets = list(d['buckets'])
+        h.count = d['count']
+        h.total = d['total']
+        h.max = d['max']
+        return h
+
 def datetime_to_unixtime(dt):
     return int(time.mktime(dt.timetuple()))
 
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the gap fill in esmond.api.dataseries.Fill: the OrderedDict
+version against the numpy version and the array-native fill_arrays, at
+10k, 100k and 1M bins.  numpy must be installed.
+"""
+
+import random
+import time
+
+from optparse import OptionParser
+
+from esmond.api.dataseries import Fill, QueryUtil
+
+def build_data(n_bins, freq, missing):
+    data = []
+    for i in xrange(n_bins):
+        if random.random() >= missing:
+            data.append({'ts': i * freq, 'val': float(i)})
+    return data
+
+def timed(f, *args):
+    t0 = time.time()
+    f(*args)
+    return time.time() - t0
+
+def main():
+    usage = '%prog [ -f FREQ | -m MISSING ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--freq', metavar='FREQ',
+            type='int', dest='freq', default=30,
+            help='Bin size in seconds (default=%default).')
+    parser.add_option('-m', '--missing', metavar='MISSING',
+            type='float', dest='missing', default=0.1,
+            help='Fraction of bins with no data (default=%default).')
+    parser.add_option('-b', '--bins', metavar='BINS',
+            type='string', dest='bins', default='10000,100000,1000000',
+            help='Comma separated list of series lengths (default=%default).')
+    options, args = parser.parse_args()
+
+    print '%10s %12s %12s %12s' % ('bins', 'dict sec', 'numpy sec', 'arrays sec')
+    for n_bins in [int(x) for x in options.bins.split(',')]:
+        freq = options.freq
+        end = (n_bins - 1) * freq
+        data = build_data(n_bins, freq, options.missing)
+
+        t_dict = timed(lambda: list(Fill.filled_series_dict(0, end, freq, data)))
+        t_numpy = timed(Fill.filled_series_numpy, 0, end, freq, data)
+
+        rows = [{'ts': d['ts'] * 1000, 'val': d['val'], 'is_valid': 1}
+            for d in data]
+        ts, vals = QueryUtil.format_data_arrays(rows)
+        t_arrays = timed(Fill.fill_arrays, 0, end, freq, ts, vals)
+
+        print '%10d %12.3f %12.3f %12.3f' % (n_bins, t_dict, t_numpy, t_arrays)
+
+if __name__ == '__main__':
+    main()
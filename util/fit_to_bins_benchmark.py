@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Benchmark fit_to_bins against fit_to_bins_batch in esmond.api.dataseries
+for a poll of many counters.  numpy must be installed.
+"""
+
+import random
+import time
+
+from optparse import OptionParser
+
+from esmond.api.dataseries import fit_to_bins, fit_to_bins_batch
+
+def build_counters(n_vars, freq, spread):
+    ts_prev, val_prev, ts_curr, val_curr = [], [], [], []
+    t = 1386369693000
+    for i in xrange(n_vars):
+        v = random.randint(0, 2**63)
+        ts_prev.append(t + random.randint(0, freq))
+        val_prev.append(v)
+        ts_curr.append(ts_prev[-1] + random.randint(freq - spread, freq + spread))
+        val_curr.append(v + random.randint(0, 2**32))
+    return ts_prev, val_prev, ts_curr, val_curr
+
+def timed(f, *args):
+    t0 = time.time()
+    f(*args)
+    return time.time() - t0
+
+def scalar(freq, ts_prev, val_prev, ts_curr, val_curr):
+    return [fit_to_bins(freq, *a)
+        for a in zip(ts_prev, val_prev, ts_curr, val_curr)]
+
+def main():
+    usage = '%prog [ -f FREQ | -s SPREAD | -n VARS ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-f', '--freq', metavar='FREQ',
+            type='int', dest='freq', default=30000,
+            help='Bin size in ms (default=%default).')
+    parser.add_option('-s', '--spread', metavar='SPREAD',
+            type='int', dest='spread', default=5000,
+            help='Jitter of the poll interval in ms (default=%default).')
+    parser.add_option('-n', '--vars', metavar='VARS',
+            type='string', dest='vars', default='100,1000,10000,100000',
+            help='Comma separated list of counter counts (default=%default).')
+    options, args = parser.parse_args()
+
+    print '%10s %12s %12s %14s' % ('vars', 'scalar sec', 'batch sec',
+            'batch vars/sec')
+    for n_vars in [int(x) for x in options.vars.split(',')]:
+        args = build_counters(n_vars, options.freq, options.spread)
+        t_scalar = timed(scalar, options.freq, *args)
+        t_batch = timed(fit_to_bins_batch, options.freq, *args)
+        print '%10d %12.4f %12.4f %14d' % (n_vars, t_scalar, t_batch,
+                n_vars / max(t_batch, 1e-6))
+
+if __name__ == '__main__':
+    main()
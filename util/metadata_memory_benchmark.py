@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+Measure the memory the persister's metadata cache uses per tracked series
+with the Metadata objects it holds now against the dicts it used to hold
+(Metadata.get_document()).  Each run is done in a forked child so the
+runs don't share freed memory.  Linux only, it reads the RSS from /proc.
+"""
+
+import os
+import sys
+
+from optparse import OptionParser
+
+from esmond.cassandra import LRUCache, Metadata, get_rowkey
+
+def rss():
+    """Resident set size of this process in bytes."""
+    f = open('/proc/self/statm')
+    try:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        f.close()
+
+def fill(cache, n_series, as_dict):
+    ts = 1386369693000
+    for i in xrange(n_series):
+        path = ['snmp', 'rtr_%d' % (i / 1000), 'FastPollHC', 'ifHCInOctets',
+            'xe-0/0/%d' % i]
+        meta_d = Metadata(path=path, last_update=ts, last_val=i * 1000,
+            min_ts=ts, freq=30000)
+        if as_dict:
+            meta_d = meta_d.get_document()
+        cache[get_rowkey(path, freq=30000)] = meta_d
+
+def measure(n_series, as_dict):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        cache = LRUCache(n_series)
+        before = rss()
+        fill(cache, n_series, as_dict)
+        os.write(w, str(rss() - before))
+        os._exit(0)
+
+    os.close(w)
+    used = int(os.read(r, 64))
+    os.close(r)
+    os.waitpid(pid, 0)
+    return used
+
+def main():
+    usage = '%prog [ -n SERIES ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--series', metavar='SERIES',
+            type='int', dest='series', default=1000000,
+            help='Number of series to track (default=%default).')
+    options, args = parser.parse_args()
+
+    print '%10s %14s %16s' % ('cache', 'MB', 'bytes/series')
+    for name, as_dict in (('dict', True), ('slots', False)):
+        used = measure(options.series, as_dict)
+        print '%10s %14.1f %16d' % (name, used / 1048576.0,
+                used / options.series)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+Benchmark CassandraPollPersister.store() on a synthetic PollResult with
+and without batched writes and report records/sec for each.
+
+Data is written to the unit test keyspace (ESMOND_UNIT_TESTS is set below)
+so a running cassandra instance and the oidsets.json fixture are needed.
+"""
+
+import os
+import time
+
+from optparse import OptionParser
+
+# Use the test keyspace so the synthetic data does not end up in production.
+os.environ['ESMOND_UNIT_TESTS'] = 'True'
+
+from esmond.config import get_config, get_config_path
+from esmond.persist import CassandraPollPersister, PollResult, \
+     PersistQueueEmpty
+
+class BenchmarkQueue(object):
+    """Placeholder queue - store() is called directly."""
+    def get(self):
+        raise PersistQueueEmpty()
+
+def build_result(device, oidset, oid, n_ifaces, ts, counter):
+    data = []
+    for i in xrange(n_ifaces):
+        data.append([[oid, 'xe-%d/%d/%d' % (i / 1000, (i / 10) % 100, i % 10)],
+            counter + (i * 1000)])
+    return PollResult(oidset_name=oidset, device_name=device, oid_name=oid,
+            timestamp=ts, data=data, metadata={})
+
+def run(p, options, batch_writes):
+    p.batch_writes = batch_writes
+
+    # First pass seeds the metadata cache so the timed passes measure
+    # steady state writes rather than the seek back reads.
+    ts = options.start
+    p.store(build_result(options.device, options.oidset, options.oid,
+        options.interfaces, ts, 0))
+    p.db.flush()
+
+    elapsed = 0
+    records = 0
+
+    for i in xrange(1, options.rounds + 1):
+        ts += options.freq
+        result = build_result(options.device, options.oidset, options.oid,
+            options.interfaces, ts, i * 1000000)
+        t0 = time.time()
+        p.store(result)
+        p.db.flush()
+        elapsed += time.time() - t0
+        records += len(result.data)
+
+    return records, elapsed
+
+def main():
+    usage = '%prog [ -n INTERFACES | -r ROUNDS ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--interfaces', metavar='INTERFACES',
+            type='int', dest='interfaces', default=10000,
+            help='Number of interfaces in the PollResult (default=%default).')
+    parser.add_option('-r', '--rounds', metavar='ROUNDS',
+            type='int', dest='rounds', default=5,
+            help='Number of timed PollResults per run (default=%default).')
+    parser.add_option('-d', '--device', metavar='DEVICE',
+            type='string', dest='device', default='bench_rtr',
+            help='Device name to write to (default=%default).')
+    parser.add_option('-o', '--oidset', metavar='OIDSET',
+            type='string', dest='oidset', default='FastPollHC',
+            help='OIDSet name (default=%default).')
+    parser.add_option('-i', '--oid', metavar='OID',
+            type='string', dest='oid', default='ifHCInOctets',
+            help='OID name (default=%default).')
+    parser.add_option('-f', '--freq', metavar='FREQ',
+            type='int', dest='freq', default=30,
+            help='Seconds between PollResults (default=%default).')
+    parser.add_option('-s', '--start', metavar='START',
+            type='int', dest='start', default=int(time.time()) - 86400,
+            help='Timestamp of the first PollResult (default=a day ago).')
+    options, args = parser.parse_args()
+
+    config = get_config(get_config_path())
+
+    for batch_writes in (False, True):
+        config.db_clear_on_testing = True
+        p = CassandraPollPersister(config, 'bench', persistq=BenchmarkQueue())
+        config.db_clear_on_testing = False
+
+        records, elapsed = run(p, options, batch_writes)
+        p.db.close()
+
+        print '%-10s %d records in %.3f sec (%.1f records/sec)' % \
+            ('batched' if batch_writes else 'unbatched', records, elapsed,
+            records / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""
+Benchmark building Cassandra row keys with build_rowkey against the
+RowKeyCache behind get_rowkey in esmond.cassandra, for the same set of
+paths repeated every poll as the persister sees them.
+"""
+
+import time
+
+from optparse import OptionParser
+
+from esmond.cassandra import build_rowkey, RowKeyCache
+
+def build_paths(n_paths):
+    paths = []
+    for i in xrange(n_paths):
+        paths.append(['snmp', 'rtr_%d' % (i / 1000), 'FastPollHC',
+            'ifHCInOctets', 'xe-%d/0/%d.%d' % (i % 8, i % 48, i)])
+    return paths
+
+def timed(f, paths, rounds):
+    t0 = time.time()
+    for i in xrange(rounds):
+        for path in paths:
+            f(path, 30000, 2013)
+    return time.time() - t0
+
+def main():
+    usage = '%prog [ -r ROUNDS | -n PATHS ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--rounds', metavar='ROUNDS',
+            type='int', dest='rounds', default=10,
+            help='Number of times each key is built (default=%default).')
+    parser.add_option('-n', '--paths', metavar='PATHS',
+            type='string', dest='paths', default='1000,10000,100000',
+            help='Comma separated list of path counts (default=%default).')
+    options, args = parser.parse_args()
+
+    print '%10s %14s %14s' % ('paths', 'build keys/s', 'cached keys/s')
+    for n_paths in [int(x) for x in options.paths.split(',')]:
+        paths = build_paths(n_paths)
+        n_keys = n_paths * options.rounds
+        t_build = timed(build_rowkey, paths, options.rounds)
+        t_cached = timed(RowKeyCache(max_entries=n_paths).get, paths,
+                options.rounds)
+        print '%10d %14d %14d' % (n_paths, n_keys / max(t_build, 1e-6),
+                n_keys / max(t_cached, 1e-6))
+
+if __name__ == '__main__':
+    main()
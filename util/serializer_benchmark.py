@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+Compare the persist queue serializers on a synthetic PollResult: bytes per
+result and encode/decode time for each.
+
+Only esmond.serialization is used so no database or memcached is needed.
+"""
+
+import time
+
+from optparse import OptionParser
+
+from esmond.serialization import SERIALIZERS, loads
+
+def build_result(n_ifaces, oid, counter):
+    data = []
+    for i in xrange(n_ifaces):
+        data.append([[oid, 'xe-%d/%d/%d' % (i / 1000, (i / 10) % 100, i % 10)],
+            counter + (i * 1000000)])
+    return dict(oidset_name='FastPollHC', device_name='bench_rtr',
+            oid_name=oid, timestamp=time.time(), data=data,
+            metadata={'tsdb_flags': 1})
+
+def timed(f, arg, rounds):
+    t0 = time.time()
+    for i in xrange(rounds):
+        f(arg)
+    return (time.time() - t0) / rounds
+
+def main():
+    usage = '%prog [ -n INTERFACES | -r ROUNDS ]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-n', '--interfaces', metavar='INTERFACES',
+            type='int', dest='interfaces', default=1000,
+            help='Number of interfaces in the PollResult (default=%default).')
+    parser.add_option('-r', '--rounds', metavar='ROUNDS',
+            type='int', dest='rounds', default=100,
+            help='Number of encode/decode rounds (default=%default).')
+    parser.add_option('-i', '--oid', metavar='OID',
+            type='string', dest='oid', default='ifHCInOctets',
+            help='OID name (default=%default).')
+    options, args = parser.parse_args()
+
+    result = build_result(options.interfaces, options.oid, 2**40)
+
+    print '%-8s %12s %12s %12s' % ('format', 'bytes', 'encode ms', 'decode ms')
+    for name in sorted(SERIALIZERS):
+        s = SERIALIZERS[name]()
+        ser = s.dumps(result)
+        enc = timed(s.dumps, result, options.rounds)
+        dec = timed(loads, ser, options.rounds)
+        print '%-8s %12d %12.3f %12.3f' % (name, len(ser), enc * 1000, dec * 1000)
+
+if __name__ == '__main__':
+    main()